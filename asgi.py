@@ -0,0 +1,16 @@
+"""
+ASGI entry point, e.g.
+
+  uvicorn asgi:app --workers 4
+
+Run "flask --app app db-upgrade" first and set DATABASE_AUTO_UPGRADE=0 so the
+workers do not all migrate the database at once. Each worker runs the WSGI
+application on a pool of WEB_THREADS threads, set ASYNC_VIEWS=1 for the async
+variants of the read-heavy routes.
+"""
+import os
+from a2wsgi import WSGIMiddleware
+
+from app import create_app
+
+app = WSGIMiddleware(create_app(), workers=int(os.environ.get("WEB_THREADS", 4)))
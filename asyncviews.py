@@ -0,0 +1,143 @@
+import asyncio
+import threading
+from flask import Blueprint, current_app, render_template, request, jsonify, g
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.pool import NullPool
+
+from models import db
+from database import is_sqlite, sqlite_pragmas, apply_pragmas, replica_reads
+from helpers import handle_error, login_required, get_user_id_from_session, get_page_size
+from httpcache import conditional
+from fragments import cached_fragment_async
+from queries import monument_cards_statement, cards_page, card_to_dict, monument_details_statement, details_row, visited_ids, rated_fingerprint, queued_visit
+from ratings import top_rated_statement, top_rated_to_dict, rating_epoch
+from search import search_statement, result_to_dict
+from recommendations import recommendations
+
+# Async variants of the read-heavy routes, registered by create_app when ASYNC_VIEWS is set
+async_views = Blueprint("async_views", __name__)
+
+# Async drivers of the supported databases
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+def init_async_database(app):
+  """Create the async engines the async views read with, on the same databases as the primary engine and the read replica."""
+  with app.app_context():
+    urls = dict((key, engine.url) for key, engine in db.engines.items())
+  app.extensions["async_engine"] = create_async_variant(app, urls[None])
+  if "replica" in urls:
+    app.extensions["async_replica_engine"] = create_async_variant(app, urls["replica"])
+
+def create_async_variant(app, url):
+  # Flask runs each async view in an event loop of its own, a pooled connection would outlive its loop
+  engine = create_async_engine(url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]), poolclass=NullPool)
+  if is_sqlite(engine):
+    apply_pragmas(engine.sync_engine, sqlite_pragmas(app, primary=False))
+
+  # The first connection initializes the dialect under a lock of the loop it runs in, get it
+  # done here before requests connect from loops of their own. A thread of its own, so this
+  # also works when the server creates the app inside its event loop
+  warmup = threading.Thread(target=asyncio.run, args=(connect_once(engine),))
+  warmup.start()
+  warmup.join()
+  return engine
+
+async def connect_once(engine):
+  async with engine.connect():
+    pass
+
+def async_session():
+  """Return a session on the read replica inside replica_reads routes if one is configured, else on the primary."""
+  engines = current_app.extensions
+  if g.get("replica_reads") and "async_replica_engine" in engines:
+    return AsyncSession(engines["async_replica_engine"])
+  return AsyncSession(engines["async_engine"])
+
+async def run_sync(f, *args):
+  """Run a function that may query through the synchronous engine on a thread, so it does not block the event loop."""
+  # The thread sees the request's contexts, asyncio.to_thread copies the context variables they live in
+  return await asyncio.to_thread(f, *args)
+
+async def fetch_cards(after, limit):
+  async with async_session() as session:
+    result = await session.execute(monument_cards_statement(after).limit(limit + 1))
+    return cards_page(result.all(), limit)
+
+@async_views.route("/monuments")
+@replica_reads
+@login_required
+@conditional("monument", "media", vary=rated_fingerprint)
+async def monument():
+  """List approved monuments, one page at a time"""
+  after = request.args.get("after")
+  limit = get_page_size()
+  try:
+    cards, (ids, next) = await cached_fragment_async("monuments", ("monument", "media"), (after, limit, rating_epoch()), lambda: render_monument_cards(after, limit))
+  except ValueError:
+    return handle_error("invalid page cursor", 400)
+
+  visited = await run_sync(visited_ids, get_user_id_from_session())
+  return render_template("monument/monuments.html", cards=cards, next=next, visited=[id for id in ids if id in visited])
+
+async def render_monument_cards(after, limit):
+  monuments, next = await fetch_cards(after, limit)
+  return render_template("monument/_cards.html", monuments=monuments), ([monument.id for monument in monuments], next)
+
+@async_views.route("/api/monuments")
+@replica_reads
+@login_required
+@conditional("monument", "media", vary=rated_fingerprint)
+async def api_monuments():
+  """List approved monuments as JSON"""
+  try:
+    monuments, next = await fetch_cards(request.args.get("after"), get_page_size())
+  except ValueError:
+    return jsonify(error="invalid page cursor"), 400
+
+  visited = await run_sync(visited_ids, get_user_id_from_session())
+  return jsonify(monuments=[card_to_dict(monument, monument.id in visited) for monument in monuments], next=next)
+
+@async_views.route("/api/monuments/search")
+@replica_reads
+@login_required
+@conditional("monument")
+async def api_monument_search():
+  """Full-text search over approved monuments as JSON"""
+  q = request.args.get("q", "").strip()
+  monuments = []
+  async with async_session() as session:
+    statement = search_statement(q, get_page_size(), is_sqlite(session.bind))
+    if statement is not None:
+      monuments = (await session.execute(statement)).all()
+  return jsonify(q=q, monuments=[result_to_dict(monument) for monument in monuments])
+
+@async_views.route("/api/monuments/top")
+@replica_reads
+@login_required
+@conditional("monument", vary=rating_epoch)
+async def api_monuments_top():
+  """Approved monuments with the best average grade as JSON"""
+  async with async_session() as session:
+    result = await session.execute(top_rated_statement(get_page_size(), request.args.get("min", 1, type=int)))
+    monuments = result.all()
+  return jsonify(monuments=[top_rated_to_dict(monument) for monument in monuments])
+
+@async_views.route("/monument/details/<id>")
+@login_required
+@conditional("monument", "agency", "state", "media", "recommendation", vary=rated_fingerprint)
+async def details_monument(id):
+  userid = get_user_id_from_session()
+  visited = id.isdigit() and int(id) in await run_sync(visited_ids, userid)
+  # Everything the page shows is joined in, nothing is lazy loaded once the session is closed
+  async with async_session() as session:
+    result = await session.execute(monument_details_statement(id, userid, visited))
+    monument, visit = details_row(result.first())
+
+  if not monument:
+    return handle_error("the specific monument does not exist", 400)
+
+  if visited and visit is None:
+    visit = queued_visit(userid, monument.id)
+
+  recommended = await run_sync(recommendations, monument.id)
+  return render_template("monument/details.html", monument=monument, isvisited=visit is not None, visit=visit, recommended=recommended)
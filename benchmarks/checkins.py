@@ -0,0 +1,97 @@
+"""
+Benchmark: check-ins per second with each VISIT_QUEUE mode.
+
+  python benchmarks/checkins.py [--database PATH | --scale 0.01] [--modes off,memory,log]
+                                [--seconds 5] [--concurrency 16] [--workers 2]
+
+"off" writes every check-in in its own transaction, the way visits were always
+written, "memory" and "log" queue them and write them in batches. Every mode gets
+its own copy of the dataset and serves it with gunicorn while --concurrency users
+post visits. Once the server has stopped, the visits in the database are counted
+against the check-ins that were acknowledged, none may be lost or doubled.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+
+from concurrent_reads import ROOT, load_app
+from serving import SETUPS, free_port, wait_until_up
+from dataset import generate
+from routes import sample, session_cookies, run_http, choice_list
+
+MODES = ["off", "memory", "log"]
+
+def count_visits(path):
+  import sqlite3
+  with sqlite3.connect(path) as conn:
+    return conn.execute("SELECT COUNT(*) FROM visit").fetchone()[0]
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--database", help="existing dataset.py database, copied so it is not modified")
+  parser.add_argument("--scale", type=float, default=0.01)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--modes", type=choice_list(MODES), default=",".join(MODES))
+  parser.add_argument("--seconds", type=float, default=5)
+  parser.add_argument("--concurrency", type=int, default=16)
+  parser.add_argument("--workers", type=int, default=2)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as directory:
+    dataset = os.path.join(directory, "dataset.db")
+    os.environ.update(
+      DATABASE_URL="sqlite:///" + dataset,
+      SECRET_KEY="benchmark",
+      MEDIA_FETCH_WORKERS="0",
+      VISIT_QUEUE="off",
+      WEB_CONCURRENCY=str(args.workers),
+      PYTHONPATH=ROOT,
+    )
+    if args.database:
+      shutil.copyfile(args.database, dataset)
+    app = load_app()
+    if not args.database:
+      print("dataset", generate(app, args.scale, args.seed, log=lambda message: None))
+    # One visiting user per connection
+    data = sample(app, args.seed, args.concurrency)
+    with app.app_context():
+      from models import db
+      # Closing the last connection checkpoints the WAL, so copies of the file are complete
+      db.engine.dispose()
+
+    print("%-8s %9s %8s %9s %9s %9s %9s" % ("mode", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms", "written"))
+    for mode in args.modes:
+      # A fresh database and session store, so every mode posts the same visits
+      path = os.path.join(directory, "%s.db" % mode)
+      shutil.copyfile(dataset, path)
+      sessions = os.path.join(directory, "%s-sessions.db" % mode)
+      cookies = session_cookies(sessions, data["writers"])
+      before = count_visits(path)
+
+      port = free_port()
+      env = dict(
+        os.environ, DATABASE_URL="sqlite:///" + path, DATABASE_AUTO_UPGRADE="0", SESSION_BACKEND="sqlite", SESSION_DB=sessions,
+        VISIT_QUEUE=mode, VISIT_QUEUE_DIR=os.path.join(directory, "%s-queue" % mode),
+      )
+      server = subprocess.Popen(
+        [part.format(port=port, workers=args.workers) for part in SETUPS["gunicorn"]],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+      )
+      try:
+        wait_until_up(port)
+        result = run_http(port, "visit", data, cookies, args.seconds, args.concurrency, args.seed)
+      finally:
+        # A graceful stop writes what is still queued
+        server.terminate()
+        server.wait()
+
+      written = count_visits(path) - before
+      print("%-8s %9.1f %8d %9.1f %9.1f %9.1f %9d%s" % (
+        mode, result["throughput"], result["errors"], result["p50"], result["p95"], result["p99"], written,
+        "" if written == result["requests"] else "  MISMATCH, %d acknowledged" % result["requests"],
+      ))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,130 @@
+"""
+Load test: throughput of the monument list API while visits are written concurrently.
+
+  python benchmarks/concurrent_reads.py [--seconds 10] [--readers 4] [--writers 2] [--modes DELETE,WAL]
+
+Each SQLite journal mode gets a fresh temporary database. Readers and writers are
+separate processes, like the workers of a deployment: readers page through
+/api/monuments while writers post visits.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MONUMENTS = 5000
+
+def load_app():
+  sys.path.insert(0, ROOT)
+  from app import create_app
+  return create_app()
+
+def seed(users):
+  app = load_app()
+  from models import Agency, State, Monument, User, db
+
+  with app.app_context(), db.engine.begin() as conn:
+    conn.execute(User.__table__.insert(), [dict(username="bench%d" % i, hash="x", isadmin=False, firstname="", lastname="") for i in range(users)])
+    conn.execute(State.__table__.insert(), [dict(name="State", createdby="1")])
+    conn.execute(Agency.__table__.insert(), [dict(name="Agency", department="Interior")])
+    conn.execute(Monument.__table__.insert(), [dict(
+      name="Monument %05d" % i, description="description " * 20, latitude=30 + i % 20, longitude=-120 + i % 40,
+      stateid=1, agencyid=1, imageurl="http://example.com/%d.jpg" % i, isapproved=True, isdeleted=False, createdby="1",
+    ) for i in range(MONUMENTS)])
+
+def client(app, userid):
+  c = app.test_client()
+  with c.session_transaction() as sess:
+    sess["user_id"] = userid
+  return c
+
+def read(c, deadline):
+  counts = dict(reads=0, read_errors=0)
+  after = None
+  while time.time() < deadline:
+    response = c.get("/api/monuments" + ("?after=" + after if after else ""))
+    if response.status_code != 200:
+      counts["read_errors"] += 1
+      continue
+    counts["reads"] += 1
+    after = response.get_json()["next"]
+  return counts
+
+def write(c, deadline):
+  counts = dict(writes=0, write_errors=0)
+  for monumentid in range(1, MONUMENTS + 1):
+    if time.time() >= deadline:
+      break
+    response = c.post("/monument/visit/%d" % monumentid, data=dict(grade=monumentid % 6 + 1, comment="bench"))
+    counts["writes" if response.status_code == 302 else "write_errors"] += 1
+  return counts
+
+def run(mode, args):
+  """Seed a database, run the readers and writers for args.seconds and return the summed counts."""
+  counts = dict(reads=0, writes=0, read_errors=0, write_errors=0)
+  with tempfile.TemporaryDirectory() as directory:
+    env = dict(
+      os.environ,
+      DATABASE_URL="sqlite:///" + os.path.join(directory, "bench.db"),
+      SQLITE_JOURNAL_MODE=mode,
+      SESSION_BACKEND="memory",
+    )
+
+    def start(role, userid):
+      return subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--worker", role, str(userid)],
+        env=env, cwd=directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+      )
+
+    start("seed", args.readers + args.writers).communicate()
+
+    processes = [start("read", i + 1) for i in range(args.readers)]
+    processes += [start("write", args.readers + i + 1) for i in range(args.writers)]
+
+    # Start the clock once every worker has imported the app and logged in
+    for process in processes:
+      process.stdout.readline()
+    deadline = time.time() + args.seconds
+    for process in processes:
+      process.stdin.write("%f\n" % deadline)
+      process.stdin.flush()
+    for process in processes:
+      output, _ = process.communicate()
+      for name, value in json.loads(output.strip().splitlines()[-1]).items():
+        counts[name] += value
+  return counts
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--seconds", type=float, default=10)
+  parser.add_argument("--readers", type=int, default=4)
+  parser.add_argument("--writers", type=int, default=2)
+  parser.add_argument("--modes", default="DELETE,WAL")
+  parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.worker:
+    role, userid = args.worker
+    if role == "seed":
+      seed(int(userid))
+      return
+    c = client(load_app(), int(userid))
+    print("ready", flush=True)
+    deadline = float(sys.stdin.readline())
+    print(json.dumps({"read": read, "write": write}[role](c, deadline)))
+    return
+
+  print("%-8s %10s %10s %12s %12s" % ("journal", "reads/s", "writes/s", "read errors", "write errors"))
+  for mode in args.modes.split(","):
+    counts = run(mode, args)
+    print("%-8s %10.1f %10.1f %12d %12d" % (
+      mode, counts["reads"] / args.seconds, counts["writes"] / args.seconds, counts["read_errors"], counts["write_errors"],
+    ))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,194 @@
+"""
+Generate a synthetic national monuments database of realistic volume.
+
+  python benchmarks/dataset.py PATH [--scale 1] [--seed 1]
+
+At scale 1 there are 50 states, 300 agencies, 100k monuments, 1M users and 10M
+visits; --scale multiplies everything but the states. The same seed always gives
+the same database. Every user's password is PASSWORD. The last tenth of the users
+have no visits yet, so benchmarks can post visits as them.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+from concurrent_reads import ROOT
+
+PASSWORD = "benchmark"
+
+# Volumes at scale 1
+VOLUMES = dict(agencies=300, monuments=100000, users=1000000, visits=10000000)
+
+# Rows inserted per statement batch
+CHUNK = 50000
+
+# (name, latitude, longitude) of the states monuments are spread around
+STATES = [
+  ("Alabama", 32.8, -86.8), ("Alaska", 64.7, -152.0), ("Arizona", 34.3, -111.7), ("Arkansas", 34.9, -92.4),
+  ("California", 37.2, -119.5), ("Colorado", 39.0, -105.5), ("Connecticut", 41.6, -72.7), ("Delaware", 39.0, -75.5),
+  ("Florida", 28.6, -82.4), ("Georgia", 32.7, -83.4), ("Hawaii", 20.3, -156.4), ("Idaho", 44.4, -114.6),
+  ("Illinois", 40.0, -89.2), ("Indiana", 39.9, -86.3), ("Iowa", 42.1, -93.5), ("Kansas", 38.5, -98.4),
+  ("Kentucky", 37.5, -85.3), ("Louisiana", 31.1, -92.0), ("Maine", 45.4, -69.2), ("Maryland", 39.1, -76.8),
+  ("Massachusetts", 42.3, -71.8), ("Michigan", 44.3, -85.4), ("Minnesota", 46.3, -94.3), ("Mississippi", 32.7, -89.7),
+  ("Missouri", 38.4, -92.5), ("Montana", 47.0, -109.6), ("Nebraska", 41.5, -99.8), ("Nevada", 39.3, -116.6),
+  ("New Hampshire", 43.7, -71.6), ("New Jersey", 40.2, -74.7), ("New Mexico", 34.4, -106.1), ("New York", 42.9, -75.5),
+  ("North Carolina", 35.6, -79.4), ("North Dakota", 47.5, -100.5), ("Ohio", 40.3, -82.8), ("Oklahoma", 35.6, -97.5),
+  ("Oregon", 43.9, -120.6), ("Pennsylvania", 40.9, -77.8), ("Rhode Island", 41.7, -71.5), ("South Carolina", 33.9, -80.9),
+  ("South Dakota", 44.4, -100.2), ("Tennessee", 35.9, -86.4), ("Texas", 31.5, -99.3), ("Utah", 39.3, -111.7),
+  ("Vermont", 44.1, -72.7), ("Virginia", 37.5, -78.9), ("Washington", 47.4, -120.5), ("West Virginia", 38.6, -80.6),
+  ("Wisconsin", 44.6, -89.9), ("Wyoming", 43.0, -107.6),
+]
+
+DEPARTMENTS = ["Interior", "Agriculture", "Defense", "Commerce", "Energy"]
+AGENCY_KINDS = ["Service", "Bureau", "Office", "Administration", "Commission", "Survey"]
+ADJECTIVES = [
+  "Red", "Painted", "Hidden", "Granite", "Golden", "Silver", "Ancient", "Broken", "Lost", "Great", "Little", "Shining",
+  "Black", "White", "Twin", "Crystal", "Sandstone", "Petrified", "Thunder", "Eagle", "Buffalo", "Cedar", "Pine", "Copper",
+]
+NOUNS = [
+  "Canyon", "Mesa", "Butte", "Cliffs", "Rock", "Springs", "Lake", "Caves", "Arch", "Ridge", "Valley", "Falls", "Dunes",
+  "Forest", "Island", "Peak", "Fort", "Ruins", "Pueblo", "Crater", "Bluffs", "Basin", "Trail", "Lighthouse", "Battlefield",
+]
+WORDS = (
+  "the monument protects a landscape of deep canyons and high plateaus shaped by wind and water over millions of years "
+  "ancestral people left dwellings rock art and tools that tell of centuries of life in the region visitors can hike "
+  "trails to overlooks camp under dark skies and watch for wildlife such as elk bighorn sheep and golden eagles the site "
+  "was proclaimed under the antiquities act to preserve its geology ecology and cultural history for future generations"
+).split()
+COMMENTS = ["Beautiful views.", "Worth the drive!", "Crowded in summer.", "Bring water.", "Loved the ranger talk.", "Quiet and remote.", ""]
+
+def sentence(rng, words):
+  return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def monument_names(rng, count):
+  """Yield count unique monument names, numbered once the word combinations run out."""
+  seen = set()
+  kinds = ["National Monument", "National Historic Site", "National Memorial", "National Preserve"]
+  while len(seen) < count:
+    name = "%s %s %s" % (rng.choice(ADJECTIVES), rng.choice(NOUNS), rng.choice(kinds))
+    if name in seen:
+      name = "%s %d" % (name, len(seen))
+    seen.add(name)
+    yield name
+
+def chunks(rows, size=CHUNK):
+  chunk = []
+  for row in rows:
+    chunk.append(row)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def generate(app, scale=1.0, seed=1, log=print):
+  """Fill the (empty) database of app with the synthetic dataset and return the row counts."""
+  from models import Agency, State, Monument, User, Visit, db
+  from passwords import get_hasher
+  from search import rebuild_search_index
+  from geo import rebuild_geo_index
+  from ratings import recompute_ratings, GRADES
+  from httpcache import bump
+
+  rng = random.Random(seed)
+  volumes = dict((name, max(1, int(volume * scale))) for name, volume in VOLUMES.items())
+  counts = dict(states=len(STATES))
+
+  with app.app_context():
+    password_hash = get_hasher().hash(PASSWORD)
+    with db.engine.begin() as conn:
+      started = time.time()
+      conn.execute(State.__table__.insert(), [dict(id=i + 1, name=name, createdby="1") for i, (name, _, _) in enumerate(STATES)])
+      conn.execute(Agency.__table__.insert(), [dict(
+        id=i + 1, name="%s %s %s %d" % (rng.choice(ADJECTIVES), rng.choice(NOUNS), rng.choice(AGENCY_KINDS), i + 1), department=rng.choice(DEPARTMENTS),
+      ) for i in range(volumes["agencies"])])
+      counts["agencies"] = volumes["agencies"]
+
+      def monuments():
+        for i, name in enumerate(monument_names(rng, volumes["monuments"])):
+          stateid = rng.randrange(len(STATES)) + 1
+          _, latitude, longitude = STATES[stateid - 1]
+          status = rng.random()
+          yield dict(
+            id=i + 1, name=name, description=" ".join(sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(3, 12))),
+            latitude=round(latitude + rng.uniform(-2, 2), 6), longitude=round(longitude + rng.uniform(-3, 3), 6),
+            agencyid=rng.randrange(volumes["agencies"]) + 1, stateid=stateid,
+            dateestablished=date(1906, 6, 8) + timedelta(days=rng.randrange(42000)), acres=int(rng.lognormvariate(8, 2)) + 1,
+            imageurl="https://images.example.com/monuments/%d.jpg" % (i + 1),
+            # Most monuments are approved, a few wait for approval or were declined
+            isapproved=status < 0.98, isdeleted=status >= 0.99, createdby="1",
+          )
+      for chunk in chunks(monuments()):
+        conn.execute(Monument.__table__.insert(), chunk)
+      counts["monuments"] = volumes["monuments"]
+      log("monuments %.1fs" % (time.time() - started))
+
+      def users():
+        for i in range(volumes["users"]):
+          yield dict(id=i + 1, username="user%07d" % (i + 1), hash=password_hash, isadmin=i == 0, firstname="First%d" % i, lastname="Last%d" % i)
+      for chunk in chunks(users()):
+        conn.execute(User.__table__.insert(), chunk)
+      counts["users"] = volumes["users"]
+      log("users %.1fs" % (time.time() - started))
+
+      # Visits favour popular monuments (Zipf) and the last tenth of the users has none
+      visitors = max(1, volumes["users"] * 9 // 10)
+      popularity = list(range(1, volumes["monuments"] + 1))
+      rng.shuffle(popularity)
+      cumulative = []
+      total = 0.0
+      for rank in range(len(popularity)):
+        total += 1.0 / (rank + 1)
+        cumulative.append(total)
+      mean = volumes["visits"] / visitors
+      today = date.today()
+
+      def visits():
+        remaining = volumes["visits"]
+        for userid in range(1, visitors + 1):
+          if remaining <= 0:
+            return
+          wanted = min(remaining, len(popularity) // 2, max(1, round(rng.expovariate(1 / mean))) if userid < visitors else remaining)
+          chosen = set()
+          while len(chosen) < wanted:
+            chosen.update(rng.choices(popularity, cum_weights=cumulative, k=wanted - len(chosen)))
+          remaining -= len(chosen)
+          for monumentid in chosen:
+            yield dict(
+              userid=userid, monumentid=monumentid, visitedon=today - timedelta(days=rng.randrange(3650)),
+              grade=rng.choices(GRADES, weights=(1, 2, 4, 8, 10, 6))[0], comment=rng.choice(COMMENTS),
+            )
+      counts["visits"] = 0
+      for chunk in chunks(visits()):
+        conn.execute(Visit.__table__.insert(), chunk)
+        counts["visits"] += len(chunk)
+      log("visits %.1fs" % (time.time() - started))
+
+      # Bulk inserts bypass the ORM events that keep these up to date
+      rebuild_search_index(conn)
+      rebuild_geo_index(conn)
+      recompute_ratings(conn)
+      bump(conn, "agency", "state", "monument", "visit")
+      log("indexes %.1fs" % (time.time() - started))
+  return counts
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("path", help="SQLite file to create")
+  parser.add_argument("--scale", type=float, default=1.0)
+  parser.add_argument("--seed", type=int, default=1)
+  args = parser.parse_args()
+
+  if os.path.exists(args.path):
+    sys.exit("%s already exists" % args.path)
+  os.environ["DATABASE_URL"] = "sqlite:///" + os.path.abspath(args.path)
+  os.environ.setdefault("MEDIA_FETCH_WORKERS", "0")
+  sys.path.insert(0, ROOT)
+  from app import create_app
+  print(generate(create_app(), args.scale, args.seed))
+
+if __name__ == "__main__":
+  main()
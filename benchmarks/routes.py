@@ -0,0 +1,278 @@
+"""
+Benchmark: latency percentiles and throughput of the key routes on the synthetic dataset.
+
+  python benchmarks/routes.py [--database PATH | --scale 0.01] [--drivers client,http] [--routes index,monuments,...]
+                              [--seconds 5] [--concurrency 8] [--workers 2] [--save FILE] [--baseline FILE] [--tolerance 0.15]
+
+The client driver calls the app in process through the Flask test client, one
+request at a time, so it measures the app alone. The http driver starts gunicorn
+and keeps --concurrency keep-alive connections busy. Without --database a dataset
+of --scale is generated into a temporary directory (see dataset.py).
+
+--save writes the results as JSON. --baseline compares them with a saved run of
+the same machine and exits with status 1 if a route got slower than the tolerance
+at p95 or lost as much throughput.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from concurrent_reads import ROOT, load_app
+from serving import SETUPS, free_port, wait_until_up, percentile
+from dataset import PASSWORD, generate
+
+ROUTES = ["index", "monuments", "details", "visited", "visit", "login"]
+DRIVERS = ["client", "http"]
+
+def choice_list(choices):
+  """argparse type of a comma separated list of some of choices."""
+  def parse(value):
+    items = value.split(",")
+    unknown = [item for item in items if item not in choices]
+    if unknown:
+      raise argparse.ArgumentTypeError("unknown %s, choose from %s" % (", ".join(unknown), ", ".join(choices)))
+    return items
+  return parse
+
+def sample(app, seed, writers):
+  """Pick the monuments, cursors and users the requests use, the same ones for the same database and seed."""
+  from sqlalchemy import text
+  from models import db
+  from queries import encode_cursor
+
+  rng = random.Random(seed)
+  with app.app_context(), db.engine.connect() as conn:
+    monuments = conn.execute(text("SELECT id, name FROM monument WHERE isdeleted = 0 AND isapproved = 1 ORDER BY id")).all()
+    readers = [row[0] for row in conn.execute(text("SELECT DISTINCT userid FROM visit ORDER BY userid LIMIT 1000"))]
+    # Users without visits post the visits, each to every monument in turn
+    idle = [row[0] for row in conn.execute(text(
+      "SELECT id FROM user WHERE NOT EXISTS (SELECT 1 FROM visit WHERE visit.userid = user.id) ORDER BY id DESC LIMIT :limit"
+    ), dict(limit=writers))]
+    login = conn.execute(text("SELECT username FROM user ORDER BY id DESC LIMIT 1")).scalar()
+  if len(idle) < writers:
+    raise RuntimeError("the dataset needs %d users without visits" % writers)
+
+  picked = rng.sample(monuments, min(1000, len(monuments)))
+  return dict(
+    monuments=[id for id, _ in picked],
+    cursors=[encode_cursor(name, id) for id, name in picked],
+    readers=readers,
+    writers=idle,
+    visit_targets=[id for id, _ in monuments],
+    login=login,
+  )
+
+def make_request(route, worker, i, rng, data):
+  """Return (method, path, form, userid) of the i-th request of a worker."""
+  if route == "index":
+    return "GET", "/", None, None
+  if route == "monuments":
+    # A quarter of the views are of the first page, the others scroll further
+    after = None if i % 4 == 0 else rng.choice(data["cursors"])
+    return "GET", "/monuments" + ("?after=" + after if after else ""), None, data["readers"][0]
+  if route == "details":
+    return "GET", "/monument/details/%d" % rng.choice(data["monuments"]), None, rng.choice(data["readers"])
+  if route == "visited":
+    return "GET", "/monument/visited", None, rng.choice(data["readers"])
+  if route == "visit":
+    targets = data["visit_targets"]
+    return "POST", "/monument/visit/%d" % targets[i % len(targets)], dict(grade=i % 6 + 1, comment="benchmark"), data["writers"][worker]
+  if route == "login":
+    return "POST", "/login", dict(username=data["login"], password=PASSWORD), None
+  raise ValueError("unknown route %r" % route)
+
+def session_cookies(path, userids):
+  """Store a session for each user in the shared session database and return their cookies by user id."""
+  from sessions import SQLiteSessionStore, serializer
+  store = SQLiteSessionStore(path)
+  cookies = {}
+  for userid in set(userids):
+    store.set("benchmark-%d" % userid, serializer.dumps({"user_id": userid}), time.time() + 86400)
+    cookies[userid] = "session=benchmark-%d" % userid
+  return cookies
+
+def summarize(latencies, errors, seconds):
+  latencies.sort()
+  return dict(
+    requests=len(latencies), errors=errors, throughput=len(latencies) / seconds,
+    p50=percentile(latencies, 0.5) * 1000, p95=percentile(latencies, 0.95) * 1000, p99=percentile(latencies, 0.99) * 1000,
+  )
+
+def run_client(app, route, data, cookies, seconds, seed, worker):
+  """Drive one route through the test client for seconds, after one warm-up request."""
+  client = app.test_client()
+  rng = random.Random(seed)
+  latencies = []
+  errors = 0
+  i = 0
+  deadline = None
+  while deadline is None or time.time() < deadline:
+    method, path, form, userid = make_request(route, worker, i, rng, data)
+    headers = {"Cookie": cookies[userid]} if userid else {}
+    start = time.perf_counter()
+    response = client.open(path, method=method, data=form, headers=headers)
+    elapsed = time.perf_counter() - start
+    i += 1
+    if deadline is None:
+      deadline = time.time() + seconds
+      continue
+    if response.status_code in (200, 302):
+      latencies.append(elapsed)
+    else:
+      errors += 1
+  return summarize(latencies, errors, seconds)
+
+def run_http(port, route, data, cookies, seconds, concurrency, seed):
+  """Drive one route with concurrency keep-alive connections for seconds."""
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+  deadline = time.time() + seconds
+
+  def worker(index):
+    rng = random.Random(seed + index)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    mine = []
+    failed = 0
+    i = 0
+    while time.time() < deadline:
+      method, path, form, userid = make_request(route, index, i, rng, data)
+      i += 1
+      headers = {"Cookie": cookies[userid]} if userid else {}
+      body = None
+      if form:
+        body = urllib.parse.urlencode(form)
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+      start = time.perf_counter()
+      try:
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        ok = response.status in (200, 302)
+      except (OSError, http.client.HTTPException):
+        conn.close()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        ok = False
+      if ok:
+        mine.append(time.perf_counter() - start)
+      else:
+        failed += 1
+    with lock:
+      latencies.extend(mine)
+      errors[0] += failed
+
+  threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return summarize(latencies, errors[0], seconds)
+
+def compare(results, baseline, tolerance):
+  """Print the change of every route against the baseline and return the regressed ones."""
+  regressions = []
+  print("\n%-20s %12s %12s %12s" % ("vs baseline", "req/s", "p95", "p99"))
+  for key, result in sorted(results.items()):
+    before = baseline.get(key)
+    if not before or not before["throughput"] or not before["p95"]:
+      continue
+    throughput = result["throughput"] / before["throughput"] - 1
+    p95 = result["p95"] / before["p95"] - 1
+    p99 = result["p99"] / before["p99"] - 1 if before["p99"] else 0
+    regressed = p95 > tolerance or throughput < -tolerance
+    print("%-20s %+11.1f%% %+11.1f%% %+11.1f%%%s" % (key, throughput * 100, p95 * 100, p99 * 100, "  REGRESSION" if regressed else ""))
+    if regressed:
+      regressions.append(key)
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--database", help="existing dataset.py database, copied so it is not modified")
+  parser.add_argument("--scale", type=float, default=0.01)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--drivers", type=choice_list(DRIVERS), default=",".join(DRIVERS))
+  parser.add_argument("--routes", type=choice_list(ROUTES), default=",".join(ROUTES))
+  parser.add_argument("--seconds", type=float, default=5)
+  parser.add_argument("--concurrency", type=int, default=8)
+  parser.add_argument("--workers", type=int, default=2)
+  parser.add_argument("--save")
+  parser.add_argument("--baseline")
+  parser.add_argument("--tolerance", type=float, default=0.15)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "bench.db")
+    env = dict(
+      DATABASE_URL="sqlite:///" + path,
+      SESSION_BACKEND="sqlite",
+      SESSION_DB=os.path.join(directory, "sessions.db"),
+      SECRET_KEY="benchmark",
+      MEDIA_FETCH_WORKERS="0",
+      # Logins all come from one address as one user
+      LOGIN_IP_LIMIT="1000000000",
+      LOGIN_USER_LIMIT="1000000000",
+      WEB_CONCURRENCY=str(args.workers),
+      PYTHONPATH=ROOT,
+    )
+    os.environ.update(env)
+    if args.database:
+      shutil.copyfile(args.database, path)
+    app = load_app()
+    if not args.database:
+      print("dataset", generate(app, args.scale, args.seed, log=lambda message: None))
+
+    routes = args.routes
+    # One visiting user per http connection and one for the client driver
+    data = sample(app, args.seed, args.concurrency + 1)
+    cookies = session_cookies(env["SESSION_DB"], data["readers"] + data["writers"])
+
+    results = {}
+    print("%-20s %9s %8s %9s %9s %9s" % ("route", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms"))
+    for driver in args.drivers:
+      server = None
+      if driver == "http":
+        port = free_port()
+        server = subprocess.Popen(
+          [part.format(port=port, workers=args.workers) for part in SETUPS["gunicorn"]],
+          cwd=ROOT, env=dict(os.environ, DATABASE_AUTO_UPGRADE="0"), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+      try:
+        if server:
+          wait_until_up(port)
+        for route in routes:
+          if driver == "client":
+            result = run_client(app, route, data, cookies, args.seconds, args.seed, args.concurrency)
+          elif driver == "http":
+            result = run_http(port, route, data, cookies, args.seconds, args.concurrency, args.seed)
+          key = "%s/%s" % (driver, route)
+          results[key] = result
+          print("%-20s %9.1f %8d %9.1f %9.1f %9.1f" % (key, result["throughput"], result["errors"], result["p50"], result["p95"], result["p99"]))
+      finally:
+        if server:
+          server.terminate()
+          server.wait()
+
+  if args.save:
+    with open(args.save, "w") as file:
+      json.dump(dict(
+        scale=args.scale if not args.database else None, seed=args.seed, seconds=args.seconds,
+        concurrency=args.concurrency, workers=args.workers, cpus=os.cpu_count(), results=results,
+      ), file, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as file:
+      regressions = compare(results, json.load(file)["results"], args.tolerance)
+    if regressions:
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,138 @@
+"""
+Benchmark: requests per second of the read-heavy routes under each way of serving the app.
+
+  python benchmarks/serving.py [--seconds 10] [--concurrency 16] [--workers 4] [--setups dev,gunicorn,uvicorn,uvicorn-async]
+
+dev is the Werkzeug development server "python app.py" starts, gunicorn runs
+gunicorn.conf.py, uvicorn serves asgi.py and uvicorn-async does the same with
+ASYNC_VIEWS=1. All of them serve the same seeded database as a logged in user.
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent_reads import ROOT, seed
+
+PATHS = ["/api/monuments", "/monuments", "/monument/details/1", "/api/monuments/top"]
+
+SETUPS = {
+  "dev": [sys.executable, "-c", "from app import create_app; create_app().run(port={port})"],
+  "gunicorn": [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", "127.0.0.1:{port}", "wsgi:app"],
+  "uvicorn": [sys.executable, "-m", "uvicorn", "asgi:app", "--port", "{port}", "--workers", "{workers}", "--no-access-log"],
+  "uvicorn-async": [sys.executable, "-m", "uvicorn", "asgi:app", "--port", "{port}", "--workers", "{workers}", "--no-access-log"],
+}
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+def wait_until_up(port, timeout=30):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    try:
+      conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+      conn.request("GET", "/")
+      conn.getresponse().read()
+      return
+    except OSError:
+      time.sleep(0.2)
+  raise RuntimeError("server on port %d did not start" % port)
+
+def login_cookie(env):
+  """Store a session of user 1 in the shared session database and return its cookie."""
+  sys.path.insert(0, ROOT)
+  from sessions import SQLiteSessionStore, serializer
+  SQLiteSessionStore(env["SESSION_DB"]).set("benchmark", serializer.dumps({"user_id": 1}), time.time() + 86400)
+  return "session=benchmark"
+
+def load(port, cookie, seconds, concurrency):
+  """Request PATHS round robin from concurrency keep-alive connections, return (requests, errors, latencies)."""
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+  deadline = time.time() + seconds
+
+  def client(offset):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    mine = []
+    i = offset
+    while time.time() < deadline:
+      path = PATHS[i % len(PATHS)]
+      i += 1
+      start = time.perf_counter()
+      try:
+        conn.request("GET", path, headers={"Cookie": cookie})
+        response = conn.getresponse()
+        response.read()
+        ok = response.status == 200
+      except (OSError, http.client.HTTPException):
+        conn.close()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        ok = False
+      if ok:
+        mine.append(time.perf_counter() - start)
+      else:
+        with lock:
+          errors[0] += 1
+    with lock:
+      latencies.extend(mine)
+
+  threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return len(latencies), errors[0], sorted(latencies)
+
+def percentile(values, p):
+  return values[min(int(len(values) * p), len(values) - 1)] if values else 0.0
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument("--seconds", type=float, default=10)
+  parser.add_argument("--concurrency", type=int, default=16)
+  parser.add_argument("--workers", type=int, default=4)
+  parser.add_argument("--setups", default=",".join(SETUPS))
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as directory:
+    env = dict(
+      os.environ,
+      DATABASE_URL="sqlite:///" + os.path.join(directory, "bench.db"),
+      SESSION_BACKEND="sqlite",
+      SESSION_DB=os.path.join(directory, "sessions.db"),
+      SECRET_KEY="benchmark",
+      WEB_CONCURRENCY=str(args.workers),
+      PYTHONPATH=ROOT,
+    )
+    os.environ.update(env)
+    seed(2)
+    cookie = login_cookie(env)
+
+    print("%-14s %10s %8s %10s %10s" % ("setup", "req/s", "errors", "p50 ms", "p95 ms"))
+    for name in args.setups.split(","):
+      port = free_port()
+      command = [part.format(port=port, workers=args.workers) for part in SETUPS[name]]
+      server = subprocess.Popen(
+        command, cwd=ROOT, env=dict(env, ASYNC_VIEWS="1" if name.endswith("-async") else "0", DATABASE_AUTO_UPGRADE="0"),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+      )
+      try:
+        wait_until_up(port)
+        count, errors, latencies = load(port, cookie, args.seconds, args.concurrency)
+      finally:
+        server.terminate()
+        server.wait()
+      print("%-14s %10.1f %8d %10.1f %10.1f" % (
+        name, count / args.seconds, errors, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+      ))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,168 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from sqlalchemy import select, Boolean, Integer, Numeric, Date
+
+from models import Agency, State, Monument, Visit, db
+
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+FORMATS = ["csv", "jsonl"] + (["parquet"] if pyarrow else [])
+KINDS = ["monument", "state", "agency", "visit"]
+
+CONTENT_TYPES = {
+  "csv": "text/csv",
+  "jsonl": "application/x-ndjson",
+  "parquet": "application/vnd.apache.parquet",
+}
+
+# Rows fetched from the server side cursor at a time
+CHUNK_SIZE = 1000
+
+def export_statement(kind, userid=None):
+  """Return the select statement of an export, visits need the user whose history is exported."""
+  if kind == "monument":
+    return select(
+      Monument.id, Monument.name, Monument.description, Monument.latitude, Monument.longitude,
+      State.name.label("state"), Agency.name.label("agency"),
+      Monument.dateestablished, Monument.acres, Monument.imageurl,
+    ).join(State, State.id == Monument.stateid) \
+      .join(Agency, Agency.id == Monument.agencyid) \
+      .where(Monument.isdeleted == 0, Monument.isapproved == 1) \
+      .order_by(Monument.id)
+  if kind == "state":
+    return select(State.id, State.name).where(State.isdeleted == 0).order_by(State.id)
+  if kind == "agency":
+    return select(Agency.id, Agency.name, Agency.department).order_by(Agency.id)
+  if kind == "visit":
+    return select(Visit.monumentid, Monument.name.label("monument"), Visit.visitedon, Visit.grade, Visit.comment) \
+      .join(Monument, Monument.id == Visit.monumentid) \
+      .where(Visit.userid == userid) \
+      .order_by(Visit.visitedon, Visit.monumentid)
+  raise ValueError("unsupported kind %r" % kind)
+
+def export_rows(statement):
+  """Yield (columns, row chunk) pairs, streaming the result from a server side cursor."""
+  with db.engine.connect() as conn:
+    result = conn.execution_options(stream_results=True, yield_per=CHUNK_SIZE).execute(statement)
+    columns = list(result.keys())
+    empty = True
+    for chunk in result.partitions():
+      empty = False
+      yield columns, chunk
+    # Still yield the columns so an empty export gets its csv header or parquet schema
+    if empty:
+      yield columns, []
+
+def to_json_value(value):
+  if isinstance(value, (date, datetime)):
+    return value.isoformat()
+  if isinstance(value, Decimal):
+    return float(value)
+  return value
+
+def encode_csv(chunks):
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  header = True
+  for columns, chunk in chunks:
+    if header:
+      writer.writerow(columns)
+      header = False
+    writer.writerows(chunk)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+def encode_jsonl(chunks):
+  for columns, chunk in chunks:
+    yield "".join(json.dumps(dict(zip(columns, map(to_json_value, row)))) + "\n" for row in chunk)
+
+class ChunkSink:
+  """Write-only file object that hands written bytes out in pieces while keeping the file position."""
+
+  def __init__(self):
+    self.chunks = []
+    self.position = 0
+    self.closed = False
+
+  def write(self, data):
+    self.chunks.append(bytes(data))
+    self.position += len(data)
+    return len(data)
+
+  def tell(self):
+    return self.position
+
+  def flush(self):
+    pass
+
+  def close(self):
+    self.closed = True
+
+  def take(self):
+    data = b"".join(self.chunks)
+    self.chunks = []
+    return data
+
+def arrow_schema(statement):
+  """Map the column types of a statement to a parquet schema, so every row group has the same types."""
+  fields = []
+  for column in statement.selected_columns:
+    if isinstance(column.type, Boolean):
+      type = pyarrow.bool_()
+    elif isinstance(column.type, Integer):
+      type = pyarrow.int64()
+    elif isinstance(column.type, Numeric):
+      type = pyarrow.float64()
+    elif isinstance(column.type, Date):
+      type = pyarrow.date32()
+    else:
+      type = pyarrow.string()
+    fields.append(pyarrow.field(column.name, type))
+  return pyarrow.schema(fields)
+
+def to_arrow_value(value, type):
+  """Coerce loosely typed SQLite values to the column type, values that do not fit become null."""
+  if value is None:
+    return None
+  try:
+    if pyarrow.types.is_integer(type):
+      return int(value)
+    if pyarrow.types.is_floating(type):
+      return float(value)
+  except (TypeError, ValueError):
+    return None
+  if pyarrow.types.is_string(type):
+    return str(value)
+  return value
+
+def encode_parquet(chunks, schema):
+  """Write one parquet row group per chunk, yielding the bytes written so far."""
+  sink = ChunkSink()
+  writer = pyarrow.parquet.ParquetWriter(sink, schema)
+  for columns, chunk in chunks:
+    data = dict((field.name, [to_arrow_value(row[i], field.type) for row in chunk]) for i, field in enumerate(schema))
+    writer.write_table(pyarrow.Table.from_pydict(data, schema=schema))
+    yield sink.take()
+  writer.close()
+  yield sink.take()
+
+def export(kind, format, userid=None):
+  """Yield the encoded export chunk by chunk, never holding more than one chunk of rows."""
+  if format not in FORMATS:
+    raise ValueError("unsupported format %r" % format)
+
+  statement = export_statement(kind, userid)
+  chunks = export_rows(statement)
+  if format == "parquet":
+    return encode_parquet(chunks, arrow_schema(statement))
+  if format == "csv":
+    return encode_csv(chunks)
+  return encode_jsonl(chunks)
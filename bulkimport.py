@@ -0,0 +1,194 @@
+import csv
+import json
+from itertools import islice
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import MultiDict
+
+from models import Agency, State, Monument, db
+from validators import AgencyForm, StateForm, MonumentForm
+from search import index_monument_ids
+from geo import index_location_ids
+from httpcache import bump
+from dashboard import invalidate_stats
+from fragments import invalidate_fragments
+
+FORMATS = ["csv", "jsonl"]
+KINDS = ["agency", "state", "monument"]
+
+# Errors kept for the report, later ones are only counted
+MAX_REPORTED_ERRORS = 1000
+
+class ImportReport:
+  """Outcome of an import: inserted and rejected row counts and the first errors."""
+
+  def __init__(self):
+    self.inserted = 0
+    self.rejected = 0
+    self.errors = []
+
+  def reject(self, line, message):
+    self.rejected += 1
+    if len(self.errors) < MAX_REPORTED_ERRORS:
+      self.errors.append(dict(line=line, error=message))
+
+  def to_dict(self):
+    return dict(inserted=self.inserted, rejected=self.rejected, errors=self.errors)
+
+def read_rows(stream, format):
+  """Yield (line number, row dict) from a CSV (with header) or JSON Lines text stream."""
+  if format == "csv":
+    reader = csv.DictReader(stream)
+    for row in reader:
+      yield reader.line_num, row
+  elif format == "jsonl":
+    for line, text in enumerate(stream, 1):
+      if text.strip():
+        try:
+          row = json.loads(text)
+        except ValueError:
+          row = None
+        yield line, row
+  else:
+    raise ValueError("unsupported format %r" % format)
+
+def form_errors(form):
+  return "; ".join("%s: %s" % (field, ", ".join(errors)) for field, errors in form.errors.items())
+
+def formdata(row):
+  """Turn a parsed row into form data, the same shape a submitted form has."""
+  return MultiDict((key, "" if value is None else str(value)) for key, value in row.items())
+
+class Importer:
+  """Validate rows of one kind with the same form rules as the create pages and build insert parameters."""
+
+  def __init__(self, kind, createdby, approve=False):
+    self.kind = kind
+    self.createdby = str(createdby)
+    self.approve = approve
+    self.model = {"agency": Agency, "state": State, "monument": Monument}[kind]
+
+    # One form is reprocessed for every row, binding its fields per row costs more than validating
+    self.form = {"agency": AgencyForm, "state": StateForm, "monument": MonumentForm}[kind]()
+
+    # Names already taken, extended with every accepted row
+    self.names = set(name for name, in db.session.query(self.model.name))
+
+    if kind == "monument":
+      self.states = dict((name, id) for id, name in db.session.query(State.id, State.name).filter(State.isdeleted == 0))
+      self.agencies = dict((name, id) for id, name in db.session.query(Agency.id, Agency.name))
+
+  def validate(self, row):
+    """Return (insert parameters, None) for a valid row or (None, error message)."""
+    if not isinstance(row, dict):
+      return None, "row is not an object"
+
+    data = formdata(row)
+    form = self.form
+    form.process(data)
+    if not form.validate():
+      return None, form_errors(form)
+
+    name = form.name.data
+    if name in self.names:
+      return None, "%s with the specific name already exists" % self.kind
+
+    if self.kind == "agency":
+      values = dict(name=name, department=form.department.data)
+    elif self.kind == "state":
+      values = dict(name=name, createdby=self.createdby)
+    else:
+      stateid = self.states.get(data.get("state"))
+      agencyid = self.agencies.get(data.get("agency"))
+      if stateid is None:
+        return None, "unknown state %r" % data.get("state")
+      if agencyid is None:
+        return None, "unknown agency %r" % data.get("agency")
+      values = dict(
+        name=name,
+        description=form.description.data,
+        latitude=form.latitude.data,
+        longitude=form.longitude.data,
+        imageurl=form.imageurl.data,
+        dateestablished=form.dateestablished.data,
+        acres=form.acres.data,
+        stateid=stateid,
+        agencyid=agencyid,
+        isapproved=1 if self.approve else 0,
+        createdby=self.createdby,
+      )
+
+    self.names.add(name)
+    return values, None
+
+  def conflict(self, values, error):
+    """Return the error message of a valid row the database refused."""
+    with db.engine.connect() as conn:
+      taken = conn.execute(select(self.model.id).where(self.model.name == values["name"])).first()
+    if taken:
+      return "%s with the specific name already exists" % self.kind
+    return "rejected by the database: %s" % error.orig
+
+def valid_rows(importer, rows, report):
+  """Yield (line number, insert parameters) of valid rows, recording the others in the report."""
+  for line, row in rows:
+    values, error = importer.validate(row)
+    if error:
+      report.reject(line, error)
+    else:
+      yield line, values
+
+def batches(iterable, size):
+  iterator = iter(iterable)
+  while True:
+    batch = list(islice(iterator, size))
+    if not batch:
+      return
+    yield batch
+
+def insert_rows(conn, kind, table, rows):
+  """Insert rows of one kind in a single executemany together with their index entries."""
+  conn.execute(table.insert(), rows)
+  if kind == "monument":
+    # Core inserts bypass the mapper events that keep the search and spatial indexes in sync
+    ids = [id for id, in conn.execute(
+      select(Monument.id).where(Monument.name.in_([values["name"] for values in rows]))
+    )]
+    index_monument_ids(conn, ids)
+    index_location_ids(conn, ids)
+  bump(conn, kind)
+
+def import_rows(kind, rows, createdby, approve=False, batchsize=1000):
+  """
+  Stream (line, row) pairs into the database and return an ImportReport.
+
+  Rows are validated one at a time and inserted in executemany batches, each in its
+  own transaction, so memory use does not grow with the size of the input. A batch
+  the database refuses is retried row by row and the refused rows are reported.
+  """
+  if kind not in KINDS:
+    raise ValueError("unsupported kind %r" % kind)
+
+  report = ImportReport()
+  importer = Importer(kind, createdby, approve)
+  table = importer.model.__table__
+
+  for batch in batches(valid_rows(importer, rows, report), batchsize):
+    try:
+      with db.engine.begin() as conn:
+        insert_rows(conn, kind, table, [values for line, values in batch])
+      report.inserted += len(batch)
+    except IntegrityError:
+      # A row clashes with one written since the importer loaded the names, e.g. by a
+      # concurrent import; retry the batch row by row so only the clashing rows are lost
+      for line, values in batch:
+        try:
+          with db.engine.begin() as conn:
+            insert_rows(conn, kind, table, [values])
+          report.inserted += 1
+        except IntegrityError as error:
+          report.reject(line, importer.conflict(values, error))
+
+  invalidate_stats()
+  invalidate_fragments("agencies", "states", "monuments")
+  return report
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+  """Small thread-safe in-process cache whose entries expire after ttl seconds."""
+
+  def __init__(self, ttl=30, maxsize=1024):
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self._data = {}
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is None:
+        return default
+      value, expires = entry
+      if expires < time.monotonic():
+        del self._data[key]
+        return default
+      return value
+
+  def set(self, key, value):
+    with self._lock:
+      # Drop the oldest entry instead of growing without bound
+      if key not in self._data and len(self._data) >= self.maxsize:
+        self._data.pop(next(iter(self._data)))
+      self._data[key] = (value, time.monotonic() + self.ttl)
+
+  def pop(self, key):
+    with self._lock:
+      self._data.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+class LRUCache:
+  """Thread-safe least recently used cache bounded by the total size of its values."""
+
+  def __init__(self, maxbytes=32 * 1024 * 1024):
+    self.maxbytes = maxbytes
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      self.hits += 1
+      self._data.move_to_end(key)
+      return entry[0]
+
+  def set(self, key, value, size):
+    with self._lock:
+      if size > self.maxbytes:
+        return
+      old = self._data.pop(key, None)
+      if old is not None:
+        self.size -= old[1]
+      self._data[key] = (value, size)
+      self.size += size
+      while self.size > self.maxbytes:
+        _, (_, evicted) = self._data.popitem(last=False)
+        self.size -= evicted
+        self.evictions += 1
+
+  def discard(self, predicate):
+    """Remove every entry whose key matches predicate."""
+    with self._lock:
+      for key in [key for key in self._data if predicate(key)]:
+        self.size -= self._data.pop(key)[1]
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+      self.size = 0
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return dict(
+        entries=len(self._data),
+        bytes=self.size,
+        maxbytes=self.maxbytes,
+        hits=self.hits,
+        misses=self.misses,
+        evictions=self.evictions,
+        hitratio=round(self.hits / lookups, 4) if lookups else None,
+      )
@@ -0,0 +1,63 @@
+import threading
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from models import Agency, State, Monument, User, Visit, db
+from ratings import top_rated, top_rated_to_dict
+from cache import TTLCache
+
+# Landing page statistics, kept for a minute at most and dropped after relevant writes
+stats_cache = TTLCache(ttl=60, maxsize=1)
+refresh_lock = threading.Lock()
+
+# Entities whose writes change the statistics
+COUNTED = (Agency, State, Monument, User, Visit)
+
+def compute_stats():
+  """Count listed agencies, states, monuments and users in a single round-trip."""
+  counts = db.session.query(
+    select(func.count(Agency.id)).scalar_subquery().label("agencies"),
+    select(func.count(State.id)).where(State.isdeleted == 0).scalar_subquery().label("states"),
+    select(func.count(Monument.id)).where(Monument.isdeleted == 0, Monument.isapproved == 1).scalar_subquery().label("monuments"),
+    select(func.count(User.id)).scalar_subquery().label("users"),
+  ).one()
+
+  return dict(
+    agencies=counts.agencies,
+    states=counts.states,
+    monuments=counts.monuments,
+    users=counts.users,
+    toprated=[top_rated_to_dict(row) for row in top_rated(5)],
+  )
+
+def get_stats():
+  """Return the statistics snapshot, computing it only when the cached one expired or was invalidated."""
+  stats = stats_cache.get("stats")
+  if stats is None:
+    # Only one request recomputes, the others wait for its result
+    with refresh_lock:
+      stats = stats_cache.get("stats")
+      if stats is None:
+        stats = compute_stats()
+        stats_cache.set("stats", stats)
+  return stats
+
+def invalidate_stats():
+  stats_cache.clear()
+
+@event.listens_for(Session, "after_flush")
+def mark_stats_dirty(session, flush_context):
+  for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+    if isinstance(obj, COUNTED):
+      session.info["stats_dirty"] = True
+      return
+
+# Invalidate after commit so a concurrent refresh cannot cache uncommitted data
+@event.listens_for(Session, "after_commit")
+def invalidate_after_commit(session):
+  if session.info.pop("stats_dirty", False):
+    invalidate_stats()
+
+@event.listens_for(Session, "after_rollback")
+def forget_dirty_flag(session):
+  session.info.pop("stats_dirty", None)
@@ -0,0 +1,108 @@
+from functools import wraps
+from flask import g, session, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from models import db
+
+def database_url(url):
+  """Normalize a database url from the environment, "postgres://" is the old name of the postgresql scheme."""
+  if url.startswith("postgres://"):
+    url = "postgresql://" + url[len("postgres://"):]
+  return url
+
+def is_sqlite(bind):
+  """Whether an engine or connection talks to SQLite, the full-text and spatial indexes only exist there."""
+  return bind.dialect.name == "sqlite"
+
+def engine_options(app, url):
+  """Build the create_engine options of a database url from the DATABASE_POOL_* settings."""
+  options = dict(pool_pre_ping=True)
+  url = make_url(url)
+  # In-memory SQLite lives in its one connection, there is no pool to size
+  if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+    return options
+  options.update(
+    pool_size=app.config["DATABASE_POOL_SIZE"],
+    max_overflow=app.config["DATABASE_MAX_OVERFLOW"],
+    pool_timeout=app.config["DATABASE_POOL_TIMEOUT"],
+    pool_recycle=app.config["DATABASE_POOL_RECYCLE"],
+  )
+  return options
+
+def sqlite_pragmas(app, primary):
+  """
+  Return the PRAGMA statements run on every new SQLite connection.
+
+  WAL lets readers go on while a visit is written, synchronous=NORMAL only syncs at
+  checkpoints, which is safe in WAL mode, and busy_timeout makes writers wait for
+  the lock instead of failing. The journal mode is a property of the database file,
+  so it is only set through the primary engine.
+  """
+  pragmas = [
+    "PRAGMA synchronous = %s" % app.config["SQLITE_SYNCHRONOUS"],
+    "PRAGMA busy_timeout = %d" % app.config["SQLITE_BUSY_TIMEOUT"],
+    "PRAGMA mmap_size = %d" % app.config["SQLITE_MMAP_SIZE"],
+  ]
+  if primary:
+    pragmas.insert(0, "PRAGMA journal_mode = %s" % app.config["SQLITE_JOURNAL_MODE"])
+  return pragmas
+
+def init_database(app):
+  """
+  Configure the primary engine from DATABASE_URL and, if DATABASE_REPLICA_URL is set,
+  a read replica engine used by the routes decorated with replica_reads.
+  """
+  url = database_url(app.config["DATABASE_URL"])
+  app.config["SQLALCHEMY_DATABASE_URI"] = url
+  app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app, url)
+
+  replica = app.config.get("DATABASE_REPLICA_URL")
+  if replica:
+    replica = database_url(replica)
+    app.config["SQLALCHEMY_BINDS"] = {"replica": dict(url=replica, **engine_options(app, replica))}
+
+  db.init_app(app)
+
+  with app.app_context():
+    for key, engine in db.engines.items():
+      if is_sqlite(engine):
+        apply_pragmas(engine, sqlite_pragmas(app, primary=key is None))
+
+  app.teardown_appcontext(close_read_session)
+
+def apply_pragmas(engine, pragmas):
+  """Run the pragmas on every new connection of engine."""
+  @event.listens_for(engine, "connect")
+  def set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in pragmas:
+      cursor.execute(pragma)
+    cursor.close()
+
+def replica_reads(f):
+  """
+  Decorate read-only routes to run their list queries on the read replica.
+
+  Right after a write the user is redirected with a flash message; those requests
+  stay on the primary so the user always sees their own write.
+  """
+  @wraps(f)
+  def decorated_function(*args, **kwargs):
+    g.replica_reads = not session.get("_flashes")
+    return current_app.ensure_sync(f)(*args, **kwargs)
+  return decorated_function
+
+def read_session():
+  """Return the session list queries run on: the replica inside replica_reads routes if one is configured, else the primary."""
+  if not g.get("replica_reads") or "replica" not in db.engines:
+    return db.session
+  if "read_session" not in g:
+    g.read_session = Session(db.engines["replica"])
+  return g.read_session
+
+def close_read_session(exception=None):
+  read = g.pop("read_session", None)
+  if read is not None:
+    read.close()
@@ -0,0 +1,46 @@
+import asyncio
+from markupsafe import Markup
+
+from httpcache import request_versions
+from helpers import get_current_user
+from cache import LRUCache
+
+# Rendered list fragments, bounded to 32 MB of html
+fragment_cache = LRUCache(maxbytes=32 * 1024 * 1024)
+
+def cached_fragment(name, tables, key, render):
+  """
+  Return the html of a list fragment, rendering it only on a cache miss.
+
+  Entries are keyed by the fragment name and key, the versions of the tables the
+  fragment shows and the admin flag, so a write to any of those tables or a
+  different role never sees a stale fragment. render() returns (html, data),
+  data is cached alongside the html for the caller.
+  """
+  cachekey = fragment_key(name, tables, key)
+  entry = fragment_cache.get(cachekey)
+  if entry is None:
+    html, data = render()
+    entry = (Markup(html), data)
+    fragment_cache.set(cachekey, entry, len(html))
+  return entry
+
+async def cached_fragment_async(name, tables, key, render):
+  """cached_fragment for async views, render is a coroutine function."""
+  # Reading the table versions may query the database, on a thread so it does not block the event loop
+  cachekey = await asyncio.to_thread(fragment_key, name, tables, key)
+  entry = fragment_cache.get(cachekey)
+  if entry is None:
+    html, data = await render()
+    entry = (Markup(html), data)
+    fragment_cache.set(cachekey, entry, len(html))
+  return entry
+
+def fragment_key(name, tables, key):
+  identity = get_current_user()
+  versions, _ = request_versions(tables)
+  return (name, key, tuple(sorted(versions.items())), bool(identity and identity.isadmin))
+
+def invalidate_fragments(*names):
+  """Drop every cached fragment with one of the given names."""
+  fragment_cache.discard(lambda key: key[0] in names)
@@ -0,0 +1,269 @@
+import functools
+import itertools
+import math
+from sqlalchemy import event, text, bindparam, DDL
+
+from models import Monument, db
+from database import read_session, is_sqlite
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+EARTH_RADIUS_KM = 6371.0088
+# Half the earth's circumference, no two points are further apart
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+CREATE_GEO_TABLE = "CREATE VIRTUAL TABLE IF NOT EXISTS monument_rtree USING rtree(id, minlat, maxlat, minlon, maxlon)"
+
+# R*Tree of approved monument coordinates, id is the monument id
+event.listen(db.metadata, "after_create", DDL(CREATE_GEO_TABLE).execute_if(dialect="sqlite"))
+
+def index_location(conn, monument):
+  """Replace the spatial entry of a monument, dropping it if the monument is not listed."""
+  if not is_sqlite(conn):
+    return
+  conn.execute(text("DELETE FROM monument_rtree WHERE id = :id"), {"id": monument.id})
+  if monument.isapproved and not monument.isdeleted:
+    lat, lon = float(monument.latitude), float(monument.longitude)
+    conn.execute(
+      text("INSERT INTO monument_rtree (id, minlat, maxlat, minlon, maxlon) VALUES (:id, :lat, :lat, :lon, :lon)"),
+      {"id": monument.id, "lat": lat, "lon": lon},
+    )
+
+@event.listens_for(Monument, "after_insert")
+@event.listens_for(Monument, "after_update")
+def sync_geo_index(mapper, connection, target):
+  index_location(connection, target)
+
+@event.listens_for(Monument, "after_delete")
+def remove_from_geo_index(mapper, connection, target):
+  if not is_sqlite(connection):
+    return
+  connection.execute(text("DELETE FROM monument_rtree WHERE id = :id"), {"id": target.id})
+
+def index_location_ids(conn, ids):
+  """Replace the spatial entries of many monuments at once, for writes that bypass the ORM."""
+  if not ids or not is_sqlite(conn):
+    return
+  conn.execute(text("DELETE FROM monument_rtree WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)), {"ids": ids})
+  conn.execute(text(
+    "INSERT INTO monument_rtree (id, minlat, maxlat, minlon, maxlon) "
+    "SELECT id, latitude, latitude, longitude, longitude FROM monument WHERE id IN :ids AND isdeleted = 0 AND isapproved = 1"
+  ).bindparams(bindparam("ids", expanding=True)), {"ids": ids})
+
+def rebuild_geo_index(conn):
+  """Rebuild the spatial index from the monument table, returning the number of indexed monuments."""
+  if not is_sqlite(conn):
+    return 0
+  conn.exec_driver_sql(CREATE_GEO_TABLE)
+  conn.exec_driver_sql("DELETE FROM monument_rtree")
+  conn.exec_driver_sql(
+    "INSERT INTO monument_rtree (id, minlat, maxlat, minlon, maxlon) "
+    "SELECT id, latitude, latitude, longitude, longitude FROM monument WHERE isdeleted = 0 AND isapproved = 1"
+  )
+  return conn.exec_driver_sql("SELECT COUNT(*) FROM monument_rtree").scalar()
+
+def distance_km(lat1, lon1, lat2, lon2):
+  """Return the great-circle distance in km between two points."""
+  lat1, lat2 = math.radians(lat1), math.radians(lat2)
+  a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+  return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+def haversine(lat, lon, lats, lons):
+  """Return the distances in km from (lat, lon) to each point of lats/lons, the same formula as distance_km."""
+  if numpy is not None:
+    lat1, lat2 = math.radians(lat), numpy.radians(lats)
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * numpy.cos(lat2) * numpy.sin(numpy.radians(lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+  return [distance_km(lat, lon, lat2, lon2) for lat2, lon2 in zip(lats, lons)]
+
+def lon_ranges(minlon, maxlon):
+  """Split a longitude range that crosses the antimeridian into two ranges."""
+  if minlon <= maxlon:
+    return [(minlon, maxlon)]
+  return [(minlon, 180.0), (-180.0, maxlon)]
+
+LOCATION_COLUMNS = "monument.id, monument.name, monument.imageurl, monument.latitude, monument.longitude"
+
+def box_query(sqlite):
+  """Select the approved monuments inside the box :minlat, :maxlat, :west, :east."""
+  if sqlite:
+    source = (
+      "monument_rtree JOIN monument ON monument.id = monument_rtree.id "
+      "WHERE monument_rtree.maxlat >= :minlat AND monument_rtree.minlat <= :maxlat "
+      "AND monument_rtree.maxlon >= :west AND monument_rtree.minlon <= :east "
+    )
+  else:
+    # Other databases have no R*Tree, the coordinate columns are filtered directly
+    source = "monument WHERE monument.isdeleted = false AND monument.isapproved = true "
+  return (
+    "SELECT " + LOCATION_COLUMNS + " FROM " + source +
+    "AND monument.latitude BETWEEN :minlat AND :maxlat AND monument.longitude BETWEEN :west AND :east"
+  )
+
+def bbox_candidates(minlat, minlon, maxlat, maxlon, limit):
+  """Return approved monuments inside the box, looked up through the R*Tree on SQLite."""
+  session = read_session()
+  statement = text(box_query(is_sqlite(session.get_bind())) + " LIMIT :limit")
+  rows = []
+  for west, east in lon_ranges(minlon, maxlon):
+    rows += session.execute(statement, {"minlat": minlat, "maxlat": maxlat, "west": west, "east": east, "limit": limit}).all()
+  return rows[:limit]
+
+def search_box(lat, lon, radius):
+  """
+  Return the (minlat, maxlat, west, east) box that contains the circle of radius km
+  around (lat, lon). west and east may run past ±180, boxes of growing radius nest.
+  """
+  dlat = radius / KM_PER_DEGREE
+  minlat, maxlat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+  # Near the poles the circle covers every longitude
+  if minlat <= -90.0 or maxlat >= 90.0:
+    dlon = 180.0
+  else:
+    dlon = min(dlat / max(math.cos(math.radians(abs(lat) + dlat)), 1e-12), 180.0)
+  return minlat, maxlat, lon - dlon, lon + dlon
+
+def wrap_lon(west, east):
+  """Split the longitude range west..east, which may run past ±180, into ranges inside -180..180."""
+  if east - west >= 360.0:
+    return [(-180.0, 180.0)]
+  shift = 360.0 * math.floor((west + 180.0) / 360.0)
+  west, east = west - shift, east - shift
+  if east <= 180.0:
+    return [(west, east)]
+  return [(west, 180.0), (-180.0, east - 360.0)]
+
+def ring_boxes(inner, outer):
+  """Split the part of the box outer that is not in the nested box inner into boxes inside -180..180."""
+  minlat, maxlat, west, east = outer
+  if inner is None:
+    strips = [outer]
+  else:
+    inner_minlat, inner_maxlat, inner_west, inner_east = inner
+    strips = [
+      (minlat, inner_minlat, west, east), (inner_maxlat, maxlat, west, east),
+      (inner_minlat, inner_maxlat, west, inner_west), (inner_minlat, inner_maxlat, inner_east, east),
+    ]
+  boxes = []
+  for south, north, strip_west, strip_east in strips:
+    # Strips are empty where the box stopped growing, at the poles or around the whole earth
+    if south < north and strip_west < strip_east:
+      boxes += [(south, north, a, b) for a, b in wrap_lon(strip_west, strip_east)]
+  return boxes
+
+# R*Tree coordinates are 32-bit floats, distances computed from them are off by less than this
+ROUNDING_KM = 0.01
+
+@functools.lru_cache(maxsize=None)
+def boxes_statement(sqlite, count):
+  """Select (id, latitude, longitude) of the approved monuments inside count boxes :minlat0, :maxlat0, :west0, :east0..."""
+  if sqlite:
+    # The R*Tree alone, without looking up the monument rows
+    box = "SELECT id, minlat, minlon FROM monument_rtree WHERE maxlat >= :minlat{0} AND minlat <= :maxlat{0} AND maxlon >= :west{0} AND minlon <= :east{0}"
+  else:
+    box = (
+      "SELECT id, CAST(latitude AS FLOAT), CAST(longitude AS FLOAT) FROM monument WHERE isdeleted = false AND isapproved = true "
+      "AND latitude BETWEEN :minlat{0} AND :maxlat{0} AND longitude BETWEEN :west{0} AND :east{0}"
+    )
+  return text(" UNION ALL ".join(box.format(i) for i in range(count)))
+
+def box_locations(session, sqlite, boxes):
+  """Return the (id, latitude, longitude) rows of the approved monuments inside the boxes in one query."""
+  if not boxes:
+    return []
+  params = {}
+  for i, (minlat, maxlat, west, east) in enumerate(boxes):
+    params.update({"minlat%d" % i: minlat, "maxlat%d" % i: maxlat, "west%d" % i: west, "east%d" % i: east})
+  return session.execute(boxes_statement(sqlite, len(boxes)), params).all()
+
+class Candidates:
+  """
+  The distinct monuments read so far and their distances from (lat, lon), kept in
+  numpy arrays when numpy is installed. Distances are computed from the R*Tree
+  coordinates, so each is within ROUNDING_KM of the exact one.
+  """
+
+  def __init__(self, lat, lon):
+    self.lat, self.lon = lat, lon
+    if numpy is not None:
+      self.ids, self.distances = numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)
+    else:
+      self.distances = {}
+
+  def add(self, rows):
+    if not rows:
+      return
+    if numpy is not None:
+      block = numpy.fromiter(itertools.chain.from_iterable(rows), dtype=numpy.float64, count=3 * len(rows)).reshape(-1, 3)
+      ids = numpy.concatenate([self.ids, block[:, 0].astype(numpy.int64)])
+      distances = numpy.concatenate([self.distances, haversine(self.lat, self.lon, block[:, 1], block[:, 2])])
+      # Monuments on the edge of two boxes are read twice
+      self.ids, first = numpy.unique(ids, return_index=True)
+      self.distances = distances[first]
+    else:
+      self.distances.update(zip([row[0] for row in rows], haversine(self.lat, self.lon, [row[1] for row in rows], [row[2] for row in rows])))
+
+  def within(self, radius):
+    """Return how many of the monuments are certainly within radius km."""
+    if numpy is not None:
+      return int(numpy.count_nonzero(self.distances <= radius - ROUNDING_KM))
+    return sum(1 for distance in self.distances.values() if distance <= radius - ROUNDING_KM)
+
+  def closest(self, radius, limit):
+    """Return the ids of the monuments that may be among the limit nearest within radius km."""
+    if numpy is not None:
+      cutoff = numpy.partition(self.distances, limit - 1)[limit - 1] if len(self.distances) >= limit else math.inf
+      return self.ids[self.distances <= min(cutoff + 2 * ROUNDING_KM, radius + ROUNDING_KM)].tolist()
+    distances = sorted(self.distances.values())
+    cutoff = distances[limit - 1] if len(distances) >= limit else math.inf
+    return [id for id, distance in self.distances.items() if distance <= min(cutoff + 2 * ROUNDING_KM, radius + ROUNDING_KM)]
+
+def location_rows(session, ids):
+  """Return the location rows of the monuments with the given ids."""
+  if not ids:
+    return []
+  statement = text("SELECT " + LOCATION_COLUMNS + " FROM monument WHERE monument.id IN :ids").bindparams(bindparam("ids", expanding=True))
+  return session.execute(statement, {"ids": ids}).all()
+
+def within_radius(lat, lon, radius, limit=100, start=10.0):
+  """
+  Return (row, distance) pairs for the limit approved monuments nearest to
+  (lat, lon) within radius km, nearest first.
+
+  The search starts with the box around a start km circle and doubles the circle
+  until it certainly holds limit monuments or reaches radius. Each step reads only
+  the ring the box grew by from the R*Tree and computes its distances in one
+  vectorized pass, so dense areas stop early and empty ones cost a few index
+  lookups. The few monuments that can make the result are then ordered by their
+  exact distances.
+  """
+  session = read_session()
+  sqlite = is_sqlite(session.get_bind())
+  candidates = Candidates(lat, lon)
+  search, covered = min(start, radius), None
+  while True:
+    box = search_box(lat, lon, search)
+    candidates.add(box_locations(session, sqlite, ring_boxes(covered, box)))
+    covered = box
+    # Every monument within search km has been read
+    if search >= radius or candidates.within(search) >= limit:
+      break
+    search = min(search * 2, radius)
+
+  matches = [(row, distance_km(lat, lon, float(row.latitude), float(row.longitude))) for row in location_rows(session, candidates.closest(radius, limit))]
+  matches.sort(key=lambda match: (match[1], match[0].id))
+  return [match for match in matches if match[1] <= radius][:limit]
+
+def nearest(lat, lon, k=10, radius=1000.0):
+  """Return the k approved monuments nearest to (lat, lon), looking no further than radius km."""
+  return within_radius(lat, lon, radius, k)
+
+def location_to_dict(row, distance=None):
+  location = dict(id=row.id, name=row.name, imageurl=row.imageurl, latitude=float(row.latitude), longitude=float(row.longitude))
+  if distance is not None:
+    location["distance"] = round(distance, 3)
+  return location
@@ -0,0 +1,27 @@
+# Gunicorn settings: gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:%s" % os.environ.get("PORT", "8000"))
+# Behind a reverse proxy set TRUSTED_PROXY_HOPS=1, so the login throttle counts client addresses and not the proxy's
+
+# Processes for CPU-bound rendering, threads so requests waiting on the database do not block a process
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+
+# Recycle workers now and then so slow leaks cannot build up
+max_requests = 10000
+max_requests_jitter = 1000
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+
+# Workers must not migrate the database concurrently, the master does it once before forking them
+raw_env = ["DATABASE_AUTO_UPGRADE=0"]
+
+def on_starting(server):
+  from app import create_app
+  create_app(dict(DATABASE_AUTO_UPGRADE=True))
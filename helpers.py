@@ -1,6 +1,40 @@
-from flask import render_template, request, redirect, url_for, session
+from flask import render_template, request, redirect, url_for, session, g, current_app
 from functools import wraps
-from models import User
+from collections import namedtuple
+from sqlalchemy import event
+from models import User, db
+from cache import TTLCache
+
+# Identity of a logged in user, detached from any database session
+Identity = namedtuple("Identity", ["id", "username", "isadmin"])
+
+# Process-wide cache of identities, keyed by user id
+user_cache = TTLCache(ttl=30)
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_user_cache(mapper, connection, target):
+    user_cache.pop(target.id)
+
+def load_identity(userid):
+    """Return the Identity of the given user, or None if the user does not exist."""
+    if userid is None:
+        return None
+
+    identity = user_cache.get(userid)
+    if identity is None:
+        row = db.session.query(User.id, User.username, User.isadmin).filter(User.id == userid).first()
+        if not row:
+            return None
+        identity = Identity(row.id, row.username, bool(row.isadmin))
+        user_cache.set(userid, identity)
+    return identity
+
+def get_current_user():
+    """Return the Identity of the logged in user, loaded at most once per request."""
+    if "identity" not in g:
+        g.identity = load_identity(session.get("user_id"))
+    return g.identity
 
 def get_user_id_from_session():
     return session["user_id"]
@@ -12,6 +46,22 @@ def handle_error(message, code=400):
   """Render message in an error page to the user."""
   return render_template("error.html", code=code, message=message), code
 
+def handle_throttled(wait):
+    """Render a 429 error page telling the client when to retry."""
+    body, code = handle_error("too many attempts, try again in %d seconds" % wait, 429)
+    return body, code, {"Retry-After": str(wait)}
+
+def handle_busy(message, wait=5):
+    """Render a 503 error page telling the client when to retry."""
+    body, code = handle_error(message, 503)
+    return body, code, {"Retry-After": str(wait)}
+
+def get_page_size():
+    """Return the page size requested via ?limit=, bounded by the configured maximum."""
+    default = current_app.config["PAGE_SIZE"]
+    limit = request.args.get("limit", default, type=int)
+    return max(1, min(limit, current_app.config["MAX_PAGE_SIZE"]))
+
 def login_required(f):
     """
     Decorate routes to require login.
@@ -21,8 +71,8 @@ def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if session.get("user_id") is None:
-            return redirect(url_for("login", next=request.url))
-        return f(*args, **kwargs)
+            return redirect(url_for("views.login", next=request.url))
+        return current_app.ensure_sync(f)(*args, **kwargs)
     return decorated_function
 
 def admin_required(f):
@@ -32,13 +82,12 @@ def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if session.get("user_id") is None:
-            return redirect(url_for("login", next=request.url))
-        
-        user_id = session.get("user_id")
-        dbuser = User.query.filter(User.id == user_id).first()
+            return redirect(url_for("views.login", next=request.url))
+
+        identity = get_current_user()
 
-        if dbuser.isadmin != 1:
+        if not identity or not identity.isadmin:
             return redirect("/")
         
-        return f(*args, **kwargs)
+        return current_app.ensure_sync(f)(*args, **kwargs)
     return decorated_function
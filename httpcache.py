@@ -0,0 +1,123 @@
+import hashlib
+import os
+from datetime import datetime
+from functools import wraps
+from flask import request, session, make_response, current_app, g
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from models import Agency, State, Monument, Visit, Media, EntityVersion
+from helpers import get_current_user
+from database import read_session
+
+# Tables whose versions are tracked, by mapped class
+VERSIONED = {Agency: "agency", State: "state", Monument: "monument", Visit: "visit", Media: "media"}
+
+@event.listens_for(Session, "after_flush")
+def bump_versions(session, flush_context):
+  """Bump the version of every table the flush wrote to, inside the same transaction."""
+  names = set()
+  for obj in list(session.new) + list(session.deleted) + [obj for obj in session.dirty if session.is_modified(obj)]:
+    name = VERSIONED.get(type(obj))
+    if name:
+      names.add(name)
+
+  if names:
+    bump(session.connection(), *names)
+
+def bump(conn, *names):
+  """Bump table versions directly, for writes that bypass the ORM."""
+  for name in sorted(names):
+    conn.execute(text(
+      "INSERT INTO entity_version (name, version, updatedon) VALUES (:name, 1, :now) "
+      "ON CONFLICT (name) DO UPDATE SET version = entity_version.version + 1, updatedon = excluded.updatedon"
+    ), {"name": name, "now": datetime.utcnow()})
+
+def get_versions(names):
+  """Return ({name: version}, last modified time) for the given tables in one query."""
+  # Read where the page's data is read, so a lagging replica never pairs old data with a new ETag
+  rows = read_session().query(EntityVersion).filter(EntityVersion.name.in_(names)).all()
+  versions = dict((name, 0) for name in names)
+  modified = None
+  for row in rows:
+    versions[row.name] = row.version
+    if modified is None or row.updatedon > modified:
+      modified = row.updatedon
+  return versions, modified
+
+def request_versions(names):
+  """Return get_versions(names), read at most once per request."""
+  key = tuple(sorted(names))
+  if "versions" not in g:
+    g.versions = {}
+  if key not in g.versions:
+    g.versions[key] = get_versions(key)
+  return g.versions[key]
+
+def request_version(name):
+  """Return the version of one table, reusing the versions this request already read if they include it."""
+  for versions, _ in g.get("versions", {}).values():
+    if name in versions:
+      return versions[name]
+  versions, _ = request_versions((name,))
+  return versions[name]
+
+def conditional(*names, vary=None):
+  """
+  Decorate read-only routes to answer If-None-Match with 304 before the view runs.
+
+  The ETag covers the url, the versions of the given tables, the user and, through
+  vary, anything else the page renders, such as user specific state. Pages with pending flash
+  messages are always rendered so the messages are not lost.
+  """
+  def decorator(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+      if request.method != "GET" or session.get("_flashes"):
+        return current_app.ensure_sync(f)(*args, **kwargs)
+
+      versions, modified = request_versions(names) if names else ({}, None)
+      identity = get_current_user()
+      key = repr((request.full_path, sorted(versions.items()), identity, vary() if vary else None))
+      etag = hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+      if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+      else:
+        response = make_response(current_app.ensure_sync(f)(*args, **kwargs))
+        if response.status_code != 200:
+          return response
+
+      response.set_etag(etag)
+      if modified:
+        response.last_modified = modified
+      # Per user pages, stored by the browser but always revalidated
+      response.cache_control.private = True
+      response.cache_control.no_cache = True
+      return response
+    return decorated_function
+  return decorator
+
+# Content hashes of static files, keyed by (filename, mtime)
+static_hashes = {}
+
+def static_fingerprint(filename):
+  """Return a short content hash of a static file, used to make its url change whenever it changes."""
+  path = os.path.join(current_app.static_folder, filename)
+  try:
+    mtime = os.path.getmtime(path)
+  except OSError:
+    return None
+
+  key = (filename, mtime)
+  if key not in static_hashes:
+    with open(path, "rb") as file:
+      static_hashes[key] = hashlib.sha1(file.read()).hexdigest()[:12]
+  return static_hashes[key]
+
+def fingerprint_static_urls(endpoint, values):
+  """url_defaults callback adding ?v=<content hash> to every static url."""
+  if endpoint == "static" and "filename" in values and "v" not in values:
+    fingerprint = static_fingerprint(values["filename"])
+    if fingerprint:
+      values["v"] = fingerprint
@@ -0,0 +1,372 @@
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import re
+import socket
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app, request, send_file, url_for
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from models import Media, EntityVersion, db
+from httpcache import request_version
+from database import read_session
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+# Resized variants as (width, height), variants with a height are cropped to fill it
+# like the card's object-fit: cover, the others keep the aspect ratio
+SIZES = {
+  "card": (320, 300),
+  "card2x": (640, 600),
+  "medium": (800, None),
+  "large": (1600, None),
+}
+
+# Variant formats, WebP for browsers that accept it and JPEG for the others
+FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+# Content types of the originals served without Pillow, by file signature
+SIGNATURES = [
+  (b"\xff\xd8\xff", "image/jpeg"),
+  (b"\x89PNG\r\n\x1a\n", "image/png"),
+  (b"GIF87a", "image/gif"),
+  (b"GIF89a", "image/gif"),
+]
+
+HASH = re.compile(r"^[0-9a-f]{64}$")
+
+class MediaError(Exception):
+  """Raised when an image url cannot be fetched or is not an image."""
+
+def sniff(data):
+  """Return the content type of image bytes, or None if they are no image we can serve."""
+  for signature, type in SIGNATURES:
+    if data.startswith(signature):
+      return type
+  if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+    return "image/webp"
+  return None
+
+def public_address(ip):
+  """Whether an address is safe to fetch from, not loopback, private or link-local."""
+  return ip.is_global
+
+def resolve(host, port, allow_private=False):
+  """
+  Return the getaddrinfo entries of host, refusing it if any address is not public,
+  so image urls cannot reach internal services.
+  """
+  try:
+    addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+  except (socket.gaierror, UnicodeError):
+    raise MediaError("cannot resolve %s" % host)
+  if not allow_private:
+    for address in addresses:
+      if not public_address(ipaddress.ip_address(address[4][0].split("%")[0])):
+        raise MediaError("%s is not a public address" % host)
+  return addresses
+
+def connect(host, port, timeout, allow_private=False):
+  """
+  Open a socket to host on one of the addresses resolve checked. Connecting by
+  name would look the host up again, and a second answer may be an internal address.
+  """
+  error = None
+  for family, type, proto, _, address in resolve(host, port, allow_private):
+    sock = socket.socket(family, type, proto)
+    try:
+      sock.settimeout(timeout)
+      sock.connect(address)
+      return sock
+    except OSError as e:
+      sock.close()
+      error = e
+  raise error
+
+class CheckedHTTPConnection(http.client.HTTPConnection):
+  def __init__(self, host, allow_private=False, **kwargs):
+    super().__init__(host, **kwargs)
+    self.allow_private = allow_private
+
+  def connect(self):
+    self.sock = connect(self.host, self.port, self.timeout, self.allow_private)
+
+class CheckedHTTPSConnection(http.client.HTTPSConnection):
+  def __init__(self, host, allow_private=False, **kwargs):
+    super().__init__(host, **kwargs)
+    self.allow_private = allow_private
+
+  def connect(self):
+    # The certificate is still verified against the host name
+    self.sock = self._context.wrap_socket(connect(self.host, self.port, self.timeout, self.allow_private), server_hostname=self.host)
+
+class CheckedHTTPHandler(urllib.request.HTTPHandler):
+  def __init__(self, allow_private):
+    super().__init__()
+    self.allow_private = allow_private
+
+  def http_open(self, req):
+    return self.do_open(CheckedHTTPConnection, req, allow_private=self.allow_private)
+
+class CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+  def __init__(self, allow_private):
+    super().__init__()
+    self.allow_private = allow_private
+
+  def https_open(self, req):
+    return self.do_open(CheckedHTTPSConnection, req, context=self._context, allow_private=self.allow_private)
+
+def check_url(url):
+  parts = urllib.parse.urlsplit(url)
+  if parts.scheme not in ("http", "https") or not parts.hostname:
+    raise MediaError("unsupported url %r" % url)
+
+class CheckedRedirects(urllib.request.HTTPRedirectHandler):
+  """Apply the url checks to every redirect as well, its address is checked when connecting."""
+
+  def redirect_request(self, req, fp, code, msg, headers, newurl):
+    check_url(newurl)
+    return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+def download(url, max_bytes, timeout, allow_private=False):
+  """Return the body of url, at most max_bytes long, fetched only from public addresses unless allow_private."""
+  check_url(url)
+  opener = urllib.request.build_opener(
+    # An environment proxy would be connected to instead of the checked address
+    urllib.request.ProxyHandler({}),
+    CheckedHTTPHandler(allow_private), CheckedHTTPSHandler(allow_private), CheckedRedirects(),
+  )
+  try:
+    with opener.open(urllib.request.Request(url, headers={"User-Agent": "national-monuments"}), timeout=timeout) as response:
+      data = response.read(max_bytes + 1)
+  except (urllib.error.URLError, OSError, ValueError) as error:
+    raise MediaError("cannot fetch %s: %s" % (url, error))
+  if len(data) > max_bytes:
+    raise MediaError("%s is larger than %d bytes" % (url, max_bytes))
+  return data
+
+def media_dir(hash):
+  return os.path.join(current_app.config["MEDIA_DIR"], hash[:2], hash)
+
+def write_file(path, data):
+  """Write a file atomically, concurrent writers of the same content all end up with a complete file."""
+  temporary = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+  with open(temporary, "wb") as file:
+    file.write(data)
+  os.replace(temporary, path)
+
+def make_variants(data, max_pixels):
+  """Yield (size, format, bytes) of every resized variant of an image."""
+  try:
+    image = Image.open(io.BytesIO(data))
+    if image.width * image.height > max_pixels:
+      raise MediaError("image of %dx%d pixels is too large" % image.size)
+    image.load()
+  except Image.DecompressionBombError as error:
+    raise MediaError(str(error))
+  except OSError:
+    raise MediaError("not an image")
+
+  # Animated images keep their first frame, everything is stored as RGB(A)
+  image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+  for size, (width, height) in SIZES.items():
+    if height:
+      scale = min(1, max(width / image.width, height / image.height))
+      resized = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+      left = (resized.width - min(width, resized.width)) // 2
+      top = (resized.height - min(height, resized.height)) // 2
+      resized = resized.crop((left, top, left + min(width, resized.width), top + min(height, resized.height)))
+    elif image.width > width:
+      resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+    else:
+      resized = image
+
+    webp = io.BytesIO()
+    resized.save(webp, "WEBP", quality=80, method=4)
+    yield size, "webp", webp.getvalue()
+    jpeg = io.BytesIO()
+    resized.convert("RGB").save(jpeg, "JPEG", quality=82, optimize=True, progressive=True)
+    yield size, "jpeg", jpeg.getvalue()
+
+def store(data):
+  """
+  Store an image under the sha256 of its bytes with its resized variants and return the hash.
+
+  Identical images fetched from different urls are stored once.
+  """
+  hash = hashlib.sha256(data).hexdigest()
+  directory = media_dir(hash)
+  if os.path.exists(os.path.join(directory, "original")):
+    return hash
+
+  if Image is None:
+    if sniff(data) is None:
+      raise MediaError("not an image")
+    variants = []
+  else:
+    variants = list(make_variants(data, current_app.config["MEDIA_MAX_PIXELS"]))
+
+  os.makedirs(directory, exist_ok=True)
+  for size, format, variant in variants:
+    write_file(os.path.join(directory, "%s.%s" % (size, format)), variant)
+  # Written last, its presence marks a complete entry
+  write_file(os.path.join(directory, "original"), data)
+  return hash
+
+def fetch_media(url):
+  """Fetch and store the image at url and record the outcome, returning (hash, error)."""
+  config = current_app.config
+  hash = error = None
+  try:
+    hash = store(download(url, config["MEDIA_MAX_BYTES"], config["MEDIA_FETCH_TIMEOUT"], config["MEDIA_ALLOW_PRIVATE"]))
+  except MediaError as e:
+    error = str(e)[:200]
+
+  try:
+    db.session.merge(Media(url=url, hash=hash, error=error, fetchedon=datetime.utcnow()))
+    db.session.flush()
+    version = db.session.execute(select(EntityVersion.version).where(EntityVersion.name == "media")).scalar()
+    db.session.commit()
+  except IntegrityError:
+    # Another worker recorded the same url first
+    db.session.rollback()
+    return hash, error
+
+  current_app.extensions["media_index"].learn(url, hash, version)
+  return hash, error
+
+class MediaIndex:
+  """
+  Map of every recorded image url to its content hash, None for urls that failed.
+
+  Reloaded when the media version changes, the fetches of this process are added
+  in place so they do not cost the next request a reload.
+  """
+
+  def __init__(self):
+    self.version = None
+    self.hashes = {}
+    self._lock = threading.Lock()
+
+  def get(self):
+    version = request_version("media")
+    if version != self.version:
+      hashes = dict(read_session().execute(select(Media.url, Media.hash)).all())
+      with self._lock:
+        self.hashes, self.version = hashes, version
+    return self.hashes
+
+  def learn(self, url, hash, version):
+    with self._lock:
+      if self.version is not None and version == self.version + 1:
+        hashes = dict(self.hashes)
+        hashes[url] = hash
+        self.hashes, self.version = hashes, version
+
+class MediaFetcher:
+  """
+  Fetch images in the background on a bounded pool, each url once per process.
+
+  Failed urls are recorded too and only fetched again by "flask media-fetch --retry".
+  """
+
+  def __init__(self, app, workers):
+    self.app = app
+    self.workers = workers
+    self._pool = None
+    self._queued = set()
+    self._lock = threading.Lock()
+
+  def enqueue(self, url):
+    if not self.workers:
+      return
+    with self._lock:
+      if url in self._queued:
+        return
+      self._queued.add(url)
+      # Created on first use, so servers that fork after creating the app get a pool per worker
+      if self._pool is None:
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="media-fetcher")
+    self._pool.submit(self.fetch, url)
+
+  def fetch(self, url):
+    try:
+      with self.app.app_context():
+        fetch_media(url)
+    except Exception:
+      self.app.logger.exception("fetching %s failed", url)
+      # Nothing was recorded, a later page view may try again
+      with self._lock:
+        self._queued.discard(url)
+
+def init_media(app):
+  """Set up the image cache in MEDIA_DIR and the image_sources template helper."""
+  os.makedirs(app.config["MEDIA_DIR"], exist_ok=True)
+  app.extensions["media_index"] = MediaIndex()
+  app.extensions["media_fetcher"] = MediaFetcher(app, app.config["MEDIA_FETCH_WORKERS"])
+  app.jinja_env.globals["image_sources"] = image_sources
+
+def image_sources(url, size="card"):
+  """
+  Return dict(src, srcset, sizes) of an <img> showing the image at url.
+
+  Cached images are served from /media, "card" in the 1x and 2x card sizes and
+  "large" in widths for the full width details image. Images not cached yet are
+  queued for fetching and shown from their remote url meanwhile.
+  """
+  hash = current_app.extensions["media_index"].get().get(url, False) if url else None
+  if hash is False:
+    current_app.extensions["media_fetcher"].enqueue(url)
+  if not hash:
+    return dict(src=url, srcset=None, sizes=None)
+
+  def media_url(size):
+    return url_for("views.media", hash=hash, size=size)
+
+  if Image is None:
+    return dict(src=media_url("original"), srcset=None, sizes=None)
+  if size == "card":
+    return dict(src=media_url("card"), srcset="%s 1x, %s 2x" % (media_url("card"), media_url("card2x")), sizes=None)
+  return dict(
+    src=media_url("large"),
+    srcset="%s %dw, %s %dw" % (media_url("medium"), SIZES["medium"][0], media_url("large"), SIZES["large"][0]),
+    sizes="100vw",
+  )
+
+def send_media(hash, size):
+  """Send a stored image, WebP to browsers that accept it, or None if there is no such image."""
+  if not HASH.match(hash) or (size != "original" and size not in SIZES):
+    return None
+  directory = media_dir(hash)
+  if size == "original":
+    path = os.path.join(directory, "original")
+    try:
+      with open(path, "rb") as file:
+        type = sniff(file.read(16))
+    except OSError:
+      return None
+  else:
+    # Only an explicit image/webp counts, older browsers accept */* but cannot decode it
+    format = "webp" if any(value == "image/webp" for value, _ in request.accept_mimetypes) else "jpeg"
+    path = os.path.join(directory, "%s.%s" % (size, format))
+    type = FORMATS[format]
+    if not os.path.exists(path):
+      return None
+
+  # The url names the content, it never changes
+  response = send_file(path, mimetype=type or "application/octet-stream", max_age=31536000)
+  response.cache_control.public = True
+  response.cache_control.immutable = True
+  response.vary.add("Accept")
+  return response
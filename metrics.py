@@ -0,0 +1,240 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+from datetime import datetime
+from flask import g, request, current_app, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from queryplans import explain_sql
+
+try:
+  import pyinstrument
+except ImportError:
+  pyinstrument = None
+
+# Histogram buckets of request, SQL and render durations in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Histogram buckets of SQL statements per request
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+# Statements of a slow request shown with their query plans, slowest first
+SLOW_STATEMENTS = 5
+
+logger = logging.getLogger("slow_requests")
+
+def escape(value):
+  return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+  pairs = list(zip(names, values)) + list(extra)
+  return "{%s}" % ",".join('%s="%s"' % (name, escape(value)) for name, value in pairs) if pairs else ""
+
+class Counter:
+  def __init__(self, name, help, labels):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.values = {}
+    self._lock = threading.Lock()
+
+  def inc(self, labels, amount=1):
+    with self._lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+  def render(self, extra):
+    lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+    with self._lock:
+      for labels, value in sorted(self.values.items()):
+        lines.append("%s%s %s" % (self.name, format_labels(self.labels, labels, extra), repr(float(value))))
+    return lines
+
+class Histogram:
+  """Cumulative bucket counts, sum and count per label values, as Prometheus histograms keep them."""
+
+  def __init__(self, name, help, labels, buckets):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.buckets = buckets
+    self.values = {}
+    self._lock = threading.Lock()
+
+  def observe(self, labels, value):
+    with self._lock:
+      entry = self.values.get(labels)
+      if entry is None:
+        entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          entry[0][i] += 1
+      entry[1] += value
+      entry[2] += 1
+
+  def render(self, extra):
+    lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+    with self._lock:
+      for labels, (counts, total, count) in sorted(self.values.items()):
+        for bound, bucket in zip(self.buckets, counts):
+          lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labels, labels, extra + [("le", repr(float(bound)))]), bucket))
+        lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labels, labels, extra + [("le", "+Inf")]), count))
+        lines.append("%s_sum%s %s" % (self.name, format_labels(self.labels, labels, extra), repr(total)))
+        lines.append("%s_count%s %d" % (self.name, format_labels(self.labels, labels, extra), count))
+    return lines
+
+requests_total = Counter("http_requests_total", "Requests by route, method and status.", ("endpoint", "method", "status"))
+request_duration = Histogram("http_request_duration_seconds", "Time from the start of a request until its response was ready.", ("endpoint", "method"), DURATION_BUCKETS)
+request_queries = Histogram("db_queries_per_request", "SQL statements executed by a request.", ("endpoint",), QUERY_BUCKETS)
+request_query_duration = Histogram("db_query_duration_seconds", "Time a request spent executing SQL statements.", ("endpoint",), DURATION_BUCKETS)
+request_render_duration = Histogram("template_render_duration_seconds", "Time a request spent rendering Jinja templates.", ("endpoint",), DURATION_BUCKETS)
+
+METRICS = [requests_total, request_duration, request_queries, request_query_duration, request_render_duration]
+
+def render_metrics():
+  """Return every metric of this process in the Prometheus text format."""
+  # Each worker process keeps its own numbers, the worker label keeps their series apart
+  extra = [("worker", os.getpid())]
+  lines = []
+  for metric in METRICS:
+    lines.extend(metric.render(extra))
+  return "\n".join(lines) + "\n"
+
+class RequestMetrics:
+  """What one request spent its time on, kept on g."""
+
+  def __init__(self, capture):
+    self.start = time.perf_counter()
+    self.queries = 0
+    self.query_time = 0.0
+    self.render_time = 0.0
+    self.renders = []
+    self.status = 500
+    # (engine, statement, parameters, seconds) of every statement, only kept for the slow request log
+    self.statements = [] if capture else None
+    self.profiler = None
+
+def current_metrics():
+  return g.get("metrics") if has_request_context() else None
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  seconds = time.perf_counter() - conn.info["query_start"].pop()
+  metrics = current_metrics()
+  if metrics is None:
+    return
+  metrics.queries += 1
+  metrics.query_time += seconds
+  if metrics.statements is not None:
+    metrics.statements.append((conn.engine, statement, parameters, seconds))
+
+def start_render(app, template, context, **extra):
+  metrics = current_metrics()
+  if metrics is not None:
+    metrics.renders.append(time.perf_counter())
+
+def end_render(app, template, context, **extra):
+  metrics = current_metrics()
+  if metrics is not None and metrics.renders:
+    start = metrics.renders.pop()
+    # Only the outermost render counts, nested ones are part of it
+    if not metrics.renders:
+      metrics.render_time += time.perf_counter() - start
+
+def start_request():
+  config = current_app.config
+  g.metrics = metrics = RequestMetrics(capture=config["SLOW_REQUEST_MS"] > 0)
+  if not config["SLOW_REQUEST_MS"]:
+    return
+  if config["SLOW_REQUEST_PROFILER"] == "pyinstrument":
+    metrics.profiler = pyinstrument.Profiler(async_mode="disabled")
+    metrics.profiler.start()
+  elif config["SLOW_REQUEST_PROFILER"] == "cprofile":
+    metrics.profiler = cProfile.Profile()
+    metrics.profiler.enable()
+
+def slow_request_report(metrics, seconds):
+  """Write the statements, query plans and profile of a slow request to SLOW_REQUEST_DIR, returning the report path."""
+  name = "%s-%s-%d" % (datetime.now().strftime("%Y%m%d-%H%M%S-%f"), request.endpoint or "unmatched", os.getpid())
+  directory = current_app.config["SLOW_REQUEST_DIR"]
+  os.makedirs(directory, exist_ok=True)
+  path = os.path.join(directory, name)
+
+  report = io.StringIO()
+  report.write("%s %s %d in %.1f ms\n" % (request.method, request.full_path, metrics.status, seconds * 1000))
+  report.write("%d SQL statements in %.1f ms, templates rendered in %.1f ms\n" % (metrics.queries, metrics.query_time * 1000, metrics.render_time * 1000))
+
+  for engine, statement, parameters, duration in sorted(metrics.statements, key=lambda entry: -entry[3])[:SLOW_STATEMENTS]:
+    report.write("\n-- %.1f ms\n%s\n%r\n" % (duration * 1000, statement, parameters))
+    try:
+      for line in explain_sql(engine, statement, parameters):
+        report.write("   %s\n" % line)
+    except Exception as error:
+      report.write("   no plan: %s\n" % error)
+
+  if isinstance(metrics.profiler, cProfile.Profile):
+    metrics.profiler.dump_stats(path + ".prof")
+    report.write("\n")
+    pstats.Stats(metrics.profiler, stream=report).sort_stats("cumulative").print_stats(30)
+  elif metrics.profiler is not None:
+    with open(path + ".html", "w") as file:
+      file.write(metrics.profiler.output_html())
+    report.write("\n" + metrics.profiler.output_text())
+
+  with open(path + ".txt", "w") as file:
+    file.write(report.getvalue())
+  return path + ".txt"
+
+def finish_request(response):
+  metrics = current_metrics()
+  if metrics is not None:
+    metrics.status = response.status_code
+  return response
+
+def record_request(exception=None):
+  metrics = g.pop("metrics", None)
+  if metrics is None:
+    return
+  seconds = time.perf_counter() - metrics.start
+  if isinstance(metrics.profiler, cProfile.Profile):
+    metrics.profiler.disable()
+  elif metrics.profiler is not None:
+    metrics.profiler.stop()
+
+  endpoint = request.endpoint or "unmatched"
+  requests_total.inc((endpoint, request.method, str(metrics.status)))
+  request_duration.observe((endpoint, request.method), seconds)
+  request_queries.observe((endpoint,), metrics.queries)
+  request_query_duration.observe((endpoint,), metrics.query_time)
+  request_render_duration.observe((endpoint,), metrics.render_time)
+
+  if metrics.statements is not None and seconds * 1000 >= current_app.config["SLOW_REQUEST_MS"]:
+    try:
+      path = slow_request_report(metrics, seconds)
+      logger.warning("slow request %s %s took %.1f ms with %d SQL statements, report in %s", request.method, request.full_path, seconds * 1000, metrics.queries, path)
+    except Exception:
+      logger.exception("writing the slow request report failed")
+
+def init_metrics(app):
+  """
+  Record latency, SQL and template render time of every request, and if
+  SLOW_REQUEST_MS is set, write a report of the requests slower than it.
+  """
+  profiler = app.config["SLOW_REQUEST_PROFILER"]
+  if profiler not in ("cprofile", "pyinstrument", "none"):
+    raise ValueError("unsupported SLOW_REQUEST_PROFILER %r" % profiler)
+  if profiler == "pyinstrument" and pyinstrument is None:
+    raise ValueError("SLOW_REQUEST_PROFILER=pyinstrument needs the pyinstrument package")
+
+  app.before_request(start_request)
+  app.after_request(finish_request)
+  app.teardown_request(record_request)
+  before_render_template.connect(start_render, app)
+  template_rendered.connect(end_render, app)
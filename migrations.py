@@ -0,0 +1,127 @@
+from sqlalchemy import inspect, text, bindparam
+
+from models import db
+from search import rebuild_search_index, index_monument_ids
+from httpcache import bump
+from geo import rebuild_geo_index
+from ratings import recompute_ratings
+
+# Registered schema migrations as (version, function), applied in version order
+MIGRATIONS = []
+
+def migration(version):
+  """Register a function as the schema migration that brings the database to version."""
+  def register(f):
+    MIGRATIONS.append((version, f))
+    MIGRATIONS.sort(key=lambda m: m[0])
+    return f
+  return register
+
+def head():
+  """Return the latest schema version."""
+  return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def get_version(conn):
+  conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+  version = conn.exec_driver_sql("SELECT MAX(version) FROM schema_version").scalar()
+  return version or 0
+
+def set_version(conn, version):
+  conn.exec_driver_sql("DELETE FROM schema_version")
+  conn.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), {"version": version})
+
+def upgrade(conn):
+  """Apply every migration newer than the database's schema version, returning the versions applied."""
+  current = get_version(conn)
+  applied = []
+  for version, f in MIGRATIONS:
+    if version > current:
+      f(conn)
+      set_version(conn, version)
+      applied.append(version)
+  return applied
+
+def init_db():
+  """
+  Create missing tables and bring an existing database up to the latest schema version.
+
+  A brand new database is created from the models, which already match the latest
+  schema, so it is only stamped with the head version.
+  """
+  fresh = not inspect(db.engine).has_table("monument")
+  # Only the primary, a read replica gets the schema from the primary
+  db.create_all(bind_key=None)
+
+  with db.engine.begin() as conn:
+    if fresh:
+      get_version(conn)
+      set_version(conn, head())
+      return []
+    return upgrade(conn)
+
+@migration(1)
+def add_listing_indexes(conn):
+  """Index the columns list pages filter and sort on."""
+  for statement in [
+    "CREATE INDEX IF NOT EXISTS ix_monument_listing ON monument (isdeleted, isapproved, name, id)",
+    "CREATE INDEX IF NOT EXISTS ix_monument_stateid ON monument (stateid)",
+    "CREATE INDEX IF NOT EXISTS ix_monument_agencyid ON monument (agencyid)",
+    "CREATE INDEX IF NOT EXISTS ix_state_listing ON state (isdeleted, name)",
+    "CREATE INDEX IF NOT EXISTS ix_agency_name ON agency (name)",
+    "CREATE INDEX IF NOT EXISTS ix_visit_monumentid ON visit (monumentid)",
+  ]:
+    conn.exec_driver_sql(statement)
+
+@migration(2)
+def build_search_index(conn):
+  """Create and fill the monument full-text search index."""
+  rebuild_search_index(conn)
+
+@migration(3)
+def build_geo_index(conn):
+  """Create and fill the monument R*Tree spatial index."""
+  rebuild_geo_index(conn)
+
+@migration(4)
+def build_ratings(conn):
+  """Fill the monument and state rating aggregates from existing visits."""
+  recompute_ratings(conn)
+
+@migration(5)
+def add_visit_recent_index(conn):
+  """Index a user's visits by date for the visited monuments page."""
+  conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_visit_user_recent ON visit (userid, visitedon, monumentid)")
+
+def rename_duplicates(conn, table):
+  """
+  Give every row whose name an older row already has a unique name, "<name> (<id>)",
+  returning the ids of the renamed rows.
+  """
+  renamed = []
+  while True:
+    ids = [id for id, in conn.execute(text(
+      "SELECT id FROM %s WHERE id NOT IN (SELECT MIN(id) FROM %s GROUP BY name)" % (table, table)
+    ))]
+    if not ids:
+      return renamed
+    conn.execute(text(
+      "UPDATE %s SET name = name || ' (' || CAST(id AS VARCHAR(20)) || ')' WHERE id IN :ids" % table
+    ).bindparams(bindparam("ids", expanding=True)), {"ids": ids})
+    renamed.extend(ids)
+
+@migration(6)
+def add_unique_names(conn):
+  """Rename duplicate agency, state and monument names and make the names unique."""
+  for table in ["agency", "state", "monument"]:
+    renamed = rename_duplicates(conn, table)
+    if renamed:
+      bump(conn, table)
+    if table == "monument":
+      index_monument_ids(conn, renamed)
+  for statement in [
+    "DROP INDEX IF EXISTS ix_agency_name",
+    "CREATE UNIQUE INDEX ix_agency_name ON agency (name)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_state_name ON state (name)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_monument_name ON monument (name)",
+  ]:
+    conn.exec_driver_sql(statement)
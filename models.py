@@ -9,6 +9,11 @@ class Agency(db.Model):
   id = db.Column(db.Integer, primary_key=True) # autoincrement=True
   name = db.Column(db.String(200), nullable=False)
   department = db.Column(db.String(200), nullable=False)
+  # Read only, so deleting an agency never rewrites its monuments
+  monuments = relationship("Monument", back_populates="agency", viewonly=True)
+  __table_args__ = (
+        db.Index("ix_agency_name", "name", unique=True),
+  )
 
   def __repr__(self):
     return '<Task %r>' % self.id
@@ -20,7 +25,12 @@ class State(db.Model):
   deletedon = db.Column(db.Date, nullable=True)
   createdon = db.Column(db.Date, default=datetime.date(datetime.now()))
   createdby = db.Column(db.String(100), nullable=False)
-  monuments = relationship("Monument")
+  monuments = relationship("Monument", back_populates="state", viewonly=True)
+  rating = relationship("StateRating", uselist=False, viewonly=True)
+  __table_args__ = (
+        db.Index("ix_state_listing", "isdeleted", "name"),
+        db.Index("ix_state_name", "name", unique=True),
+  )
 
 class Monument(db.Model):
   id = db.Column(db.Integer, primary_key=True)
@@ -38,6 +48,18 @@ class Monument(db.Model):
   createdby = db.Column(db.String(100), nullable=False)
   isdeleted = db.Column(db.Boolean, default=0)
   deletedon = db.Column(db.Date, nullable=True)
+  agency = relationship("Agency", back_populates="monuments")
+  state = relationship("State", back_populates="monuments")
+  # Read only, so deleting a monument never tries to blank out the primary key of its visits
+  visits = relationship("Visit", back_populates="monument", viewonly=True)
+  rating = relationship("MonumentRating", uselist=False, viewonly=True)
+  __table_args__ = (
+        # Serves the approved/pending list filters and the keyset (name, id) ordering
+        db.Index("ix_monument_listing", "isdeleted", "isapproved", "name", "id"),
+        db.Index("ix_monument_stateid", "stateid"),
+        db.Index("ix_monument_agencyid", "agencyid"),
+        db.Index("ix_monument_name", "name", unique=True),
+  )
 
 class User(db.Model):
   id = db.Column(db.Integer, primary_key=True)
@@ -56,7 +78,65 @@ class Visit(db.Model):
   visitedon = db.Column(db.Date, default=datetime.date(datetime.now()))
   grade = db.Column(db.Integer, nullable=False)
   comment = db.Column(db.String(500), nullable=False)
+  monument = relationship("Monument", back_populates="visits")
   __table_args__ = (
+        # The primary key also serves lookups by userid
         PrimaryKeyConstraint(userid, monumentid),
+        db.Index("ix_visit_monumentid", "monumentid"),
+        # Serves the visited monuments page, newest visits first
+        db.Index("ix_visit_user_recent", "userid", "visitedon", "monumentid"),
         {},
-  )
\ No newline at end of file
+  )
+
+class RatingColumns:
+  """Visit count, grade sum and grade histogram shared by the rating aggregate tables."""
+  visits = db.Column(db.Integer, nullable=False, default=0)
+  gradesum = db.Column(db.Integer, nullable=False, default=0)
+  grade1 = db.Column(db.Integer, nullable=False, default=0)
+  grade2 = db.Column(db.Integer, nullable=False, default=0)
+  grade3 = db.Column(db.Integer, nullable=False, default=0)
+  grade4 = db.Column(db.Integer, nullable=False, default=0)
+  grade5 = db.Column(db.Integer, nullable=False, default=0)
+  grade6 = db.Column(db.Integer, nullable=False, default=0)
+
+  def average(self):
+    return self.gradesum / self.visits if self.visits else None
+
+  def histogram(self):
+    return [(grade, getattr(self, "grade%d" % grade)) for grade in range(1, 7)]
+
+class MonumentRating(RatingColumns, db.Model):
+  monumentid = db.Column(db.Integer, db.ForeignKey('monument.id'), primary_key=True)
+
+class StateRating(RatingColumns, db.Model):
+  stateid = db.Column(db.Integer, db.ForeignKey('state.id'), primary_key=True)
+
+class EntityVersion(db.Model):
+  """Write counter per table, bumped in the same transaction as every change to the table."""
+  name = db.Column(db.String(50), primary_key=True)
+  version = db.Column(db.Integer, nullable=False, default=0)
+  updatedon = db.Column(db.DateTime, nullable=False)
+
+class Media(db.Model):
+  """Outcome of fetching an image url, the sha256 of the stored image or the error that prevented it."""
+  url = db.Column(db.String(512), primary_key=True)
+  hash = db.Column(db.String(64), nullable=True)
+  error = db.Column(db.String(200), nullable=True)
+  fetchedon = db.Column(db.DateTime, nullable=False)
+
+class MonumentNeighbour(db.Model):
+  """The monuments most similar to a monument by who visited both and how they graded them, best first."""
+  monumentid = db.Column(db.Integer, db.ForeignKey('monument.id'), primary_key=True)
+  rank = db.Column(db.Integer, primary_key=True)
+  neighbourid = db.Column(db.Integer, db.ForeignKey('monument.id'), nullable=False)
+  score = db.Column(db.Float, nullable=False)
+  __table_args__ = (
+        # Finds the monuments whose lists name a monument whose visits changed
+        db.Index("ix_monument_neighbour_neighbourid", "neighbourid"),
+  )
+
+class NeighbourSource(db.Model):
+  """Visit aggregates of every listed monument as of the last neighbour build, to find what changed since."""
+  monumentid = db.Column(db.Integer, primary_key=True)
+  visits = db.Column(db.Integer, nullable=False)
+  gradesum = db.Column(db.Integer, nullable=False)
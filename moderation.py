@@ -0,0 +1,99 @@
+from datetime import datetime
+from sqlalchemy import select, update, func, or_, and_
+
+from models import Monument, db
+from queries import EXCERPT_LENGTH, decode_cursor, cards_page
+from search import index_monument_ids
+from geo import index_location_ids
+from httpcache import bump
+from dashboard import invalidate_stats
+from fragments import invalidate_fragments
+from visits import forget_listed
+
+ACTIONS = ["approve", "decline"]
+
+# Most ids one moderation request may change, well below SQLite's bound parameter limit
+MAX_BATCH = 1000
+
+def pending_page(after=None, limit=24):
+  """Return one page of monuments waiting for approval ordered by (name, id), and the cursor of the next page."""
+  statement = select(
+    Monument.id,
+    Monument.name,
+    Monument.imageurl,
+    func.substr(Monument.description, 1, EXCERPT_LENGTH).label("excerpt"),
+    Monument.createdon,
+  ).where(Monument.isdeleted == 0, Monument.isapproved == 0)
+
+  if after:
+    name, id = decode_cursor(after)
+    statement = statement.where(or_(Monument.name > name, and_(Monument.name == name, Monument.id > id)))
+
+  rows = db.session.execute(statement.order_by(Monument.name, Monument.id).limit(limit + 1)).all()
+  return cards_page(rows, limit)
+
+def pending_to_dict(row):
+  return dict(id=row.id, name=row.name, imageurl=row.imageurl, excerpt=row.excerpt, createdon=row.createdon.isoformat() if row.createdon else None)
+
+def parse_ids(values):
+  """Turn submitted ids into a list of unique ints in their order, raising ValueError for anything else."""
+  ids = []
+  for value in values:
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).isdigit():
+      raise ValueError("ids must be monument ids")
+    if int(value) not in ids:
+      ids.append(int(value))
+  if not ids:
+    raise ValueError("select at least one monument")
+  if len(ids) > MAX_BATCH:
+    raise ValueError("at most %d monuments can be moderated at once" % MAX_BATCH)
+  return ids
+
+def moderate(action, ids):
+  """
+  Approve or decline pending monuments with a single UPDATE in one transaction.
+
+  Returns [(id, result)] in the order of ids, the result is "approved" or "declined"
+  for the monuments this call changed, else "already_approved", "already_declined"
+  or "not_found".
+  """
+  if action not in ACTIONS:
+    raise ValueError("unsupported action %r" % action)
+
+  pending = and_(Monument.id.in_(ids), Monument.isdeleted == 0, Monument.isapproved == 0)
+  if action == "approve":
+    values = dict(isapproved=1)
+  else:
+    values = dict(isdeleted=1, deletedon=datetime.date(datetime.now()))
+
+  with db.engine.begin() as conn:
+    # RETURNING names exactly the rows this statement changed, even with other moderators at work
+    changed = set(conn.execute(update(Monument).where(pending).values(**values).returning(Monument.id)).scalars())
+    others = dict((row.id, row) for row in conn.execute(
+      select(Monument.id, Monument.isapproved, Monument.isdeleted).where(Monument.id.in_(set(ids) - changed))
+    )) if len(changed) < len(ids) else {}
+
+    if changed:
+      # Set-based writes bypass the mapper events that keep the search and spatial indexes in sync
+      index_monument_ids(conn, list(changed))
+      index_location_ids(conn, list(changed))
+      bump(conn, "monument")
+
+  if changed:
+    invalidate_stats()
+    invalidate_fragments("monuments", "states")
+    if action == "decline":
+      forget_listed(changed)
+
+  results = []
+  for id in ids:
+    if id in changed:
+      result = "approved" if action == "approve" else "declined"
+    elif id not in others:
+      result = "not_found"
+    elif others[id].isdeleted:
+      result = "already_declined"
+    else:
+      result = "already_approved"
+    results.append((id, result))
+  return results
@@ -0,0 +1,146 @@
+import hashlib
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import current_app, request
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from throttle import Throttle
+
+try:
+  import argon2
+except ImportError:
+  argon2 = None
+
+METHODS = ["scrypt"] + (["argon2"] if argon2 else [])
+
+class HasherBusy(Exception):
+  """Raised when the hashing pool already has as many waiting jobs as it may queue, or a job waited longer than the timeout."""
+
+def check_legacy_hash(stored, password):
+  """Check a "sha256$salt$hmac" hash written by generate_password_hash(password, "sha256") of Werkzeug < 3."""
+  _, salt, digest = stored.split("$", 2)
+  expected = hmac.new(salt.encode("utf-8"), password.encode("utf-8"), hashlib.sha256).hexdigest()
+  return hmac.compare_digest(expected, digest)
+
+class PasswordHasher:
+  """
+  Hash and verify passwords on a bounded pool of threads.
+
+  scrypt and argon2 release the GIL while they run, so the pool size is the number
+  of cores hashing may use at once. At most queue more jobs wait for a thread,
+  further callers get HasherBusy instead of piling up behind them.
+  """
+
+  def __init__(self, method="scrypt", workers=2, queue=16, timeout=10, scrypt=(2 ** 15, 8, 1), argon2_params=None):
+    if method not in METHODS:
+      raise ValueError("unsupported password hash method %r" % method)
+    self.method = method
+    self.timeout = timeout
+    self.scrypt_method = "scrypt:%d:%d:%d" % scrypt
+    if argon2:
+      self.argon2 = argon2.PasswordHasher(**(argon2_params or {}))
+    self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+    self._slots = threading.BoundedSemaphore(workers + queue)
+    self._dummy = None
+
+  def run(self, f, *args):
+    if not self._slots.acquire(blocking=False):
+      raise HasherBusy()
+    try:
+      future = self._pool.submit(f, *args)
+    except BaseException:
+      self._slots.release()
+      raise
+    future.add_done_callback(lambda future: self._slots.release())
+    try:
+      return future.result(self.timeout)
+    except TimeoutError:
+      # A job that has not started yet gives its slot back at once
+      future.cancel()
+      raise HasherBusy() from None
+
+  def _hash(self, password):
+    if self.method == "argon2":
+      return self.argon2.hash(password)
+    return generate_password_hash(password, self.scrypt_method)
+
+  def _verify(self, stored, password):
+    if stored.startswith("$argon2"):
+      if not argon2:
+        return False
+      try:
+        return self.argon2.verify(stored, password)
+      except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+        return False
+    if stored.startswith("sha256$"):
+      return check_legacy_hash(stored, password)
+    try:
+      return check_password_hash(stored, password)
+    except ValueError:
+      return False
+
+  def needs_rehash(self, stored):
+    """Whether a hash was made with another method or cost than the configured one."""
+    if self.method == "argon2":
+      return not stored.startswith("$argon2") or self.argon2.check_needs_rehash(stored)
+    return not stored.startswith(self.scrypt_method + "$")
+
+  def _check(self, stored, password):
+    if stored is None:
+      # Unknown users cost as much as known ones, so timing does not reveal usernames
+      self._verify(self._dummy, password)
+      return False, None
+    if not self._verify(stored, password):
+      return False, None
+    return True, self._hash(password) if self.needs_rehash(stored) else None
+
+  def hash(self, password):
+    """Return a new hash of password, computed on the pool."""
+    return self.run(self._hash, password)
+
+  def check(self, stored, password):
+    """
+    Verify password against a stored hash, None for an unknown user.
+
+    Returns (ok, new hash), the new hash is set when the stored one uses a legacy
+    method or an outdated cost and should replace it.
+    """
+    if self._dummy is None:
+      self._dummy = self.hash("dummy password")
+    return self.run(self._check, stored, password)
+
+def init_passwords(app):
+  """Create the password hasher and the login throttles from the PASSWORD_* and LOGIN_* settings."""
+  config = app.config
+  app.extensions["password_hasher"] = PasswordHasher(
+    method=config["PASSWORD_HASH_METHOD"],
+    workers=config["PASSWORD_HASH_WORKERS"],
+    queue=config["PASSWORD_HASH_QUEUE"],
+    timeout=config["PASSWORD_HASH_TIMEOUT"],
+    scrypt=(config["PASSWORD_SCRYPT_N"], config["PASSWORD_SCRYPT_R"], config["PASSWORD_SCRYPT_P"]),
+    argon2_params=dict(
+      time_cost=config["PASSWORD_ARGON2_TIME_COST"],
+      memory_cost=config["PASSWORD_ARGON2_MEMORY_COST"],
+      parallelism=config["PASSWORD_ARGON2_PARALLELISM"],
+    ),
+  )
+  app.extensions["login_throttles"] = dict(
+    ip=Throttle(config["LOGIN_IP_LIMIT"], config["LOGIN_IP_WINDOW"]),
+    username=Throttle(config["LOGIN_USER_LIMIT"], config["LOGIN_USER_WINDOW"]),
+  )
+
+def get_hasher():
+  return current_app.extensions["password_hasher"]
+
+def throttle_wait(username=None):
+  """
+  Count an attempt from the client's address and for username, returning the seconds to wait or 0.
+
+  Behind a reverse proxy the address is only the client's when TRUSTED_PROXY_HOPS is set.
+  """
+  throttles = current_app.extensions["login_throttles"]
+  wait = throttles["ip"].hit(request.remote_addr)
+  if not wait and username is not None:
+    wait = throttles["username"].hit(username.lower())
+  return wait
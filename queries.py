@@ -0,0 +1,241 @@
+import base64
+import json
+import time
+from datetime import date
+from types import SimpleNamespace
+from flask import session
+from sqlalchemy import select, func, or_, and_, event
+from sqlalchemy.orm import joinedload, Session
+
+from models import Monument, MonumentRating, State, Visit, db
+from cache import TTLCache
+from helpers import get_user_id_from_session
+from database import read_session
+from media import image_sources
+from ratings import rating_epoch
+
+# Number of description characters shown on a monument card
+EXCERPT_LENGTH = 100
+
+# Queued visits kept in the session for read-your-writes, and for how many seconds
+# at most, long after a visit queue has written or rejected them
+MAX_QUEUED_VISITS = 50
+QUEUED_VISIT_TTL = 600
+
+def encode_cursor(name, id):
+  """Encode the (name, id) keyset position of a row as an opaque url-safe token."""
+  raw = json.dumps([name, id]).encode("utf-8")
+  return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_cursor(token):
+  """Decode a token created by encode_cursor, raising ValueError if it is malformed."""
+  try:
+    name, id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+  except Exception:
+    raise ValueError("invalid cursor")
+  if not isinstance(name, str) or not isinstance(id, int):
+    raise ValueError("invalid cursor")
+  return name, id
+
+def monument_cards_statement(after=None):
+  """
+  Build the select of approved monument cards ordered by (name, id), starting after the given cursor.
+
+  Only the columns a card renders are selected; the description is cut down to an
+  excerpt by the database so the full text is never loaded for list pages.
+  """
+  statement = select(
+    Monument.id,
+    Monument.name,
+    Monument.imageurl,
+    func.substr(Monument.description, 1, EXCERPT_LENGTH).label("excerpt"),
+    MonumentRating.visits,
+    (MonumentRating.gradesum * 1.0 / MonumentRating.visits).label("average"),
+  ).outerjoin(MonumentRating, MonumentRating.monumentid == Monument.id) \
+    .where(Monument.isdeleted == 0, Monument.isapproved == 1)
+
+  if after:
+    name, id = decode_cursor(after)
+    statement = statement.where(or_(Monument.name > name, and_(Monument.name == name, Monument.id > id)))
+
+  return statement.order_by(Monument.name, Monument.id)
+
+def cards_page(rows, limit):
+  """Cut the limit + 1 rows of a card query down to one page and the cursor of the next page."""
+  next = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next = encode_cursor(rows[-1].name, rows[-1].id)
+  return rows, next
+
+def monument_cards(after=None, limit=24):
+  """Return one page of approved monument cards and the cursor of the next page."""
+  # Fetch one extra row to know whether there is a next page
+  rows = read_session().execute(monument_cards_statement(after).limit(limit + 1)).all()
+  return cards_page(rows, limit)
+
+def card_to_dict(row, visited=False):
+  average = round(row.average, 2) if row.average is not None else None
+  return dict(id=row.id, name=row.name, imageurl=row.imageurl, image=image_sources(row.imageurl), excerpt=row.excerpt, visits=row.visits or 0, average=average, visited=visited)
+
+def monument_details_statement(id, userid, visited=True):
+  """
+  Select a monument with its agency, state, ratings and, if visited says the user
+  has been there, the user's visit in one joined query.
+  """
+  options = [
+    joinedload(Monument.agency),
+    joinedload(Monument.state).joinedload(State.rating),
+    joinedload(Monument.rating),
+  ]
+
+  if not visited:
+    return select(Monument).options(*options).where(Monument.id == id)
+
+  return select(Monument, Visit) \
+    .outerjoin(Visit, and_(Visit.monumentid == Monument.id, Visit.userid == userid)) \
+    .options(*options) \
+    .where(Monument.id == id)
+
+def details_row(row):
+  """Turn a row of monument_details_statement into (monument, visit), (None, None) if there is no row."""
+  if row is None:
+    return None, None
+  return row[0], row[1] if len(row) > 1 else None
+
+def monument_details(id, userid, visited=True):
+  """Return (monument, visit), or (None, None) if the monument does not exist."""
+  return details_row(db.session.execute(monument_details_statement(id, userid, visited)).first())
+
+def visited_cards(userid, after=None, limit=24):
+  """
+  Return one page of the user's visited monuments with the grade and date of each visit, newest visits first.
+
+  The page and the cursor of the next one come from a single joined query keyed on (visitedon, monumentid),
+  visits still waiting in a visit queue are merged in.
+  """
+  query = db.session.query(
+    Monument.id,
+    Monument.name,
+    Monument.imageurl,
+    func.substr(Monument.description, 1, EXCERPT_LENGTH).label("excerpt"),
+    Visit.grade,
+    Visit.visitedon,
+  ).join(Monument, Monument.id == Visit.monumentid) \
+    .filter(Visit.userid == userid, Monument.isdeleted == 0)
+
+  position = None
+  if after:
+    visitedon, id = decode_cursor(after)
+    position = (date.fromisoformat(visitedon), id)
+    query = query.filter(or_(Visit.visitedon < position[0], and_(Visit.visitedon == position[0], Visit.monumentid < id)))
+
+  rows = query.order_by(Visit.visitedon.desc(), Visit.monumentid.desc()).limit(limit + 1).all()
+
+  queued = [row for row in queued_visit_rows(userid) if position is None or (row.visitedon, row.id) < position]
+  if queued:
+    written = set(row.id for row in rows)
+    rows = sorted(rows + [row for row in queued if row.id not in written], key=lambda row: (row.visitedon, row.id), reverse=True)
+
+  next = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next = encode_cursor(rows[-1].visitedon.isoformat(), rows[-1].id)
+
+  return rows, next
+
+def queued_visits(userid):
+  """
+  Return the visits the session's user made that may still wait in a visit queue,
+  as {monumentid: (grade, comment, visitedon)}.
+
+  They are kept in the session, which every worker shares, so the user sees them
+  whichever worker serves the next request.
+  """
+  if userid is None or userid != session.get("user_id"):
+    return {}
+  oldest = time.time() - QUEUED_VISIT_TTL
+  return dict(
+    (monumentid, (grade, comment, date.fromisoformat(visitedon)))
+    for monumentid, grade, comment, visitedon, queuedon in session.get("queued_visits", ()) if queuedon >= oldest
+  )
+
+def remember_queued_visit(monumentid, grade, comment, visitedon):
+  """Record a queued visit of the session's user until it is found in the database."""
+  oldest = time.time() - QUEUED_VISIT_TTL
+  entries = [entry for entry in session.get("queued_visits", ()) if entry[4] >= oldest and entry[0] != monumentid]
+  entries.append([monumentid, grade, comment, visitedon.isoformat(), time.time()])
+  session["queued_visits"] = entries[-MAX_QUEUED_VISITS:]
+
+def forget_queued_visits(ids):
+  """Drop the session's queued visits of the given monuments, once they are in the database."""
+  session["queued_visits"] = [entry for entry in session.get("queued_visits", ()) if entry[0] not in ids]
+
+def queued_visit(userid, monumentid):
+  """Return a queued visit of the session's user as a Visit-like object, or None."""
+  visit = queued_visits(userid).get(monumentid)
+  if visit is None:
+    return None
+  grade, comment, visitedon = visit
+  return SimpleNamespace(userid=userid, monumentid=monumentid, grade=grade, comment=comment, visitedon=visitedon)
+
+def queued_visit_rows(userid):
+  """Return visited_cards rows of the session user's queued visits."""
+  queued = queued_visits(userid)
+  if not queued:
+    return []
+  rows = db.session.query(
+    Monument.id,
+    Monument.name,
+    Monument.imageurl,
+    func.substr(Monument.description, 1, EXCERPT_LENGTH).label("excerpt"),
+  ).filter(Monument.id.in_(queued), Monument.isdeleted == 0).all()
+  return [SimpleNamespace(
+    id=row.id, name=row.name, imageurl=row.imageurl, excerpt=row.excerpt, grade=queued[row.id][0], visitedon=queued[row.id][2],
+  ) for row in rows]
+
+# Ids of the monuments each user has visited, keyed by user id
+visited_cache = TTLCache(ttl=300, maxsize=10000)
+
+def recorded_visit_ids(userid):
+  """Return the set of monument ids of the user's visits in the database, loaded once and kept in sync by Visit events."""
+  ids = visited_cache.get(userid)
+  if ids is None:
+    ids = frozenset(id for id, in db.session.query(Visit.monumentid).filter(Visit.userid == userid))
+    visited_cache.set(userid, ids)
+  return ids
+
+def visited_ids(userid):
+  """Return the set of monument ids the user has visited, including visits still queued."""
+  ids = recorded_visit_ids(userid)
+  queued = queued_visits(userid)
+  if not queued:
+    return ids
+  if not ids.isdisjoint(queued):
+    forget_queued_visits(ids)
+  return ids | frozenset(queued)
+
+@event.listens_for(Session, "after_flush")
+def collect_visitors(session, flush_context):
+  for obj in list(session.new) + list(session.deleted):
+    if isinstance(obj, Visit):
+      session.info.setdefault("visitors", set()).add(int(obj.userid))
+
+# Invalidate after commit so a concurrent reload cannot cache the set without the new visit
+@event.listens_for(Session, "after_commit")
+def invalidate_visited_ids(session):
+  for userid in session.info.pop("visitors", ()):
+    visited_cache.pop(userid)
+
+@event.listens_for(Session, "after_rollback")
+def forget_visitors(session):
+  session.info.pop("visitors", None)
+
+def visited_fingerprint():
+  """Part of the ETag of pages that mark the monuments the user has visited."""
+  visited = visited_ids(get_user_id_from_session())
+  return (len(visited), hash(visited))
+
+def rated_fingerprint():
+  """Part of the ETag of pages that mark the user's visits and show the ratings of the monuments."""
+  return (visited_fingerprint(), rating_epoch())
@@ -0,0 +1,58 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+
+from models import Monument, User, db
+
+# Maximum SQL statements per request once per-process caches are warm,
+# conditional routes spend one of them on reading table versions
+QUERY_BUDGETS = {
+  "/": 0,
+  "/monuments": 2,
+  "/api/monuments": 2,
+  "/monuments/search?q=monument": 2,
+  "/api/monuments/top": 2,
+  "/monument/details/<monument>": 2,
+  "/monument/visited": 2,
+  "/agencies": 2,
+}
+
+@contextmanager
+def count_queries(engine):
+  """Collect every SQL statement the engine executes inside the block."""
+  statements = []
+
+  def record(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+  event.listen(engine, "before_cursor_execute", record)
+  try:
+    yield statements
+  finally:
+    event.remove(engine, "before_cursor_execute", record)
+
+def check_query_budgets(app, budgets=QUERY_BUDGETS):
+  """
+  Request every route of budgets as an admin user and return (route, count, budget, statements) for each one over budget.
+
+  Each route is requested twice and only the second, warm request is counted.
+  """
+  with app.app_context():
+    admin = db.session.query(User.id).filter(User.isadmin == 1).order_by(User.id).first()
+    monument = db.session.query(Monument.id).filter(Monument.isdeleted == 0, Monument.isapproved == 1).order_by(Monument.id).first()
+    engine = db.engine
+  if not admin or not monument:
+    raise RuntimeError("the database needs an admin user and an approved monument to check query budgets")
+
+  client = app.test_client()
+  with client.session_transaction() as session:
+    session["user_id"] = admin.id
+
+  problems = []
+  for route, budget in budgets.items():
+    url = route.replace("<monument>", str(monument.id))
+    client.get(url)
+    with count_queries(engine) as statements:
+      response = client.get(url)
+    if response.status_code >= 400 or len(statements) > budget:
+      problems.append((route, len(statements), budget, statements))
+  return problems
@@ -0,0 +1,44 @@
+from models import Agency, State, Monument, User, Visit, db
+from queries import monument_cards_statement, encode_cursor
+from recommendations import recommendations_statement
+
+def hot_queries():
+  """Return (name, statement) pairs for the queries behind the busiest routes."""
+  return [
+    ("monuments first page", monument_cards_statement().limit(25)),
+    ("monuments next page", monument_cards_statement(encode_cursor("M", 1)).limit(25)),
+    ("pending monuments", db.session.query(Monument.id, Monument.name).filter(Monument.isdeleted == 0, Monument.isapproved == 0).order_by(Monument.name).statement),
+    ("states list", db.session.query(State.id, State.name).filter(State.isdeleted == 0).order_by(State.name).statement),
+    ("agency by name", db.session.query(Agency.id).filter(Agency.name == "x").statement),
+    ("user by username", db.session.query(User.id).filter(User.username == "x").statement),
+    ("visits by user", db.session.query(Visit.monumentid).filter(Visit.userid == 1).statement),
+    ("monument recommendations", recommendations_statement(1)),
+  ]
+
+def explain(statement):
+  """Return the EXPLAIN QUERY PLAN detail lines of a statement."""
+  sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+  with db.engine.connect() as conn:
+    return [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+
+def explain_sql(engine, statement, parameters):
+  """Return the plan of a SQL statement as it was executed, with its parameters; only selects are explained."""
+  if not statement.lstrip().upper().startswith(("SELECT", "WITH")) or engine.dialect.is_async:
+    return []
+  sqlite = engine.dialect.name == "sqlite"
+  with engine.connect() as conn:
+    rows = conn.exec_driver_sql(("EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN ") + statement, parameters).all()
+  return [row[-1] if sqlite else row[0] for row in rows]
+
+def is_full_scan(detail):
+  """A plain "SCAN <table>" without an index reads every row, and a temp b-tree means an unindexed sort."""
+  return (detail.startswith("SCAN") and "USING" not in detail) or "TEMP B-TREE" in detail
+
+def check_query_plans():
+  """Return (name, detail) for every hot query step that falls back to a full scan or sort."""
+  problems = []
+  for name, statement in hot_queries():
+    for detail in explain(statement):
+      if is_full_scan(detail):
+        problems.append((name, detail))
+  return problems
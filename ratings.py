@@ -0,0 +1,138 @@
+import time
+
+from sqlalchemy import event, text, inspect, select
+
+from models import Monument, Visit, MonumentRating
+from database import read_session
+
+GRADES = range(1, 7)
+COLUMNS = ["visits", "gradesum"] + ["grade%d" % grade for grade in GRADES]
+
+# Aggregate table and key column for each level of aggregation
+MONUMENT = ("monument_rating", "monumentid")
+STATE = ("state_rating", "stateid")
+
+# Pages shared by all users show ratings at most this many seconds old, so check-ins do not invalidate them
+RATING_REFRESH = 60
+
+def grade_counts(grade):
+  """Return the aggregate counts contributed by one visit with the given grade."""
+  counts = dict(visits=1, gradesum=grade)
+  for g in GRADES:
+    counts["grade%d" % g] = int(g == grade)
+  return counts
+
+def add_counts(conn, level, id, counts, sign=1):
+  """Add (or with sign=-1 subtract) counts to the aggregate row of id, creating it if needed."""
+  table, key = level
+  params = dict((column, sign * counts[column]) for column in COLUMNS)
+  params["id"] = id
+  conn.execute(text(
+    "INSERT INTO %s (%s, %s) VALUES (:id, %s) ON CONFLICT (%s) DO UPDATE SET %s" % (
+      table, key, ", ".join(COLUMNS), ", ".join(":" + column for column in COLUMNS), key,
+      ", ".join("%s = %s + excluded.%s" % (column, column, column) for column in COLUMNS),
+    )
+  ), params)
+
+def state_of(conn, monumentid):
+  return conn.execute(text("SELECT stateid FROM monument WHERE id = :id"), {"id": monumentid}).scalar()
+
+def add_visit(conn, monumentid, grade, sign=1):
+  counts = grade_counts(int(grade))
+  add_counts(conn, MONUMENT, monumentid, counts, sign)
+  stateid = state_of(conn, monumentid)
+  if stateid is not None:
+    add_counts(conn, STATE, stateid, counts, sign)
+
+# The aggregates are written by the same flush, and so the same transaction, as the visit itself
+@event.listens_for(Visit, "after_insert")
+def visit_added(mapper, connection, target):
+  add_visit(connection, target.monumentid, target.grade)
+
+@event.listens_for(Visit, "after_delete")
+def visit_removed(mapper, connection, target):
+  add_visit(connection, target.monumentid, target.grade, -1)
+
+@event.listens_for(Visit, "after_update")
+def visit_changed(mapper, connection, target):
+  history = inspect(target).attrs.grade.history
+  if history.deleted and history.added and int(history.deleted[0]) != int(history.added[0]):
+    add_visit(connection, target.monumentid, history.deleted[0], -1)
+    add_visit(connection, target.monumentid, history.added[0])
+
+def monument_counts(conn, monumentid):
+  row = conn.execute(text("SELECT %s FROM monument_rating WHERE monumentid = :id" % ", ".join(COLUMNS)), {"id": monumentid}).mappings().first()
+  return dict(row) if row else None
+
+@event.listens_for(Monument, "after_update")
+def monument_moved(mapper, connection, target):
+  """Move a monument's aggregates to its new state when it changes state."""
+  history = inspect(target).attrs.stateid.history
+  if not history.deleted or not history.added or history.deleted[0] is None:
+    return
+  old, new = int(history.deleted[0]), int(history.added[0])
+  if old == new:
+    return
+  counts = monument_counts(connection, target.id)
+  if counts:
+    add_counts(connection, STATE, old, counts, -1)
+    add_counts(connection, STATE, new, counts)
+
+@event.listens_for(Monument, "after_delete")
+def monument_removed(mapper, connection, target):
+  counts = monument_counts(connection, target.id)
+  if counts:
+    add_counts(connection, STATE, target.stateid, counts, -1)
+    connection.execute(text("DELETE FROM monument_rating WHERE monumentid = :id"), {"id": target.id})
+
+def rating_epoch():
+  """Part of the cache keys of pages that show ratings, changes every RATING_REFRESH seconds."""
+  return int(time.time() // RATING_REFRESH)
+
+def top_rated_statement(limit=10, min_visits=1):
+  """Select the approved monuments with the best average grade and their number of visits."""
+  average = MonumentRating.gradesum * 1.0 / MonumentRating.visits
+  return select(Monument.id, Monument.name, Monument.imageurl, MonumentRating.visits, average.label("average")) \
+    .join(MonumentRating, MonumentRating.monumentid == Monument.id) \
+    .where(Monument.isdeleted == 0, Monument.isapproved == 1, MonumentRating.visits >= max(min_visits, 1)) \
+    .order_by(average.desc(), MonumentRating.visits.desc(), Monument.id) \
+    .limit(limit)
+
+def top_rated(limit=10, min_visits=1):
+  return read_session().execute(top_rated_statement(limit, min_visits)).all()
+
+def top_rated_to_dict(row):
+  return dict(id=row.id, name=row.name, imageurl=row.imageurl, visits=row.visits, average=round(row.average, 2))
+
+AGGREGATE_SQL = {
+  MONUMENT: "SELECT monument.id AS id, %s FROM visit JOIN monument ON monument.id = visit.monumentid GROUP BY monument.id",
+  STATE: "SELECT monument.stateid AS id, %s FROM visit JOIN monument ON monument.id = visit.monumentid GROUP BY monument.stateid",
+}
+
+def recompute_ratings(conn, fix=True):
+  """
+  Recompute the aggregates from the visit table and compare them with the stored ones.
+
+  Returns (table, id, stored, expected) for every drifted row; with fix=True the
+  stored aggregates are replaced by the recomputed ones.
+  """
+  select = ", ".join(["COUNT(*) AS visits", "SUM(visit.grade) AS gradesum"] + [
+    "SUM(CASE WHEN visit.grade = %d THEN 1 ELSE 0 END) AS grade%d" % (grade, grade) for grade in GRADES
+  ])
+
+  drift = []
+  for level, sql in AGGREGATE_SQL.items():
+    table, key = level
+    expected = dict((row["id"], dict((column, row[column]) for column in COLUMNS)) for row in conn.execute(text(sql % select)).mappings())
+    stored = dict((row[key], dict((column, row[column]) for column in COLUMNS)) for row in conn.execute(text("SELECT %s, %s FROM %s" % (key, ", ".join(COLUMNS), table))).mappings())
+
+    empty = dict((column, 0) for column in COLUMNS)
+    for id in set(expected) | set(stored):
+      if expected.get(id, empty) != stored.get(id, empty):
+        drift.append((table, id, stored.get(id), expected.get(id)))
+
+    if fix:
+      conn.execute(text("DELETE FROM %s" % table))
+      conn.execute(text("INSERT INTO %s (%s, %s) %s" % (table, key, ", ".join(COLUMNS), sql % select)))
+
+  return drift
@@ -0,0 +1,237 @@
+import itertools
+from sqlalchemy import event, select, delete, insert, func, and_
+
+from models import Monument, MonumentRating, Visit, MonumentNeighbour, NeighbourSource, db
+from httpcache import bump, request_version
+from cache import TTLCache
+from database import read_session
+
+try:
+  import numpy
+  from scipy import sparse
+except ImportError:
+  numpy = sparse = None
+
+# Neighbours stored per monument
+TOP_K = 10
+# Similarity of a pair seen by this many common visitors is halved, so that one
+# visitor's history cannot make two rarely visited monuments look alike
+SHRINKAGE = 5
+# Most similarity entries computed at once, bounds the memory of a block to a few hundred MB
+BLOCK_ENTRIES = 5 * 1000 * 1000
+# Visit rows read and neighbour rows written per round trip
+CHUNK = 500000
+
+LISTED = and_(Monument.isdeleted == 0, Monument.isapproved == 1)
+
+class VisitMatrix:
+  """The grades of every visit of a listed monument as a sparse users × monuments matrix."""
+
+  def __init__(self, conn):
+    self.ids = numpy.array(conn.execute(select(Monument.id).where(LISTED).order_by(Monument.id)).scalars().all(), dtype=numpy.int64)
+
+    # Straight from the driver's cursor, a Row object per visit costs more than the rest of the build
+    statement = select(Visit.userid, Visit.monumentid, Visit.grade).join(Monument, Monument.id == Visit.monumentid).where(LISTED)
+    cursor = conn.connection.dbapi_connection.cursor()
+    cursor.execute(str(statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})))
+    chunks = []
+    while True:
+      rows = cursor.fetchmany(CHUNK)
+      if not rows:
+        break
+      chunks.append(numpy.fromiter(itertools.chain.from_iterable(rows), dtype=numpy.int64, count=3 * len(rows)).reshape(-1, 3))
+    cursor.close()
+    visits = numpy.concatenate(chunks) if chunks else numpy.zeros((0, 3), dtype=numpy.int64)
+    del chunks
+
+    _, users = numpy.unique(visits[:, 0], return_inverse=True)
+    columns = numpy.searchsorted(self.ids, visits[:, 1])
+    shape = (int(users.max()) + 1 if len(users) else 0, len(self.ids))
+    grades = visits[:, 2].astype(numpy.float32)
+    del visits
+    # Row-major for the right side of the products, column-major to slice the monuments of a block
+    self.grades = sparse.csr_matrix((grades, (users, columns)), shape=shape)
+    self.visited = sparse.csr_matrix((numpy.ones(len(grades), dtype=numpy.float32), (users, columns)), shape=shape)
+    del grades, users, columns
+    self.grades_by_monument = self.grades.tocsc()
+    self.visited_by_monument = self.visited.tocsc()
+    self.norms = numpy.sqrt(numpy.asarray(self.grades.multiply(self.grades).sum(axis=0, dtype=numpy.float64)).ravel())
+    # Entries a monument's similarity row takes to compute, the visits of all its visitors
+    degrees = numpy.diff(self.visited.indptr)
+    self.costs = numpy.asarray(self.visited_by_monument.T @ degrees).ravel()
+
+  def columns(self, ids):
+    """Matrix columns of the given monument ids, leaving out the ones that are not listed."""
+    ids = numpy.asarray(sorted(ids), dtype=numpy.int64)
+    columns = numpy.searchsorted(self.ids, ids)
+    found = columns < len(self.ids)
+    found[found] = self.ids[columns[found]] == ids[found]
+    return columns[found]
+
+  def blocks(self, columns):
+    """Split columns into blocks of about BLOCK_ENTRIES similarity entries each."""
+    start = total = 0
+    for i, cost in enumerate(self.costs[columns]):
+      if total and total + cost > BLOCK_ENTRIES:
+        yield columns[start:i]
+        start, total = i, 0
+      total += cost
+    if start < len(columns):
+      yield columns[start:]
+
+  def similarities(self, columns):
+    """
+    Yield (block, scores) for blocks of the given columns, scores a sparse
+    block × monuments matrix of the similarity of every pair of monuments with
+    common visitors.
+
+    The score is the cosine of the two monuments' grade vectors, damped by
+    SHRINKAGE for pairs with few common visitors. A monument's score with itself is 0.
+    """
+    for block in self.blocks(columns):
+      scores = self.grades_by_monument[:, block].T.tocsr() @ self.grades
+      common = self.visited_by_monument[:, block].T.tocsr() @ self.visited
+      # Both products have the same sparsity pattern, grades are never zero
+      scores.sort_indices()
+      common.sort_indices()
+      sources = numpy.repeat(block, numpy.diff(scores.indptr))
+      scores.data *= common.data / (common.data + SHRINKAGE) / (self.norms[sources] * self.norms[scores.indices])
+      scores.data[sources == scores.indices] = 0
+      yield block, scores
+
+def top_k(block, scores, k=TOP_K):
+  """Return [(source, rank, neighbour, score)] of the k best scored neighbours of every source column of a block."""
+  rows = []
+  for i, source in enumerate(block.tolist()):
+    start, end = scores.indptr[i], scores.indptr[i + 1]
+    data, indices = scores.data[start:end], scores.indices[start:end]
+    # Only the k best need sorting, the scores of popular monuments have thousands of entries
+    if end - start > k:
+      # Ties with the k-th score are kept, the lowest neighbour ids win them below
+      best = data >= -numpy.partition(-data, k - 1)[k - 1]
+      data, indices = data[best], indices[best]
+    order = numpy.lexsort((indices, -data))
+    rank = 0
+    for neighbour, score in zip(indices[order].tolist(), data[order].tolist()):
+      if rank < k and score > 0:
+        rows.append((source, rank, neighbour, score))
+        rank += 1
+  return rows
+
+def source_counts(conn):
+  """Return {monumentid: (visits, gradesum)} of every listed monument."""
+  rows = conn.execute(select(Monument.id, func.coalesce(MonumentRating.visits, 0), func.coalesce(MonumentRating.gradesum, 0))
+    .outerjoin(MonumentRating, MonumentRating.monumentid == Monument.id).where(LISTED))
+  return dict((id, (visits, gradesum)) for id, visits, gradesum in rows)
+
+def stored_thresholds(conn, matrix):
+  """Score a new neighbour must beat to enter each monument's stored list, by matrix column."""
+  thresholds = numpy.zeros(len(matrix.ids))
+  rows = conn.execute(select(MonumentNeighbour.monumentid, func.count(), func.min(MonumentNeighbour.score)).group_by(MonumentNeighbour.monumentid)).all()
+  if rows:
+    ids, counts, lowest = (numpy.array(column) for column in zip(*rows))
+    full = (counts >= TOP_K) & numpy.isin(ids, matrix.ids)
+    thresholds[numpy.searchsorted(matrix.ids, ids[full])] = lowest[full]
+  return thresholds
+
+def listers(conn, ids):
+  """Monuments whose stored lists name one of ids."""
+  found = set()
+  ids = list(ids)
+  for i in range(0, len(ids), 900):
+    found.update(conn.execute(select(MonumentNeighbour.monumentid).distinct().where(MonumentNeighbour.neighbourid.in_(ids[i:i + 900]))).scalars())
+  return found
+
+def build_neighbours(full=False, log=lambda message: None):
+  """
+  Bring the stored neighbour lists up to date with the visits and return
+  (monuments recomputed, neighbour rows written).
+
+  A full build computes every list. Otherwise only monuments whose visit
+  aggregates changed since the last build are computed, along with the monuments
+  whose lists those changes can alter: the ones naming a changed monument and the
+  ones a changed monument now scores above their current last neighbour.
+  """
+  if sparse is None:
+    raise RuntimeError("building recommendations needs the numpy and scipy packages")
+
+  # One read transaction, the visits and their aggregates are a consistent snapshot
+  with db.engine.connect() as conn, conn.begin():
+    counts = source_counts(conn)
+    previous = dict((id, (visits, gradesum)) for id, visits, gradesum in conn.execute(select(NeighbourSource.monumentid, NeighbourSource.visits, NeighbourSource.gradesum)))
+    full = full or not previous
+    changed = set(counts) if full else set(id for id in set(counts) | set(previous) if counts.get(id) != previous.get(id))
+    log("%d monuments changed" % len(changed))
+    if not changed:
+      return 0, 0
+
+    matrix = VisitMatrix(conn)
+    log("%d visits of %d monuments loaded" % (matrix.grades.nnz, len(matrix.ids)))
+    rows = []
+    if full:
+      targets = numpy.arange(len(matrix.ids))
+    else:
+      thresholds = stored_thresholds(conn, matrix)
+      affected = set(listers(conn, changed))
+      for block, scores in matrix.similarities(matrix.columns(changed)):
+        rows.extend(top_k(block, scores))
+        # Similarity is symmetric, a changed monument may now enter its neighbours' lists
+        entering = numpy.unique(scores.indices[scores.data >= thresholds[scores.indices]])
+        affected.update(matrix.ids[entering].tolist())
+      targets = matrix.columns(affected - changed)
+
+  for block, scores in matrix.similarities(targets):
+    rows.extend(top_k(block, scores))
+  recomputed = set(changed) | set(matrix.ids[targets].tolist())
+  monument_ids = matrix.ids.tolist()
+  rows = [(monument_ids[source], rank, monument_ids[neighbour], score) for source, rank, neighbour, score in rows]
+  log("%d neighbours of %d monuments computed" % (len(rows), len(recomputed)))
+
+  with db.engine.begin() as conn:
+    if full:
+      conn.execute(delete(MonumentNeighbour))
+      conn.execute(delete(NeighbourSource))
+    else:
+      ids = sorted(recomputed)
+      for i in range(0, len(ids), 900):
+        conn.execute(delete(MonumentNeighbour).where(MonumentNeighbour.monumentid.in_(ids[i:i + 900])))
+      ids = sorted(changed)
+      for i in range(0, len(ids), 900):
+        conn.execute(delete(NeighbourSource).where(NeighbourSource.monumentid.in_(ids[i:i + 900])))
+    for i in range(0, len(rows), CHUNK):
+      conn.execute(insert(MonumentNeighbour), [
+        dict(monumentid=monumentid, rank=rank, neighbourid=neighbourid, score=score) for monumentid, rank, neighbourid, score in rows[i:i + CHUNK]
+      ])
+    sources = [dict(monumentid=id, visits=counts[id][0], gradesum=counts[id][1]) for id in sorted(changed) if id in counts]
+    for i in range(0, len(sources), CHUNK):
+      conn.execute(insert(NeighbourSource), sources[i:i + CHUNK])
+    bump(conn, "recommendation")
+  return len(recomputed), len(rows)
+
+@event.listens_for(Monument, "after_delete")
+def monument_removed(mapper, connection, target):
+  connection.execute(delete(MonumentNeighbour).where((MonumentNeighbour.monumentid == target.id) | (MonumentNeighbour.neighbourid == target.id)))
+  connection.execute(delete(NeighbourSource).where(NeighbourSource.monumentid == target.id))
+
+# Recommendations by (monument id, limit, recommendation and monument versions)
+recommendation_cache = TTLCache(ttl=3600, maxsize=20000)
+
+def recommendations_statement(id, limit=TOP_K):
+  """Select the listed monuments visitors of monument id also went to, most similar first."""
+  return select(Monument.id, Monument.name, Monument.imageurl, MonumentNeighbour.score) \
+    .join(MonumentNeighbour, MonumentNeighbour.neighbourid == Monument.id) \
+    .where(MonumentNeighbour.monumentid == id, LISTED) \
+    .order_by(MonumentNeighbour.rank) \
+    .limit(limit)
+
+def recommendations(id, limit=TOP_K):
+  """Return the monuments visitors of monument id also went to, cached until the lists or the monuments change."""
+  key = (id, limit, request_version("recommendation"), request_version("monument"))
+  rows = recommendation_cache.get(key)
+  if rows is None:
+    rows = read_session().execute(recommendations_statement(id, limit)).all()
+    recommendation_cache.set(key, rows)
+  return rows
+
+def recommendation_to_dict(row):
+  return dict(id=row.id, name=row.name, imageurl=row.imageurl, score=round(row.score, 4))
@@ -0,0 +1,48 @@
+from sqlalchemy import select, func
+
+from models import Agency, State, Monument
+from httpcache import request_version
+from cache import TTLCache
+from database import read_session
+
+# States, agencies and their monument counts, keyed by (name, version of the table they come from)
+reference_cache = TTLCache(ttl=3600, maxsize=16)
+
+def cached(name, table, load):
+  """
+  Return the cached result of load for the current version of table.
+
+  The version changes with every write to the table in any process, the create,
+  edit and delete handlers also clear this process's entries right away.
+  """
+  key = (name, request_version(table))
+  value = reference_cache.get(key)
+  if value is None:
+    value = load()
+    reference_cache.set(key, value)
+  return value
+
+def states():
+  """Return (id, name) of the states that are not deleted, ordered by name."""
+  return cached("states", "state", lambda: read_session().execute(
+    select(State.id, State.name).where(State.isdeleted == 0).order_by(State.name)
+  ).all())
+
+def agencies():
+  """Return (id, name, department) of every agency, ordered by name."""
+  return cached("agencies", "agency", lambda: read_session().execute(
+    select(Agency.id, Agency.name, Agency.department).order_by(Agency.name)
+  ).all())
+
+def count_monuments(column):
+  rows = read_session().execute(
+    select(column, func.count()).where(Monument.isdeleted == 0, Monument.isapproved == 1).group_by(column)
+  ).all()
+  return dict(rows)
+
+def monument_counts():
+  """Return ({stateid: approved monuments}, {agencyid: approved monuments}), one GROUP BY each."""
+  return cached("monument counts", "monument", lambda: (count_monuments(Monument.stateid), count_monuments(Monument.agencyid)))
+
+def invalidate_reference_data():
+  reference_cache.clear()
@@ -0,0 +1,124 @@
+import re
+from markupsafe import Markup, escape
+from sqlalchemy import event, text, bindparam, select, DDL, func, or_, and_, case
+
+from models import Monument, db
+from database import read_session, is_sqlite
+
+# Markers wrapped around matched terms by snippet(), replaced after escaping
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+CREATE_SEARCH_TABLE = (
+  "CREATE VIRTUAL TABLE IF NOT EXISTS monument_fts USING fts5("
+  "name, description, prefix='2 3', tokenize='unicode61 remove_diacritics 2')"
+)
+
+# Full-text index of approved monuments, rowid is the monument id
+event.listen(db.metadata, "after_create", DDL(CREATE_SEARCH_TABLE).execute_if(dialect="sqlite"))
+
+def is_searchable(monument):
+  return bool(monument.isapproved) and not monument.isdeleted
+
+def index_monument(conn, monument):
+  """Replace the search entry of a monument, dropping it if the monument is not listed."""
+  if not is_sqlite(conn):
+    return
+  conn.execute(text("DELETE FROM monument_fts WHERE rowid = :id"), {"id": monument.id})
+  if is_searchable(monument):
+    conn.execute(
+      text("INSERT INTO monument_fts (rowid, name, description) VALUES (:id, :name, :description)"),
+      {"id": monument.id, "name": monument.name, "description": monument.description},
+    )
+
+@event.listens_for(Monument, "after_insert")
+@event.listens_for(Monument, "after_update")
+def sync_search_index(mapper, connection, target):
+  index_monument(connection, target)
+
+@event.listens_for(Monument, "after_delete")
+def remove_from_search_index(mapper, connection, target):
+  if not is_sqlite(connection):
+    return
+  connection.execute(text("DELETE FROM monument_fts WHERE rowid = :id"), {"id": target.id})
+
+def index_monument_ids(conn, ids):
+  """Replace the search entries of many monuments at once, for writes that bypass the ORM."""
+  if not ids or not is_sqlite(conn):
+    return
+  conn.execute(text("DELETE FROM monument_fts WHERE rowid IN :ids").bindparams(bindparam("ids", expanding=True)), {"ids": ids})
+  conn.execute(text(
+    "INSERT INTO monument_fts (rowid, name, description) "
+    "SELECT id, name, description FROM monument WHERE id IN :ids AND isdeleted = 0 AND isapproved = 1"
+  ).bindparams(bindparam("ids", expanding=True)), {"ids": ids})
+
+def rebuild_search_index(conn):
+  """Rebuild the search index from the monument table, returning the number of indexed monuments."""
+  if not is_sqlite(conn):
+    return 0
+  conn.exec_driver_sql(CREATE_SEARCH_TABLE)
+  conn.exec_driver_sql("DELETE FROM monument_fts")
+  conn.exec_driver_sql(
+    "INSERT INTO monument_fts (rowid, name, description) "
+    "SELECT id, name, description FROM monument WHERE isdeleted = 0 AND isapproved = 1"
+  )
+  conn.exec_driver_sql("INSERT INTO monument_fts (monument_fts) VALUES ('optimize')")
+  return conn.exec_driver_sql("SELECT COUNT(*) FROM monument_fts").scalar()
+
+def to_match_query(q):
+  """
+  Turn free text into an FTS5 query where every word must match, the last one as a prefix.
+
+  Words are quoted so user input can never be parsed as FTS5 syntax.
+  """
+  words = re.findall(r"\w+", q or "")
+  if not words:
+    return None
+  terms = ['"%s"' % word for word in words]
+  terms[-1] += "*"
+  return " ".join(terms)
+
+def highlight(snippet):
+  """Escape a snippet and mark up the matched terms."""
+  return Markup(str(escape(snippet)).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>"))
+
+def search_statement(q, limit=24, sqlite=True):
+  """
+  Build the search for q ranked by bm25 with names weighted higher, or None if q has no words.
+
+  Databases without FTS5 fall back to requiring every word in the name or
+  description, with name matches first.
+  """
+  match = to_match_query(q)
+  if not match:
+    return None
+
+  if sqlite:
+    return text(
+      "SELECT monument.id, monument.name, monument.imageurl, "
+      "snippet(monument_fts, 1, :start, :end, '...', 16) AS snippet "
+      "FROM monument_fts JOIN monument ON monument.id = monument_fts.rowid "
+      "WHERE monument_fts MATCH :match "
+      "ORDER BY bm25(monument_fts, 10.0, 1.0) LIMIT :limit"
+    ).bindparams(start=MATCH_START, end=MATCH_END, match=match, limit=limit)
+
+  words = re.findall(r"\w+", q)
+  in_name = [Monument.name.ilike("%" + word + "%") for word in words]
+  in_text = [or_(name, Monument.description.ilike("%" + word + "%")) for name, word in zip(in_name, words)]
+  return select(
+    Monument.id, Monument.name, Monument.imageurl,
+    func.substr(Monument.description, 1, 120).label("snippet"),
+  ).where(Monument.isdeleted == 0, Monument.isapproved == 1, *in_text) \
+    .order_by(case((and_(*in_name), 0), else_=1), Monument.name, Monument.id) \
+    .limit(limit)
+
+def search_monuments(q, limit=24):
+  """Return the best matching approved monuments for q."""
+  session = read_session()
+  statement = search_statement(q, limit, is_sqlite(session.get_bind()))
+  if statement is None:
+    return []
+  return session.execute(statement).all()
+
+def result_to_dict(row):
+  return dict(id=row.id, name=row.name, imageurl=row.imageurl, snippet=str(highlight(row.snippet)))
@@ -0,0 +1,207 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from werkzeug.datastructures import CallbackDict
+
+serializer = TaggedJSONSerializer()
+
+class MemorySessionStore:
+  """Sessions kept in a dict of this process, for tests and single process development."""
+
+  def __init__(self):
+    self._data = {}
+    self._lock = threading.Lock()
+
+  def get(self, sid):
+    with self._lock:
+      entry = self._data.get(sid)
+    if entry is None or entry[1] < time.time():
+      return None
+    return entry
+
+  def set(self, sid, data, expires):
+    with self._lock:
+      self._data[sid] = (data, expires)
+
+  def touch(self, sid, expires):
+    with self._lock:
+      if sid in self._data:
+        self._data[sid] = (self._data[sid][0], expires)
+
+  def delete(self, sid):
+    with self._lock:
+      self._data.pop(sid, None)
+
+  def purge_expired(self):
+    now = time.time()
+    with self._lock:
+      for sid in [sid for sid, (_, expires) in self._data.items() if expires < now]:
+        del self._data[sid]
+
+class SQLiteSessionStore:
+  """Sessions in a single SQLite file in WAL mode, shared by every worker on the host."""
+
+  def __init__(self, path):
+    self.path = path
+    self._local = threading.local()
+    with self.connection() as conn:
+      conn.execute("CREATE TABLE IF NOT EXISTS session (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+      conn.execute("CREATE INDEX IF NOT EXISTS ix_session_expires ON session (expires)")
+
+  def connection(self):
+    """Return this thread's connection, opening it on first use."""
+    conn = getattr(self._local, "conn", None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=5)
+      conn.execute("PRAGMA journal_mode = WAL")
+      conn.execute("PRAGMA synchronous = NORMAL")
+      self._local.conn = conn
+    return conn
+
+  def get(self, sid):
+    row = self.connection().execute("SELECT data, expires FROM session WHERE sid = ? AND expires >= ?", (sid, time.time())).fetchone()
+    return (row[0], row[1]) if row else None
+
+  def set(self, sid, data, expires):
+    with self.connection() as conn:
+      conn.execute("INSERT OR REPLACE INTO session (sid, data, expires) VALUES (?, ?, ?)", (sid, data, expires))
+
+  def touch(self, sid, expires):
+    with self.connection() as conn:
+      conn.execute("UPDATE session SET expires = ? WHERE sid = ?", (expires, sid))
+
+  def delete(self, sid):
+    with self.connection() as conn:
+      conn.execute("DELETE FROM session WHERE sid = ?", (sid,))
+
+  def purge_expired(self):
+    with self.connection() as conn:
+      conn.execute("DELETE FROM session WHERE expires < ?", (time.time(),))
+
+class ServerSession(CallbackDict, SessionMixin):
+  """Session dict that remembers whether it was changed, so unchanged sessions are never written."""
+
+  def __init__(self, initial=None, sid=None, expires=None):
+    def on_update(self):
+      self.modified = True
+    CallbackDict.__init__(self, initial, on_update)
+    self.sid = sid
+    self.expires = expires
+    self.modified = False
+    # The user the session belonged to when it was opened, a new id is issued when it changes
+    self.userid = self.get("user_id")
+    self.cleared = False
+
+  def clear(self):
+    self.cleared = True
+    CallbackDict.clear(self)
+
+class ServerSessionInterface(SessionInterface):
+  """
+  Keep session data in a SessionStore and only a random session id in the cookie.
+
+  Sessions expire lifetime seconds after they were last used. The store is only
+  written when the session changed, or to push the expiry forward once half of the
+  lifetime has passed, and a background thread purges expired sessions.
+  """
+
+  def __init__(self, store, lifetime=86400, purge_interval=600):
+    self.store = store
+    self.lifetime = lifetime
+    self.purge_interval = purge_interval
+    self._purger = None
+
+  def start_purger(self):
+    if self._purger is not None:
+      return
+
+    def purge():
+      while True:
+        time.sleep(self.purge_interval)
+        try:
+          self.store.purge_expired()
+        except Exception:
+          pass
+
+    self._purger = threading.Thread(target=purge, name="session-purger", daemon=True)
+    self._purger.start()
+
+  def open_session(self, app, request):
+    self.start_purger()
+    sid = request.cookies.get(self.get_cookie_name(app))
+    if sid:
+      entry = self.store.get(sid)
+      if entry is not None:
+        data, expires = entry
+        return ServerSession(serializer.loads(data), sid=sid, expires=expires)
+    return ServerSession()
+
+  def save_session(self, app, session, response):
+    name = self.get_cookie_name(app)
+    domain = self.get_cookie_domain(app)
+    path = self.get_cookie_path(app)
+
+    # An emptied session is removed together with its cookie
+    if not session:
+      if session.sid:
+        self.store.delete(session.sid)
+        response.delete_cookie(name, domain=domain, path=path)
+      return
+
+    # Logging in or out gets a new id, so an id planted in the browser before is useless after (session fixation)
+    if session.sid is not None and (session.cleared or session.get("user_id") != session.userid):
+      self.store.delete(session.sid)
+      session.sid = None
+
+    now = time.time()
+    expires = now + self.lifetime
+    if session.sid is None:
+      session.sid = secrets.token_urlsafe(32)
+      self.store.set(session.sid, serializer.dumps(dict(session)), expires)
+    elif session.modified:
+      self.store.set(session.sid, serializer.dumps(dict(session)), expires)
+    elif session.expires - now < self.lifetime / 2:
+      self.store.touch(session.sid, expires)
+    else:
+      return
+
+    response.vary.add("Cookie")
+    response.set_cookie(
+      name,
+      session.sid,
+      expires=self.get_expiration_time(app, session),
+      httponly=self.get_cookie_httponly(app),
+      domain=domain,
+      path=path,
+      secure=self.get_cookie_secure(app),
+      samesite=self.get_cookie_samesite(app),
+    )
+
+def init_sessions(app):
+  """
+  Install the session backend named by SESSION_BACKEND: "sqlite" (default), "memory" or "cookie".
+
+  "cookie" keeps the whole session in a cookie signed with SECRET_KEY, which must be
+  set: a key made up by each worker would not accept the cookies of the others.
+  """
+  backend = app.config["SESSION_BACKEND"]
+  if backend == "cookie":
+    if not app.config.get("SECRET_KEY"):
+      raise ValueError("SESSION_BACKEND=cookie needs SECRET_KEY set in the environment")
+    app.session_interface = SecureCookieSessionInterface()
+    return
+
+  if backend == "memory":
+    store = MemorySessionStore()
+  elif backend == "sqlite":
+    path = app.config.get("SESSION_DB") or os.path.join(app.instance_path, "sessions.db")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    store = SQLiteSessionStore(path)
+  else:
+    raise ValueError("unsupported SESSION_BACKEND %r" % backend)
+
+  app.session_interface = ServerSessionInterface(store, app.config["SESSION_LIFETIME"], app.config["SESSION_PURGE_INTERVAL"])
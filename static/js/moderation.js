@@ -0,0 +1,19 @@
+// Moderation queue: the "Select all" box checks or clears every monument on the page.
+(function () {
+  const all = document.getElementById("select-all");
+  if (!all) {
+    return;
+  }
+  const boxes = document.querySelectorAll(".moderation-select");
+
+  all.addEventListener("change", function () {
+    boxes.forEach(function (box) {
+      box.checked = all.checked;
+    });
+  });
+  boxes.forEach(function (box) {
+    box.addEventListener("change", function () {
+      all.checked = Array.prototype.every.call(boxes, function (box) { return box.checked; });
+    });
+  });
+})();
@@ -0,0 +1,101 @@
+// Infinite scroll for the monuments page: fetch the next page from /api/monuments
+// when the "Load more" block comes into view and append the cards to the list.
+(function () {
+  const list = document.getElementById("monument-list");
+  const more = document.getElementById("monument-more");
+  if (!list || !more || !("IntersectionObserver" in window)) {
+    return;
+  }
+
+  const isAdmin = list.dataset.admin === "true";
+  let loading = false;
+
+  function link(href, className, text) {
+    const a = document.createElement("a");
+    a.href = href;
+    a.className = className;
+    a.textContent = text;
+    return a;
+  }
+
+  function card(monument) {
+    const item = document.createElement("div");
+    item.className = monument.visited ? "monument-item visited" : "monument-item";
+    item.dataset.id = monument.id;
+
+    const imgContainer = document.createElement("div");
+    imgContainer.className = "monument-img-container";
+    const img = document.createElement("img");
+    img.src = monument.image.src;
+    if (monument.image.srcset) {
+      img.srcset = monument.image.srcset;
+    }
+    img.alt = monument.name;
+    img.className = "monument-img";
+    img.loading = "lazy";
+    img.decoding = "async";
+    img.onerror = function () {
+      img.onerror = null;
+      img.removeAttribute("srcset");
+      img.src = list.dataset.missingImage;
+    };
+    imgContainer.appendChild(img);
+
+    const body = document.createElement("div");
+    body.className = "monument-body";
+    const title = document.createElement("h5");
+    title.className = "card-title";
+    title.textContent = monument.name;
+    const badge = document.createElement("span");
+    badge.className = "badge visited-badge";
+    badge.textContent = "Visited";
+    title.append(" ", badge);
+    const text = document.createElement("p");
+    text.className = "card-text";
+    text.textContent = monument.excerpt + "...";
+    body.append(title, text);
+    if (monument.visits) {
+      const rating = document.createElement("p");
+      rating.className = "card-rating";
+      rating.textContent = "Rated " + monument.average.toFixed(1) + " from " + monument.visits + " visits";
+      body.append(rating);
+    }
+    body.append(link("/monument/details/" + monument.id, "btn btn-read-more", "Read more!"));
+    if (isAdmin) {
+      body.append(" ", link("/monument/edit/" + monument.id, "btn btn-warning", "Edit"));
+      body.append(" ", link("/monument/delete/" + monument.id, "btn btn-danger", "Delete"));
+    }
+
+    item.append(imgContainer, body);
+    return item;
+  }
+
+  async function loadNext() {
+    if (loading || !more.dataset.next) {
+      return;
+    }
+    loading = true;
+    const response = await fetch("/api/monuments?after=" + encodeURIComponent(more.dataset.next));
+    if (response.ok) {
+      const page = await response.json();
+      page.monuments.forEach(function (monument) {
+        list.appendChild(card(monument));
+      });
+      if (page.next) {
+        more.dataset.next = page.next;
+        more.querySelector("a").href = "/monuments?after=" + page.next;
+      } else {
+        more.remove();
+        observer.disconnect();
+      }
+    }
+    loading = false;
+  }
+
+  const observer = new IntersectionObserver(function (entries) {
+    if (entries.some(function (entry) { return entry.isIntersecting; })) {
+      loadNext();
+    }
+  });
+  observer.observe(more);
+})();
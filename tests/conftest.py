@@ -0,0 +1,85 @@
+import pytest
+
+from app import create_app
+from models import Agency, State, Monument, User, db
+from helpers import user_cache
+from queries import visited_cache
+from dashboard import stats_cache
+from fragments import fragment_cache
+from refdata import reference_cache
+from recommendations import recommendation_cache
+from visits import listed_cache
+
+CACHES = [user_cache, visited_cache, stats_cache, fragment_cache, reference_cache, recommendation_cache, listed_cache]
+
+def settings(tmp_path, **config):
+  """Settings of an app on a new SQLite database in tmp_path, without background workers."""
+  defaults = dict(
+    TESTING=True,
+    DATABASE_URL="sqlite:///%s" % tmp_path.joinpath("test.db"),
+    SECRET_KEY="test",
+    SESSION_BACKEND="memory",
+    MEDIA_DIR=str(tmp_path.joinpath("media")),
+    MEDIA_FETCH_WORKERS=0,
+    VISIT_QUEUE="off",
+    # Cheap hashes, the tests are not about their strength
+    PASSWORD_SCRYPT_N=2 ** 8,
+  )
+  defaults.update(config)
+  return defaults
+
+def create_test_app(tmp_path, **config):
+  """An app on a new database in tmp_path with an admin user, a state and an agency."""
+  # Process-wide caches are keyed by table versions, which every new database starts again
+  for cache in CACHES:
+    cache.clear()
+  app = create_app(settings(tmp_path, **config))
+  with app.app_context():
+    db.session.add_all([
+      User(username="admin", hash="x", isadmin=1, firstname="", lastname=""),
+      State(name="Utah", createdby="1"),
+      Agency(name="National Park Service", department="Interior"),
+    ])
+    db.session.commit()
+  return app
+
+@pytest.fixture
+def app(tmp_path):
+  app = create_test_app(tmp_path)
+  yield app
+  with app.app_context():
+    db.engine.dispose()
+
+@pytest.fixture
+def admin(app):
+  """A test client logged in as the admin user."""
+  client = app.test_client()
+  with client.session_transaction() as session:
+    session["user_id"] = 1
+  return client
+
+def add_monuments(app, locations, approved=True):
+  """Insert a listed monument at every (latitude, longitude) and return their ids."""
+  with app.app_context():
+    monuments = [
+      Monument(
+        name="Monument %d" % i, description="A monument", latitude=latitude, longitude=longitude,
+        agencyid=1, stateid=1, imageurl="http://example.com/%d.jpg" % i, isapproved=1 if approved else 0, createdby="1",
+      )
+      for i, (latitude, longitude) in enumerate(locations)
+    ]
+    db.session.add_all(monuments)
+    db.session.commit()
+    return [monument.id for monument in monuments]
+
+def visitor(app, username):
+  """A test client logged in as a new user."""
+  with app.app_context():
+    user = User(username=username, hash="x", isadmin=0, firstname="", lastname="")
+    db.session.add(user)
+    db.session.commit()
+    userid = user.id
+  client = app.test_client()
+  with client.session_transaction() as session:
+    session["user_id"] = userid
+  return client
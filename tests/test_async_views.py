@@ -0,0 +1,57 @@
+import asyncio
+import shutil
+import sqlite3
+
+import asyncviews
+from app import create_app
+from models import db
+from conftest import settings, add_monuments
+
+ROUTES = ["/monuments", "/api/monuments?limit=2", "/api/monuments/top", "/api/monuments/search?q=monument", "/monument/details/1"]
+
+def client(app):
+  client = app.test_client()
+  with client.session_transaction() as session:
+    session["user_id"] = 1
+  return client
+
+def test_async_views_answer_like_the_sync_views(app, tmp_path):
+  add_monuments(app, [(37.0, -110.0), (38.0, -110.0), (39.0, -110.0)])
+  async_app = create_app(settings(tmp_path, ASYNC_VIEWS=True))
+
+  for url in ROUTES:
+    expected, response = client(app).get(url), client(async_app).get(url)
+    assert (response.status_code, response.data) == (expected.status_code, expected.data), url
+
+def test_async_list_views_read_from_the_replica(app, tmp_path):
+  add_monuments(app, [(37.0, -110.0)])
+  with app.app_context():
+    db.engine.dispose()
+  replica = tmp_path.joinpath("replica.db")
+  shutil.copyfile(tmp_path.joinpath("test.db"), replica)
+  with sqlite3.connect(replica) as conn:
+    conn.execute("UPDATE monument SET name = 'Only on the replica'")
+  async_app = create_app(settings(tmp_path, ASYNC_VIEWS=True, DATABASE_REPLICA_URL="sqlite:///%s" % replica))
+
+  response = client(async_app).get("/api/monuments")
+
+  assert [monument["name"] for monument in response.get_json()["monuments"]] == ["Only on the replica"]
+
+def test_sync_reads_do_not_run_on_the_event_loop(app, tmp_path, monkeypatch):
+  add_monuments(app, [(37.0, -110.0)])
+  async_app = create_app(settings(tmp_path, ASYNC_VIEWS=True))
+  on_loop = []
+  visited_ids = asyncviews.visited_ids
+  def recording_visited_ids(userid):
+    try:
+      asyncio.get_running_loop()
+      on_loop.append(True)
+    except RuntimeError:
+      on_loop.append(False)
+    return visited_ids(userid)
+  monkeypatch.setattr(asyncviews, "visited_ids", recording_visited_ids)
+
+  for url in ["/monuments", "/api/monuments", "/monument/details/1"]:
+    assert client(async_app).get(url).status_code == 200
+
+  assert on_loop == [False, False, False]
@@ -0,0 +1,80 @@
+import io
+
+from bulkimport import import_rows
+from models import Agency, Monument, db
+
+MONUMENTS = b"""name,description,latitude,longitude,imageurl,dateestablished,acres,state,agency
+Arches Monument,Sandstone arches,38.68,-109.57,http://example.com/arches.jpg,1929-04-12,76679,Utah,National Park Service
+Zion Monument,A canyon,37.3,-113.05,http://example.com/zion.jpg,1909-07-31,146597,Utah,National Park Service
+Bad Monument,No coordinates,,,http://example.com/bad.jpg,1909-07-31,10,Utah,National Park Service
+Lost Monument,Somewhere else,40.0,-100.0,http://example.com/lost.jpg,1909-07-31,10,Atlantis,National Park Service
+Zion Monument,The same canyon again,37.3,-113.05,http://example.com/zion.jpg,1909-07-31,146597,Utah,National Park Service
+"""
+
+def upload(client, kind, data, filename, **form):
+  form["file"] = (io.BytesIO(data), filename)
+  return client.post("/api/import/%s" % kind, data=form, content_type="multipart/form-data")
+
+def test_import_inserts_valid_rows_and_reports_the_others(app, admin):
+  response = upload(admin, "monument", MONUMENTS, "monuments.csv", approve="1")
+
+  assert response.status_code == 200
+  report = response.get_json()
+  assert report["inserted"] == 2
+  assert report["rejected"] == 3
+  assert [error["line"] for error in report["errors"]] == [4, 5, 6]
+  assert "latitude" in report["errors"][0]["error"]
+  assert report["errors"][1]["error"] == "unknown state 'Atlantis'"
+  assert report["errors"][2]["error"] == "monument with the specific name already exists"
+
+  # Imported monuments are searchable and placed on the map like created ones
+  names = [monument["name"] for monument in admin.get("/api/monuments/near?lat=38&lon=-111&r=300").get_json()["monuments"]]
+  assert sorted(names) == ["Arches Monument", "Zion Monument"]
+
+def test_import_rejects_names_already_in_the_database(app, admin):
+  rows = b'{"name": "Bureau of Land Management", "department": "Interior"}\nnot json\n'
+  assert upload(admin, "agency", rows, "agencies.jsonl").get_json()["inserted"] == 1
+
+  report = upload(admin, "agency", rows, "agencies.jsonl").get_json()
+
+  assert report == dict(inserted=0, rejected=2, errors=[
+    dict(line=1, error="agency with the specific name already exists"),
+    dict(line=2, error="row is not an object"),
+  ])
+
+def test_import_reports_rows_inserted_concurrently(app):
+  def rows():
+    yield 1, dict(name="Bureau of Land Management", department="Interior")
+    # Another import takes a name after the importer loaded the taken ones
+    with db.engine.begin() as conn:
+      conn.execute(Agency.__table__.insert(), [dict(name="Forest Service", department="Agriculture")])
+    yield 2, dict(name="Forest Service", department="Agriculture")
+    yield 3, dict(name="Fish and Wildlife Service", department="Interior")
+
+  with app.test_request_context():
+    report = import_rows("agency", rows(), 1)
+    names = sorted(name for name, in db.session.query(Agency.name))
+
+  assert report.to_dict() == dict(inserted=2, rejected=1, errors=[
+    dict(line=2, error="agency with the specific name already exists"),
+  ])
+  assert names == ["Bureau of Land Management", "Fish and Wildlife Service", "Forest Service", "National Park Service"]
+
+def test_import_keeps_earlier_batches_when_a_later_one_clashes(app):
+  def rows():
+    yield 2, dict(name="First Monument", description="One", latitude=38, longitude=-110, imageurl="http://example.com/1.jpg",
+      dateestablished="1909-07-31", acres="10", state="Utah", agency="National Park Service")
+    with db.engine.begin() as conn:
+      conn.execute(Monument.__table__.insert(), [dict(name="Second Monument", description="Two", latitude=39, longitude=-110,
+        agencyid=1, stateid=1, imageurl="http://example.com/2.jpg", isapproved=1, isdeleted=0, createdby="1")])
+    yield 3, dict(name="Second Monument", description="Two", latitude=39, longitude=-110, imageurl="http://example.com/2.jpg",
+      dateestablished="1909-07-31", acres="10", state="Utah", agency="National Park Service")
+
+  with app.test_request_context():
+    report = import_rows("monument", rows(), 1, approve=True, batchsize=1)
+    count = db.session.query(Monument).count()
+
+  assert report.to_dict() == dict(inserted=1, rejected=1, errors=[
+    dict(line=3, error="monument with the specific name already exists"),
+  ])
+  assert count == 2
@@ -0,0 +1,44 @@
+from models import Agency, Monument, Visit, db
+from ratings import recompute_ratings
+from queries import recorded_visit_ids
+from conftest import add_monuments, visitor
+
+def test_delete_monument_with_visits(app, admin):
+  id, other = add_monuments(app, [(37.0, -110.0), (38.0, -110.0)])
+  with app.app_context():
+    db.session.add(Visit(userid=1, monumentid=id, grade=5, comment="nice"))
+    db.session.add(Visit(userid=1, monumentid=other, grade=3, comment="fine"))
+    db.session.commit()
+  # Caches the admin's visited ids
+  assert admin.get("/monuments").status_code == 200
+
+  response = admin.post("/monument/delete/%d" % id)
+
+  assert response.status_code == 302
+  with app.app_context():
+    assert db.session.get(Monument, id) is None
+    assert [visit.monumentid for visit in db.session.query(Visit)] == [other]
+    with db.engine.begin() as conn:
+      assert recompute_ratings(conn, fix=False) == []
+  # The deleted monument can be visited by nobody, the other one is still visited
+  assert visitor(app, "late").post("/monument/visit/%d" % id, data=dict(grade=5)).status_code == 400
+  with app.app_context():
+    assert recorded_visit_ids(1) == frozenset([other])
+
+def test_delete_agency_with_monuments_is_refused(app, admin):
+  add_monuments(app, [(37.0, -110.0)])
+
+  response = admin.post("/agency/delete/1")
+
+  assert response.status_code == 400
+  assert b"still has monuments" in response.data
+  with app.app_context():
+    assert db.session.get(Agency, 1) is not None
+    assert db.session.query(Monument).count() == 1
+
+def test_delete_agency_without_monuments(app, admin):
+  response = admin.post("/agency/delete/1")
+
+  assert response.status_code == 302
+  with app.app_context():
+    assert db.session.get(Agency, 1) is None
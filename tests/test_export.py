@@ -0,0 +1,45 @@
+import csv
+import io
+import json
+
+import bulkexport
+from conftest import add_monuments, visitor
+
+def test_export_streams_monuments_in_chunks(app, admin, monkeypatch):
+  monkeypatch.setattr(bulkexport, "CHUNK_SIZE", 2)
+  add_monuments(app, [(37.0, -110.0 - i) for i in range(5)])
+
+  response = admin.get("/api/export/monument?format=csv")
+
+  assert response.status_code == 200
+  assert response.is_streamed
+  assert response.headers["Content-Disposition"] == "attachment; filename=monument.csv"
+  rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+  assert [row["name"] for row in rows] == ["Monument %d" % i for i in range(5)]
+  assert rows[0]["state"] == "Utah"
+
+def test_export_streams_the_users_visits(app, admin):
+  first, second = add_monuments(app, [(37.0, -110.0), (38.0, -110.0)])
+  client = visitor(app, "traveller")
+  assert client.post("/monument/visit/%d" % second, data=dict(grade=4, comment="windy")).status_code == 302
+
+  response = client.get("/api/export/visit?format=jsonl")
+  assert response.status_code == 200
+  assert response.is_streamed
+  assert response.headers["Content-Disposition"] == "attachment; filename=visits-2.jsonl"
+  visits = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+  assert [(visit["monumentid"], visit["grade"], visit["comment"]) for visit in visits] == [(second, 4, "windy")]
+
+  # An admin exports the same history by user id
+  assert admin.get("/api/export/visit?format=jsonl&userid=2").get_data() == response.get_data()
+
+def test_export_refuses_a_malformed_userid(app, admin):
+  response = admin.get("/api/export/visit?userid=abc")
+
+  assert response.status_code == 400
+  assert response.get_json() == dict(error="userid must be a user id")
+
+def test_export_of_other_users_visits_needs_an_admin(app):
+  response = visitor(app, "traveller").get("/api/export/visit?userid=1")
+
+  assert response.status_code == 403
@@ -0,0 +1,89 @@
+import random
+import statistics
+import time
+
+import pytest
+
+import geo
+from models import Monument, db
+from geo import distance_km, rebuild_geo_index, within_radius, nearest, bbox_candidates
+
+CENTERS = [(39.3, -111.1), (41.5, -108.5), (37.0, -112.0)]
+# Around the antimeridian and the north pole, where boxes wrap
+EDGES = [(41.5, 179.8), (89.0, 40.0)]
+
+def add_random_monuments(app, count, seed=1, centers=CENTERS, spread=1.5):
+  """Insert count approved monuments scattered around the centers, returning {id: (lat, lon)}."""
+  rng = random.Random(seed)
+  rows = []
+  for i in range(count):
+    lat, lon = rng.choice(centers)
+    lat = min(max(lat + rng.gauss(0, spread), -90.0), 90.0)
+    lon = (lon + rng.gauss(0, spread) + 180.0) % 360.0 - 180.0
+    rows.append(dict(
+      name="Generated %d" % i, description="A monument", latitude=round(lat, 6), longitude=round(lon, 6),
+      agencyid=1, stateid=1, imageurl="http://example.com/%d.jpg" % i, isapproved=1, isdeleted=0, createdby="1",
+    ))
+  with app.app_context():
+    with db.engine.begin() as conn:
+      conn.execute(Monument.__table__.insert(), rows)
+      rebuild_geo_index(conn)
+    return dict((id, (float(lat), float(lon))) for id, lat, lon in db.session.query(Monument.id, Monument.latitude, Monument.longitude))
+
+def brute_force(locations, lat, lon, radius, limit):
+  distances = sorted((distance_km(lat, lon, *location), id) for id, location in locations.items())
+  return [(id, round(distance, 3)) for distance, id in distances if distance <= radius][:limit]
+
+def near(client, url):
+  return [(monument["id"], monument["distance"]) for monument in client.get(url).get_json()["monuments"]]
+
+def test_near_matches_brute_force_on_dense_data(app, admin):
+  # More monuments in the search box than any candidate cap would keep
+  locations = add_random_monuments(app, 12000, centers=CENTERS + EDGES)
+
+  for lat, lon, radius in [
+    (39.3, -111.1, 300), (41.5, -108.5, 300), (38.0, -110.0, 50), (45.0, -100.0, 1000),
+    (41.5, -179.9, 200), (41.5, 179.0, 2000), (89.9, -140.0, 300), (0.0, 0.0, 1500),
+  ]:
+    found = near(admin, "/api/monuments/near?lat=%s&lon=%s&r=%s" % (lat, lon, radius))
+    assert found == brute_force(locations, lat, lon, radius, app.config["PAGE_SIZE"])
+
+def test_nearest_matches_brute_force_within_the_limit(app, admin):
+  locations = add_random_monuments(app, 2000, seed=2, centers=CENTERS + EDGES)
+
+  for lat, lon in [(39.3, -111.1), (0.0, 0.0), (41.5, -179.9), (85.0, 0.0), (30.0, -100.0)]:
+    found = near(admin, "/api/monuments/near?lat=%s&lon=%s" % (lat, lon))
+    assert found == brute_force(locations, lat, lon, app.config["NEAREST_MAX_KM"], app.config["PAGE_SIZE"])
+
+def test_near_matches_brute_force_without_numpy(app, admin, monkeypatch):
+  locations = add_random_monuments(app, 2000, seed=3, centers=CENTERS + EDGES)
+  monkeypatch.setattr(geo, "numpy", None)
+
+  for lat, lon, radius in [(39.3, -111.1, 300), (41.5, -179.9, 500)]:
+    found = near(admin, "/api/monuments/near?lat=%s&lon=%s&r=%s" % (lat, lon, radius))
+    assert found == brute_force(locations, lat, lon, radius, app.config["PAGE_SIZE"])
+
+@pytest.mark.skipif(geo.numpy is None, reason="the vectorized distances need numpy")
+def test_near_queries_are_fast_on_a_large_catalogue(app):
+  # Spread like benchmarks/dataset.py, monuments clustered around 50 places
+  rng = random.Random(4)
+  centers = [(rng.uniform(25, 65), rng.uniform(-160, -70)) for _ in range(50)]
+  add_random_monuments(app, 100000, seed=4, centers=centers)
+
+  queries = [
+    lambda: nearest(*centers[0], k=24),
+    lambda: nearest(0.0, 0.0, k=24, radius=app.config["NEAREST_MAX_KM"]),
+    lambda: within_radius(60.0, -150.0, 3000, 24),
+    lambda: within_radius(0.0, -30.0, 1500, 24),
+    lambda: within_radius(*centers[1], 300, 100),
+    lambda: bbox_candidates(30.0, -120.0, 40.0, -100.0, 24),
+  ]
+  with app.test_request_context():
+    for query in queries:
+      query()
+      timings = []
+      for _ in range(10):
+        started = time.perf_counter()
+        query()
+        timings.append(time.perf_counter() - started)
+      assert statistics.median(timings) < 0.01
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from conftest import add_monuments, visitor
+from ratings import RATING_REFRESH
+
+@pytest.mark.parametrize("url", ["/monuments", "/api/monuments", "/api/monuments/top"])
+def test_check_in_keeps_other_users_listing_etags(app, url):
+  first, second = add_monuments(app, [(37.0, -110.0), (38.0, -110.0)])
+  reader = visitor(app, "reader")
+  etag = reader.get(url).headers["ETag"]
+
+  assert visitor(app, "writer").post("/monument/visit/%d" % first, data=dict(grade=5)).status_code == 302
+
+  assert reader.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+def test_own_check_in_changes_listing_etag(app):
+  first, = add_monuments(app, [(37.0, -110.0)])
+  client = visitor(app, "writer")
+  etag = client.get("/monuments").headers["ETag"]
+
+  assert client.post("/monument/visit/%d" % first, data=dict(grade=5)).status_code == 302
+
+  response = client.get("/monuments", headers={"If-None-Match": etag})
+  assert response.status_code == 200
+  assert ('.monument-item[data-id="%d"] .visited-badge' % first).encode() in response.data
+
+def test_shared_ratings_refresh_after_rating_refresh(app, monkeypatch):
+  now = time.time()
+  monkeypatch.setattr(time, "time", lambda: now)
+  first, = add_monuments(app, [(37.0, -110.0)])
+  reader = visitor(app, "reader")
+  etag = reader.get("/monuments").headers["ETag"]
+  assert visitor(app, "writer").post("/monument/visit/%d" % first, data=dict(grade=5)).status_code == 302
+  assert b"Rated" not in reader.get("/monuments").data
+
+  monkeypatch.setattr(time, "time", lambda: now + RATING_REFRESH)
+
+  response = reader.get("/monuments", headers={"If-None-Match": etag})
+  assert response.status_code == 200
+  assert b"Rated 5.0 from 1 visits" in response.data
+
+def test_anonymous_home_page_revalidates_with_etag(app):
+  client = app.test_client()
+  response = client.get("/")
+  assert "no-store" not in response.headers["Cache-Control"]
+
+  assert client.get("/", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+  # A new monument changes the statistics snapshot
+  add_monuments(app, [(37.0, -110.0)])
+  assert client.get("/", headers={"If-None-Match": response.headers["ETag"]}).status_code == 200
+
+def test_anonymous_login_form_is_not_kept_out_of_caches(app):
+  for url in ["/login", "/register"]:
+    response = app.test_client().get(url)
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-cache"
+
+def test_authenticated_forms_and_posts_are_not_stored(app, admin):
+  assert "no-store" in admin.get("/monument/create").headers["Cache-Control"]
+  assert "no-store" in app.test_client().post("/login", data=dict(username="nobody", password="x")).headers["Cache-Control"]
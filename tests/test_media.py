@@ -0,0 +1,129 @@
+import http.server
+import io
+import os
+import socket
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import media
+from media import fetch_media, media_dir, SIZES
+from models import Media, db
+
+Image = pytest.importorskip("PIL.Image")
+
+@pytest.fixture
+def server():
+  """A local HTTP server answering each path of routes with its (status, headers, body)."""
+  routes, requests = {}, []
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+      requests.append(self.path)
+      status, headers, body = routes.get(self.path, (404, {}, b""))
+      self.send_response(status)
+      for name, value in headers.items():
+        self.send_header(name, value)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      pass
+
+  httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+  thread = threading.Thread(target=httpd.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True)
+  thread.start()
+  yield SimpleNamespace(url="http://127.0.0.1:%d" % httpd.server_port, port=httpd.server_port, routes=routes, requests=requests)
+  httpd.shutdown()
+  httpd.server_close()
+
+@pytest.fixture
+def loopback_is_public(monkeypatch):
+  # The fixture server listens on loopback, every other internal address stays refused
+  monkeypatch.setattr(media, "public_address", lambda ip: ip.is_loopback)
+
+def png(width, height):
+  data = io.BytesIO()
+  Image.new("RGB", (width, height), (200, 80, 40)).save(data, "PNG")
+  return data.getvalue()
+
+def fetch(app, url):
+  with app.app_context():
+    hash, error = fetch_media(url)
+    assert db.session.get(Media, url).error == error
+    return hash, error
+
+def test_fetch_stores_the_original_and_every_variant(app, admin, server, loopback_is_public):
+  server.routes["/image.png"] = (200, {"Content-Type": "image/png"}, png(1000, 500))
+
+  hash, error = fetch(app, server.url + "/image.png")
+
+  assert error is None
+  with app.app_context():
+    directory = media_dir(hash)
+  assert os.path.exists(os.path.join(directory, "original"))
+  for size in SIZES:
+    for format in ["webp", "jpeg"]:
+      assert os.path.exists(os.path.join(directory, "%s.%s" % (size, format)))
+  assert Image.open(os.path.join(directory, "card.jpeg")).size == SIZES["card"]
+  assert Image.open(os.path.join(directory, "medium.jpeg")).size == (800, 400)
+
+  response = admin.get("/media/%s/card" % hash, headers={"Accept": "image/webp,*/*"})
+  assert response.status_code == 200
+  assert response.mimetype == "image/webp"
+
+def test_fetch_refuses_a_body_over_the_size_limit(app, server, loopback_is_public):
+  server.routes["/image.png"] = (200, {}, png(100, 100))
+  app.config["MEDIA_MAX_BYTES"] = 100
+
+  hash, error = fetch(app, server.url + "/image.png")
+
+  assert hash is None
+  assert "larger than 100 bytes" in error
+
+def test_fetch_refuses_an_image_over_the_pixel_limit(app, server, loopback_is_public):
+  server.routes["/image.png"] = (200, {}, png(100, 100))
+  app.config["MEDIA_MAX_PIXELS"] = 5000
+
+  hash, error = fetch(app, server.url + "/image.png")
+
+  assert hash is None
+  assert "100x100 pixels is too large" in error
+
+def test_fetch_refuses_a_redirect_to_a_private_address(app, server, loopback_is_public):
+  server.routes["/image.png"] = (302, {"Location": "http://10.1.2.3:%d/image.png" % server.port}, b"")
+
+  hash, error = fetch(app, server.url + "/image.png")
+
+  assert hash is None
+  assert "10.1.2.3 is not a public address" in error
+
+def test_fetch_refuses_a_local_address(app, server):
+  server.routes["/image.png"] = (200, {}, png(10, 10))
+
+  hash, error = fetch(app, server.url + "/image.png")
+
+  assert hash is None
+  assert "not a public address" in error
+  assert server.requests == []
+
+def test_fetch_connects_to_the_address_it_checked(app, server, loopback_is_public, monkeypatch):
+  server.routes["/image.png"] = (200, {}, png(10, 10))
+  app.config["MEDIA_FETCH_TIMEOUT"] = 1
+  lookups = []
+
+  # A rebinding name: public on the first lookup, internal on every later one
+  def getaddrinfo(host, port, *args, **kwargs):
+    assert host == "images.test"
+    lookups.append(host)
+    address = "127.0.0.1" if len(lookups) == 1 else "10.1.2.3"
+    return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (address, port))]
+  monkeypatch.setattr(media.socket, "getaddrinfo", getaddrinfo)
+
+  hash, error = fetch(app, "http://images.test:%d/image.png" % server.port)
+
+  assert error is None
+  assert lookups == ["images.test"]
+  assert server.requests == ["/image.png"]
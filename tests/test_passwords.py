@@ -0,0 +1,25 @@
+import time
+
+import pytest
+
+from passwords import PasswordHasher, HasherBusy
+
+def test_a_job_that_waits_too_long_raises_hasher_busy():
+  hasher = PasswordHasher(workers=1, queue=4, timeout=0.05)
+  with pytest.raises(HasherBusy):
+    hasher.run(time.sleep, 0.5)
+
+def test_login_and_register_answer_503_while_the_pool_is_saturated(app):
+  hasher = app.extensions["password_hasher"] = PasswordHasher(workers=1, queue=4, timeout=0.05, scrypt=(2 ** 8, 8, 1))
+  # Times out, and keeps the only hashing thread busy for a second
+  with pytest.raises(HasherBusy):
+    hasher.run(time.sleep, 1)
+
+  client = app.test_client()
+  for url, data in [
+    ("/register", dict(username="visitor", password="secret123", confirmation="secret123")),
+    ("/login", dict(username="admin", password="secret123")),
+  ]:
+    response = client.post(url, data=data)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
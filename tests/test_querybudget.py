@@ -0,0 +1,18 @@
+from querybudget import check_query_budgets
+from conftest import add_monuments, visitor
+
+def test_hot_routes_stay_within_their_query_budgets(app, admin):
+  id, = add_monuments(app, [(37.0, -110.0)])
+  assert visitor(app, "user").post("/monument/visit/%d" % id, data=dict(grade=5)).status_code == 302
+  assert admin.post("/monument/visit/%d" % id, data=dict(grade=4)).status_code == 302
+
+  problems = check_query_budgets(app)
+
+  assert [(route, count, budget) for route, count, budget, _ in problems] == []
+
+def test_query_budgets_catch_a_route_over_budget(app):
+  add_monuments(app, [(37.0, -110.0)])
+
+  problems = check_query_budgets(app, {"/monuments": 0})
+
+  assert [(route, budget) for route, count, budget, _ in problems] == [("/monuments", 0)]
@@ -0,0 +1,42 @@
+import pytest
+
+from app import create_app
+from models import User, db
+from conftest import settings
+from passwords import get_hasher
+
+def test_login_issues_a_new_session_id(app):
+  with app.app_context():
+    db.session.add(User(username="visitor", hash=get_hasher().hash("secret123"), isadmin=0, firstname="", lastname=""))
+    db.session.commit()
+  store = app.session_interface.store
+
+  # A session id an attacker got for themselves and planted in the victim's browser
+  client = app.test_client()
+  with client.session_transaction() as session:
+    session["next"] = "/"
+  planted = client.get_cookie("session").value
+
+  response = client.post("/login", data=dict(username="visitor", password="secret123"))
+
+  assert response.status_code == 302
+  assert client.get_cookie("session").value != planted
+  assert store.get(planted) is None
+  assert store.get(client.get_cookie("session").value) is not None
+
+def test_logout_removes_the_session(app, admin):
+  sid = admin.get_cookie("session").value
+
+  admin.get("/logout")
+
+  assert app.session_interface.store.get(sid) is None
+
+def test_cookie_sessions_need_a_secret_key(tmp_path):
+  with pytest.raises(ValueError, match="SECRET_KEY"):
+    create_app(settings(tmp_path, SESSION_BACKEND="cookie", SECRET_KEY=None))
+
+  app = create_app(settings(tmp_path, SESSION_BACKEND="cookie"))
+  with app.test_client() as client:
+    with client.session_transaction() as session:
+      session["user_id"] = 1
+    assert client.get("/monuments").status_code == 200
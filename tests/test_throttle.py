@@ -0,0 +1,16 @@
+from conftest import create_test_app
+
+def login_statuses(app, addresses):
+  client = app.test_client()
+  return [
+    client.post("/login", data=dict(username="admin", password="wrong password"), headers={"X-Forwarded-For": address}).status_code
+    for address in addresses
+  ]
+
+def test_clients_behind_a_trusted_proxy_are_throttled_apart(tmp_path):
+  app = create_test_app(tmp_path, TRUSTED_PROXY_HOPS=1, LOGIN_IP_LIMIT=2)
+  assert login_statuses(app, ["203.0.113.1"] * 3 + ["203.0.113.2"]) == [403, 403, 429, 403]
+
+def test_forwarded_addresses_are_ignored_without_trusted_proxies(tmp_path):
+  app = create_test_app(tmp_path, LOGIN_IP_LIMIT=2)
+  assert login_statuses(app, ["203.0.113.1", "203.0.113.2", "203.0.113.3"]) == [403, 403, 429]
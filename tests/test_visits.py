@@ -0,0 +1,68 @@
+from datetime import date
+
+import pytest
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+
+import visits
+from models import Visit, db
+from visits import VisitQueue, insert_visit
+from conftest import add_monuments, visitor
+
+def test_check_in_after_decline_is_refused(app, admin):
+  id, = add_monuments(app, [(37.0, -110.0)], approved=False)
+  assert visitor(app, "first").post("/monument/visit/%d" % id, data=dict(grade=5)).status_code == 302
+
+  assert admin.post("/monument/moderate", data=dict(action="decline", ids=[str(id)])).status_code == 302
+
+  response = visitor(app, "second").post("/monument/visit/%d" % id, data=dict(grade=5))
+  assert response.status_code == 400
+  with app.app_context():
+    assert db.session.query(Visit).count() == 1
+
+def test_check_in_after_delete_is_refused(app, admin):
+  first, second = add_monuments(app, [(37.0, -110.0), (38.0, -110.0)])
+  assert visitor(app, "first").post("/monument/visit/%d" % first, data=dict(grade=5)).status_code == 302
+
+  assert admin.post("/monument/delete/%d" % first).status_code == 302
+
+  response = visitor(app, "second").post("/monument/visit/%d" % first, data=dict(grade=5))
+  assert response.status_code == 400
+
+def test_check_in_statement_compares_booleans_on_postgresql():
+  # PostgreSQL has no boolean = integer operator
+  statement = str(insert_visit("postgresql").compile(dialect=postgresql.dialect()))
+  assert "monument.isdeleted = false" in statement
+
+def queued_visit(userid, monumentid, comment="nice"):
+  return dict(userid=userid, monumentid=monumentid, visitedon=date.today(), grade=5, comment=comment)
+
+def test_flush_drops_a_rejected_visit_and_writes_the_others(app):
+  first, second = add_monuments(app, [(37.0, -110.0), (38.0, -110.0)])
+  queue = VisitQueue(app, "memory", None, batch=100, interval=60, limit=100)
+  queue.add(queued_visit(1, first))
+  # NOT NULL comment, the database rejects it every time
+  queue.add(queued_visit(1, second, comment=None))
+
+  assert queue.flush() == 2
+
+  assert queue.pending == {}
+  with app.app_context():
+    assert [(visit.userid, visit.monumentid) for visit in db.session.query(Visit)] == [(1, first)]
+
+def test_flush_queues_the_batch_again_on_a_transient_error(app, monkeypatch):
+  id, = add_monuments(app, [(37.0, -110.0)])
+  queue = VisitQueue(app, "memory", None, batch=100, interval=60, limit=100)
+  queue.add(queued_visit(1, id))
+
+  def locked(visits):
+    raise OperationalError("INSERT INTO visit", {}, Exception("database is locked"))
+  monkeypatch.setattr(visits, "record_visits", locked)
+  with pytest.raises(OperationalError):
+    queue.flush()
+  assert list(queue.pending) == [(1, id)]
+
+  monkeypatch.undo()
+  assert queue.flush() == 1
+  with app.app_context():
+    assert db.session.query(Visit).count() == 1
@@ -0,0 +1,39 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+class Throttle:
+  """
+  Thread-safe token buckets per key: limit attempts at once, refilled evenly over window seconds.
+
+  Only the maxsize most recently used keys are kept, a forgotten key starts again
+  with a full bucket.
+  """
+
+  def __init__(self, limit, window, maxsize=100000):
+    self.limit = limit
+    self.rate = limit / window
+    self.maxsize = maxsize
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+
+  def hit(self, key):
+    """Take a token for key, returning 0 if allowed or else the seconds until the next token."""
+    now = time.monotonic()
+    with self._lock:
+      tokens, updated = self._buckets.pop(key, (self.limit, now))
+      tokens = min(self.limit, tokens + (now - updated) * self.rate)
+      if tokens >= 1:
+        tokens -= 1
+        wait = 0
+      else:
+        wait = math.ceil((1 - tokens) / self.rate)
+      self._buckets[key] = (tokens, now)
+      if len(self._buckets) > self.maxsize:
+        self._buckets.popitem(last=False)
+      return wait
+
+  def clear(self):
+    with self._lock:
+      self._buckets.clear()
@@ -0,0 +1,348 @@
+import atexit
+import functools
+import glob
+import json
+import os
+import secrets
+import threading
+from datetime import date
+from flask import current_app
+from sqlalchemy import event, bindparam, select, delete, Date
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import OperationalError, InterfaceError
+from sqlalchemy.orm import Session
+
+from models import Monument, Visit, db
+from ratings import MONUMENT, STATE, COLUMNS, grade_counts, add_counts
+from httpcache import bump
+from cache import TTLCache
+from dashboard import invalidate_stats
+from queries import visited_cache, remember_queued_visit
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+MODES = ["log", "memory", "off"]
+
+# Errors a batch is written again after, anything else is a visit the database rejects
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+# Ids of monuments recently seen listed. A monument can still be declined or deleted afterwards: writes
+# of this process drop its entry once committed, other workers' writes are seen when the entry expires
+listed_cache = TTLCache(ttl=30, maxsize=100000)
+
+# ON CONFLICT needs the insert of the dialect, both have the same interface
+DIALECT_INSERT = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+@functools.lru_cache(maxsize=None)
+def insert_visit(dialect):
+  """Insert one visit unless it is recorded already or its monument is deleted, returning the row written."""
+  listed = select(Monument.id).where(Monument.id == bindparam("monumentid"), Monument.isdeleted == False).exists()
+  values = select(
+    bindparam("userid"), bindparam("monumentid"), bindparam("visitedon", type_=Date), bindparam("grade"), bindparam("comment"),
+  ).where(listed)
+  return DIALECT_INSERT[dialect](Visit.__table__) \
+    .from_select(["userid", "monumentid", "visitedon", "grade", "comment"], values) \
+    .on_conflict_do_nothing(index_elements=["userid", "monumentid"]) \
+    .returning(Visit.userid, Visit.monumentid, Visit.grade)
+
+class VisitQueueFull(Exception):
+  """Raised when VISIT_QUEUE_MAX visits already wait to be written."""
+
+def monument_listed(id):
+  """Whether the monument exists and was not declined or deleted."""
+  if listed_cache.get(id):
+    return True
+  listed = db.session.execute(select(Monument.id).where(Monument.id == id, Monument.isdeleted == False)).first() is not None
+  if listed:
+    listed_cache.set(id, True)
+  return listed
+
+def forget_listed(ids):
+  """Drop the cached listing of monuments declined or deleted by a write that bypasses the ORM."""
+  for id in ids:
+    listed_cache.pop(id)
+
+@event.listens_for(Session, "after_flush")
+def collect_changed_monuments(session, flush_context):
+  for obj in list(session.dirty) + list(session.deleted):
+    if isinstance(obj, Monument):
+      session.info.setdefault("monuments", set()).add(obj.id)
+
+# Dropped after commit so a concurrent check-in cannot cache the monument as listed again before the write is visible
+@event.listens_for(Session, "after_commit")
+def forget_changed_monuments(session):
+  forget_listed(session.info.pop("monuments", ()))
+
+@event.listens_for(Session, "after_rollback")
+def forget_changed_monument_ids(session):
+  session.info.pop("monuments", None)
+
+def write_visits(conn, visits):
+  """
+  Insert visits and their rating aggregates on conn, skipping the ones already
+  recorded or of monuments deleted meanwhile, and return the (userid, monumentid)
+  pairs written.
+  """
+  written = []
+  counts = {}
+  for visit in visits:
+    row = conn.execute(insert_visit(conn.dialect.name), visit).first()
+    if row is None:
+      continue
+    written.append((row.userid, row.monumentid))
+    total = counts.setdefault(row.monumentid, dict((column, 0) for column in COLUMNS))
+    for column, value in grade_counts(int(row.grade)).items():
+      total[column] += value
+
+  if not written:
+    return written
+
+  # The set-based insert bypasses the Visit events that keep the aggregates in step
+  states = dict(conn.execute(select(Monument.id, Monument.stateid).where(Monument.id.in_(counts))).all())
+  state_counts = {}
+  for monumentid, total in sorted(counts.items()):
+    add_counts(conn, MONUMENT, monumentid, total)
+    stateid = states.get(monumentid)
+    if stateid is not None:
+      state_total = state_counts.setdefault(stateid, dict((column, 0) for column in COLUMNS))
+      for column in COLUMNS:
+        state_total[column] += total[column]
+  for stateid, total in sorted(state_counts.items()):
+    add_counts(conn, STATE, stateid, total)
+  bump(conn, "visit")
+  return written
+
+def record_visits(visits):
+  """Write visits in one transaction and drop the caches they make stale, returning the pairs written."""
+  with db.engine.begin() as conn:
+    written = write_visits(conn, visits)
+  for userid in set(userid for userid, _ in written):
+    visited_cache.pop(userid)
+  if written:
+    invalidate_stats()
+  return written
+
+def delete_monument_visits(session, monumentid):
+  """
+  Delete every visit of a monument in the session's transaction in one statement.
+
+  The statement bypasses the Visit events: the Monument delete that follows drops
+  the aggregates, and the visited ids of the visitors are dropped on commit.
+  """
+  visitors = session.execute(select(Visit.userid).where(Visit.monumentid == monumentid)).scalars().all()
+  if not visitors:
+    return
+  session.execute(delete(Visit).where(Visit.monumentid == monumentid), execution_options={"synchronize_session": False})
+  session.info.setdefault("visitors", set()).update(visitors)
+  bump(session.connection(), "visit")
+
+def record_batch(app, visits):
+  """
+  Write visits in one transaction, or one at a time if the batch fails on anything
+  but a transient error, so a visit the database rejects cannot hold up the others.
+  Rejected visits are logged and dropped, transient errors such as a locked database
+  are raised so the caller can retry the whole batch, which is safe to write twice.
+  """
+  try:
+    record_visits(visits)
+    return
+  except TRANSIENT_ERRORS:
+    raise
+  except Exception:
+    app.logger.exception("writing %d queued visits failed, writing them one at a time", len(visits))
+
+  for visit in visits:
+    try:
+      record_visits([visit])
+    except TRANSIENT_ERRORS:
+      raise
+    except Exception:
+      app.logger.exception("dropping queued visit %s", visit_to_json(visit))
+
+def visit_to_json(visit):
+  return json.dumps(dict(visit, visitedon=visit["visitedon"].isoformat()))
+
+def visit_from_json(line):
+  visit = json.loads(line)
+  visit["visitedon"] = date.fromisoformat(visit["visitedon"])
+  return visit
+
+class Segment:
+  """
+  One append-only file of the visit log, locked by the process writing it.
+
+  A segment whose lock can be taken belongs to no running process, its visits
+  were never written and are replayed.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, "x")
+    fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+  def append(self, visit):
+    self.file.write(visit_to_json(visit) + "\n")
+    # Into the operating system before the visit is acknowledged, so it survives a killed worker
+    self.file.flush()
+
+  def remove(self):
+    os.unlink(self.path)
+    self.file.close()
+
+class VisitQueue:
+  """
+  Visits waiting to be written, keyed by (userid, monumentid), flushed in one
+  transaction once VISIT_QUEUE_BATCH are queued or every VISIT_QUEUE_INTERVAL seconds.
+
+  In "log" mode every queued visit is appended to a segment file of this process
+  first; a segment is removed once its visits are committed.
+  """
+
+  def __init__(self, app, mode, directory, batch, interval, limit):
+    self.app = app
+    self.mode = mode
+    self.directory = directory
+    self.batch = batch
+    self.interval = interval
+    self.limit = limit
+    self.pending = {}
+    self._segment = None
+    # Segments of failed flushes, their visits are pending again
+    self._retained = []
+    self._flusher = None
+    self._wakeup = threading.Event()
+    self._lock = threading.Lock()
+    self._flush_lock = threading.Lock()
+
+  def add(self, visit):
+    """Queue a visit, returning False if the same visit is already queued."""
+    key = (visit["userid"], visit["monumentid"])
+    with self._lock:
+      if key in self.pending:
+        return False
+      if len(self.pending) >= self.limit:
+        raise VisitQueueFull()
+      if self.mode == "log":
+        if self._segment is None:
+          self._segment = Segment(os.path.join(self.directory, "visits-%d-%s.log" % (os.getpid(), secrets.token_hex(8))))
+        self._segment.append(visit)
+      self.pending[key] = visit
+      # Started on first use, so servers that fork after creating the app get a flusher per worker
+      if self._flusher is None:
+        self._flusher = threading.Thread(target=self.run, name="visit-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+      full = len(self.pending) >= self.batch
+    if full:
+      self._wakeup.set()
+    return True
+
+  def flush(self):
+    """
+    Write every queued visit, returning how many were queued. On a transient error
+    they are queued again, with their segments, and the error is raised.
+    """
+    with self._flush_lock:
+      with self._lock:
+        visits, self.pending = self.pending, {}
+        segments, self._retained = self._retained + ([self._segment] if self._segment else []), []
+        self._segment = None
+      if not visits:
+        return 0
+
+      try:
+        with self.app.app_context():
+          record_batch(self.app, list(visits.values()))
+      except TRANSIENT_ERRORS:
+        with self._lock:
+          for key, visit in visits.items():
+            self.pending.setdefault(key, visit)
+          self._retained = segments + self._retained
+        raise
+
+      for segment in segments:
+        segment.remove()
+      return len(visits)
+
+  def run(self):
+    while True:
+      self._wakeup.wait(self.interval)
+      self._wakeup.clear()
+      try:
+        self.flush()
+      except Exception:
+        self.app.logger.exception("writing queued visits failed, retrying in %s seconds", self.interval)
+
+def replay_segments(app, directory):
+  """Write the visits of log segments left behind by stopped processes, returning how many were found."""
+  found = 0
+  for path in sorted(glob.glob(os.path.join(directory, "visits-*.log"))):
+    try:
+      file = open(path)
+    except FileNotFoundError:
+      continue
+    with file:
+      try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        # Its process is still running
+        continue
+      # Another process may have replayed and removed it before the lock was ours
+      if not os.path.exists(path) or os.stat(path).st_ino != os.fstat(file.fileno()).st_ino:
+        continue
+      # A torn last line is a visit that was never acknowledged
+      visits = []
+      for line in file:
+        try:
+          visits.append(visit_from_json(line))
+        except ValueError:
+          pass
+      with app.app_context():
+        record_batch(app, visits)
+      os.unlink(path)
+      found += len(visits)
+  return found
+
+def check_in(userid, monumentid, grade, comment):
+  """
+  Record a visit of a listed monument the user has not visited yet, queued or
+  written at once depending on VISIT_QUEUE.
+
+  Queued visits are remembered in the session so the user's own pages show them
+  before they are written. Raises VisitQueueFull if the queue is full.
+  """
+  visit = dict(userid=userid, monumentid=monumentid, visitedon=date.today(), grade=grade, comment=comment)
+  queue = current_visit_queue()
+  if queue is None:
+    record_visits([visit])
+    return
+  if queue.add(visit):
+    remember_queued_visit(monumentid, grade, comment, visit["visitedon"])
+
+def current_visit_queue():
+  return current_app.extensions["visit_queue"]
+
+def init_visits(app):
+  """Set up the VISIT_QUEUE visit ingestion and replay log segments of stopped processes."""
+  mode = app.config["VISIT_QUEUE"]
+  if mode not in MODES:
+    raise ValueError("unsupported VISIT_QUEUE %r" % mode)
+  if mode == "log" and fcntl is None:
+    app.logger.warning("VISIT_QUEUE=log needs file locks, queueing visits in memory only")
+    mode = "memory"
+
+  app.extensions["visit_queue"] = None
+  if mode == "off":
+    return
+  directory = app.config["VISIT_QUEUE_DIR"]
+  if mode == "log":
+    os.makedirs(directory, exist_ok=True)
+    replayed = replay_segments(app, directory)
+    if replayed:
+      app.logger.warning("replayed %d queued visits of stopped processes", replayed)
+  app.extensions["visit_queue"] = VisitQueue(
+    app, mode, directory, app.config["VISIT_QUEUE_BATCH"], app.config["VISIT_QUEUE_INTERVAL"], app.config["VISIT_QUEUE_MAX"],
+  )